@@ -0,0 +1,113 @@
+"""Microbenchmark de extracción de listados: un find_element por campo y producto
+(como hacían los spiders) contra una sola foto del DOM con extraction.py.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.benchmarks.extraction_benchmark --products 48 480
+    python -m scr_pharma.benchmarks.extraction_benchmark --no-browser
+
+Con Chrome disponible se mide sobre una grilla sintética con la estructura de
+Ahumada; con --no-browser solo se mide el costo de parsear la foto del DOM."""
+import os
+import re
+import time
+import argparse
+import tempfile
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException
+from scrapy.http import HtmlResponse
+
+from ..extraction import extract_products, page_response
+from ..spiders.ahumada import AhumadaSpider
+
+TILE = """
+<div class="product-tile"><div class="product-tile h-100">
+  <div class="product-tile-brand"><span>Marca {i}</span></div>
+  <a class="link" href="/producto-{i}-{sku}.html">Producto {i}</a>
+  <del><span><span class="value" content="{price}">$ {price}</span></span></del>
+  <span class="sales"><span>$ {sale}</span></span>
+</div></div>"""
+
+
+def listing_html(products):
+    tiles = ''.join(TILE.format(i=i, sku=100000 + i, price=1990 + i, sale=1490 + i) for i in range(products))
+    return f"<html><body><div class='grid'>{tiles}</div><button class='more'>Más</button></body></html>"
+
+
+def per_element(driver):
+    # Mismo patrón que el extract_product_details original: 5 round-trips por producto
+    rows = []
+    for product in driver.find_elements(By.XPATH, AhumadaSpider.product_tiles_xpath):
+        try:
+            brand = product.find_element(By.XPATH, ".//div[@class='product-tile-brand']//span").text
+        except NoSuchElementException:
+            brand = 'No brand'
+        link = product.find_element(By.XPATH, ".//a[@class='link']")
+        product_url = link.get_attribute('href')
+        product_name = link.text
+        price = product.find_element(By.XPATH, ".//del//span//span[@class='value']").get_attribute('content')
+        price_sale = product.find_element(By.XPATH, ".//span[@class = 'sales']//span").text
+        sku_match = re.search(r'-(\d+)\.html$', product_url)
+        rows.append((brand, product_url, product_name, price, price_sale, sku_match.group(1) if sku_match else 'No SKU'))
+    return rows
+
+
+def bulk(driver):
+    page = page_response(driver)
+    return extract_products(page, AhumadaSpider.product_tiles_xpath, AhumadaSpider.product_fields)
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_parse_only(sizes, repeat):
+    print(f"{'products':>9} {'parse_ms':>9}")
+    for products in sizes:
+        response = HtmlResponse(url='https://www.farmaciasahumada.cl/grid', body=listing_html(products), encoding='utf-8')
+        elapsed, rows = timed(extract_products, response, AhumadaSpider.product_tiles_xpath,
+                              AhumadaSpider.product_fields, repeat=repeat)
+        assert len(rows) == products
+        print(f"{products:>9} {elapsed * 1000:>9.1f}")
+
+
+def run_browser(sizes, repeat):
+    from ..drivers import acquire_driver, release_driver
+    driver = acquire_driver()
+    try:
+        print(f"{'products':>9} {'per_element_s':>14} {'bulk_s':>8} {'speedup':>8}")
+        for products in sizes:
+            with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False, encoding='utf-8') as file:
+                file.write(listing_html(products))
+            try:
+                driver.get(f"file://{file.name}")
+                slow, slow_rows = timed(per_element, driver, repeat=repeat)
+                fast, fast_rows = timed(bulk, driver, repeat=repeat)
+            finally:
+                os.unlink(file.name)
+            assert len(slow_rows) == len(fast_rows) == products
+            print(f"{products:>9} {slow:>14.3f} {fast:>8.3f} {slow / fast:>7.1f}x")
+    finally:
+        release_driver(driver)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[48, 240, 960])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-browser', action='store_true', help="solo medir el parseo de la foto del DOM")
+    args = parser.parse_args()
+    if args.no_browser:
+        run_parse_only(args.products, args.repeat)
+    else:
+        run_browser(args.products, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
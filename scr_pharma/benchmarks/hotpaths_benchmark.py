@@ -0,0 +1,219 @@
+"""Microbenchmarks de los caminos calientes: helpers, carga de ítems y pipeline (CSV y base de datos).
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.benchmarks.hotpaths_benchmark --items 1000 10000 --output benchmark.json
+    python -m scr_pharma.benchmarks.hotpaths_benchmark --items 1000 10000 --compare benchmark.json
+
+Cada caso procesa un flujo sintético de ítems (sample_records de items_benchmark) y reporta
+ítems por segundo (el mejor de --repeat) y el pico de memoria Python (tracemalloc, en una pasada
+aparte para no distorsionar el tiempo). insert_into_database corre contra un SQLite temporal,
+con el hilo escritor y el reactor de Twisted, desde open_spider hasta que close_spider vacía la
+cola: 'new' inserta productos nuevos y 'unchanged' repite los mismos precios (solo last_seen).
+
+Con --compare el resultado se compara con un JSON anterior y el comando termina con código 1
+si algún caso quedó más lento que --max-regression (por defecto 15%)."""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+from scrapy import Spider
+from scrapy.settings import Settings
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, task
+
+from ..helpers import safe_price, format_datetime, safe_string
+from ..items import build_items
+from ..pipelines import ScrPharmaPipeline
+from .items_benchmark import sample_records, with_item_loader
+
+# Mismas columnas que db.sql, en SQLite
+SQLITE_SCHEMA = """CREATE TABLE scr_pharma (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) NOT NULL,
+url VARCHAR(255) NOT NULL UNIQUE, category VARCHAR(255) NOT NULL, price DECIMAL(10,2), price_sale DECIMAL(10,2),
+brand VARCHAR(255) NOT NULL, timestamp DATETIME NOT NULL, spider_name VARCHAR(255) NOT NULL, code VARCHAR(255),
+price_benef DECIMAL(10,2), last_seen DATETIME)"""
+
+
+def helper_cases(records):
+    prices = [record['price'] for record in records] + [record['price_sale'] for record in records]
+    names = [record['name'] for record in records]
+    now = datetime.now()
+    timestamps = [now] * len(records) + [format_datetime(now)] * len(records)
+    return {
+        'helpers.safe_price': (lambda: [safe_price(price) for price in prices], len(prices)),
+        'helpers.format_datetime': (lambda: [format_datetime(value) for value in timestamps], len(timestamps)),
+        'helpers.safe_string': (lambda: [safe_string(name, 255) for name in names], len(names)),
+    }
+
+
+def item_cases(records):
+    timestamp = datetime.now()
+    return {
+        'items.item_loader': (lambda: with_item_loader(records, 'ahumada', timestamp), len(records)),
+        'items.build_items': (lambda: build_items(records, 'ahumada', timestamp), len(records)),
+    }
+
+
+def pipeline_settings(directory, **overrides):
+    settings = Settings(get_project_settings().copy_to_dict())
+    settings.setdict({'CSV_OUTPUT_DIR': directory, 'DB_QUARANTINE_DIR': directory, 'DB_FLUSH_INTERVAL': 0,
+                      'PRICE_HISTORY_ENABLED': False, **overrides}, priority='cmdline')
+    return settings
+
+
+def csv_case(records, directory):
+    items = build_items(records, 'benchmark')
+    settings = pipeline_settings(directory, ENABLE_DATABASE_INSERTION=False)
+
+    def run():
+        pipeline = ScrPharmaPipeline(settings)
+        pipeline.open_spider(Spider('benchmark'))
+        for item in items:
+            pipeline.write_to_csv(item, 'benchmark')
+        pipeline.close_spider(Spider('benchmark'))
+    return run, len(items)
+
+
+def measure(function, count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result_row(count, best, peak)
+
+
+def result_row(count, seconds, peak):
+    return {'items': count, 'seconds': round(seconds, 6), 'items_per_sec': round(count / seconds, 1) if seconds else None,
+            'peak_memory_kb': round(peak / 1024, 1)}
+
+
+@defer.inlineCallbacks
+def run_database(records, directory, name):
+    # Un archivo SQLite por corrida: 'new' lo llena y 'unchanged' vuelve a pasar los mismos precios
+    path = os.path.join(directory, f'{name}.sqlite')
+    if not os.path.exists(path):
+        connection = sqlite3.connect(path)
+        connection.execute(SQLITE_SCHEMA)
+        connection.close()
+    settings = pipeline_settings(directory, DATABASE_URI=f'sqlite:///{path}', ENABLE_DATABASE_INSERTION=True)
+    spider = Spider('benchmark')
+    spider.crawler = get_crawler(Spider)
+    items = build_items(records, 'benchmark')
+    start = time.perf_counter()
+    pipeline = ScrPharmaPipeline(settings)
+    pipeline.open_spider(spider)
+    for item in items:
+        pending = pipeline.insert_into_database(item, spider)
+        if pending is not None:
+            # Backpressure del hilo escritor, igual que en process_item
+            yield pending
+    yield pipeline.close_spider(spider)
+    return time.perf_counter() - start
+
+
+@defer.inlineCallbacks
+def database_cases(records, directory, repeat):
+    results = {}
+    for case in ('new', 'unchanged'):
+        results[f'pipeline.insert_into_database[{case}]'] = None
+    for attempt in range(repeat + 1):
+        # La última pasada mide memoria; las anteriores, tiempo
+        name = f'db_{len(records)}_{attempt}'
+        trace = attempt == repeat
+        for case in ('new', 'unchanged'):
+            if trace:
+                tracemalloc.start()
+            elapsed = yield run_database(records, directory, name)
+            key = f'pipeline.insert_into_database[{case}]'
+            if trace:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results[key]['peak_memory_kb'] = round(peak / 1024, 1)
+            elif results[key] is None or elapsed < results[key]['seconds']:
+                results[key] = result_row(len(records), elapsed, 0)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = {(row['case'], row['items']): row for row in json.load(file)['results']}
+    regressions = []
+    print(f"\n{'case':<42} {'items':>7} {'baseline/s':>12} {'current/s':>12} {'change':>8}")
+    for row in results:
+        previous = baseline.get((row['case'], row['items']))
+        if previous is None or not previous['items_per_sec'] or not row['items_per_sec']:
+            continue
+        change = row['items_per_sec'] / previous['items_per_sec'] - 1
+        flag = ' <-' if change < -max_regression else ''
+        if flag:
+            regressions.append(row['case'])
+        print(f"{row['case']:<42} {row['items']:>7} {previous['items_per_sec']:>12,.0f} {row['items_per_sec']:>12,.0f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    directory = tempfile.mkdtemp(prefix='scr_pharma_benchmark_')
+    results = []
+    try:
+        print(f"{'case':<42} {'items':>7} {'items/s':>12} {'peak_kb':>10}")
+        for count in args.items:
+            records = sample_records(count)
+            cases = {**helper_cases(records), **item_cases(records),
+                     'pipeline.write_to_csv': csv_case(records, directory)}
+            rows = {case: measure(function, size, args.repeat) for case, (function, size) in cases.items()}
+            rows.update((yield database_cases(records, directory, args.repeat)))
+            for case, row in rows.items():
+                results.append({'case': case, **row})
+                print(f"{case:<42} {row['items']:>7} {row['items_per_sec']:>12,.0f} {row['peak_memory_kb']:>10,.0f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'repeat': args.repeat, 'results': results}, file, indent=1)
+        print(f"\nSaved {args.output}")
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+        if regressions:
+            print(f"\n{len(regressions)} cases are more than {args.max_regression:.0%} slower than {args.compare}")
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="guardar los resultados en este JSON")
+    parser.add_argument('--compare', help="JSON de una corrida anterior para detectar regresiones")
+    parser.add_argument('--max-regression', type=float, default=0.15)
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark de construcción de ítems: ItemLoader + add_value por ítem contra
+items.build_items para un lote de registros crudos.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.benchmarks.items_benchmark --items 500 5000
+
+Antes de medir se comprueba que ambos caminos producen exactamente los mismos ítems."""
+import time
+import random
+import argparse
+from datetime import datetime
+from scrapy.loader import ItemLoader
+
+from ..items import ScrPharmaItem, build_items
+
+BRANDS = ['Bayer', 'Pfizer', 'Laboratorio Chile', 'Saval', 'Recalcine', 'Eucerin', 'La Roche-Posay']
+CATEGORIES = ['medicamentos', 'dermocosmetica', 'belleza', 'vitaminas-y-suplementos', 'infantil-y-maternidad']
+
+
+def sample_records(count, seed=0):
+    # Registros con la forma que entregan los extract_*_details de los spiders
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        price = rng.randint(990, 99990)
+        records.append({
+            'brand': f" {rng.choice(BRANDS)} ",
+            'url': f"https://www.farmaciasahumada.cl/producto-{i}-{100000 + i}.html",
+            'name': f"Producto {i}, {rng.randint(1, 500)} mg x {rng.randint(1, 60)} comprimidos",
+            'price': f"$ {price:,}".replace(',', '.'),
+            'price_sale': rng.choice(['0', f"$ {int(price * 0.8):,}".replace(',', '.')]),
+            'price_benef': '0',
+            'code': str(100000 + i),
+            'category': rng.choice(CATEGORIES),
+        })
+    return records
+
+
+def with_item_loader(records, spider_name, timestamp):
+    items = []
+    for record in records:
+        loader = ItemLoader(item=ScrPharmaItem())
+        for field, value in record.items():
+            loader.add_value(field, value)
+        loader.add_value('timestamp', timestamp)
+        loader.add_value('spider_name', spider_name)
+        items.append(loader.load_item())
+    return items
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[500, 5000])
+    args = parser.parse_args()
+
+    timestamp = datetime.now()
+    print(f"{'items':>7} {'loader_items_s':>15} {'builder_items_s':>16} {'speedup':>8}")
+    for count in args.items:
+        records = sample_records(count)
+        slow, slow_items = timed(with_item_loader, records, 'ahumada', timestamp)
+        fast, fast_items = timed(build_items, records, 'ahumada', timestamp)
+        assert [dict(item) for item in slow_items] == [dict(item) for item in fast_items]
+        print(f"{count:>7} {count / slow:>15,.0f} {count / fast:>16,.0f} {slow / fast:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
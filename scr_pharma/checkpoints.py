@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+from datetime import datetime
+from scrapy import signals
+from scrapy.utils.project import data_path
+
+logger = logging.getLogger(__name__)
+
+# Señal del crawler al terminar una categoría (argumentos category y failed): la cola compartida
+# (workqueue.py) da la categoría por completa recién ahí, no cuando el loop del spider pasa a la siguiente
+category_finished = object()
+
+
+def checkpoint_path(settings, spider_name, worker=None):
+    # Con la cola compartida (workqueue.py) cada worker (-a worker=N) tiene su propio checkpoint
+    directory = settings.get('CHECKPOINT_DIR') or data_path('checkpoints', createdir=True)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{spider_name}_{worker}.json' if worker else f'{spider_name}.json')
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class Checkpoint:
+    """Checkpoints por página para los loops Selenium, cuyo estado (categoría, offset, página)
+    vive en variables locales de parse() y JOBDIR no puede guardar.
+
+    Después de cada página el spider llama a page_done(categoría, cursor, ítems) y el estado se
+    reescribe de forma atómica en CHECKPOINT_DIR/<spider>.json. Con -a resume=true (o
+    CHECKPOINT_RESUME) un spider que no terminó retoma desde la página siguiente a la última
+    completada: las categorías terminadas se saltan y las páginas ya emitidas no se repiten."""
+
+    def __init__(self, spider):
+        self.spider = spider
+        settings = spider.settings
+        self.path = checkpoint_path(settings, spider.name, getattr(spider, 'worker', None))
+        self.failed = False
+        resume = settings.getbool('CHECKPOINT_RESUME', False) or str(getattr(spider, 'resume', '')).lower() in ('1', 'true', 'yes')
+        previous = load_checkpoint(self.path) if resume else None
+        if previous is not None and previous.get('status') != 'finished':
+            self.state = previous
+            self.state['resumes'] = self.state.get('resumes', 0) + 1
+            logger.info(f"Resuming {spider.name} from checkpoint: {len(self.done_categories())} categories done, "
+                        f"{self.state['items']} items already emitted")
+        else:
+            self.state = {'spider': spider.name, 'started': now(), 'items': 0, 'resumes': 0, 'categories': {}}
+        self.state['status'] = 'running'
+        self.save()
+        spider.crawler.signals.connect(self.spider_error, signal=signals.spider_error)
+
+    def entry(self, category):
+        # Las claves JSON son texto: ids numéricos o tuplas se guardan como str
+        return self.state['categories'].setdefault(str(category), {'cursor': None, 'pages': 0, 'items': 0, 'done': False})
+
+    def done_categories(self):
+        return [category for category, entry in self.state['categories'].items() if entry['done']]
+
+    def is_done(self, category):
+        return self.entry(category)['done']
+
+    def cursor(self, category):
+        # Cursor (offset, URL...) de la última página completada, o None
+        return self.entry(category)['cursor']
+
+    def pages_done(self, category):
+        return self.entry(category)['pages']
+
+    def page_done(self, category, cursor, items):
+        entry = self.entry(category)
+        entry['cursor'] = cursor
+        entry['pages'] += 1
+        entry['items'] += items
+        self.state['items'] += items
+        self.save()
+
+    def category_done(self, category):
+        self.entry(category)['done'] = True
+        self.save()
+        self.spider.crawler.signals.send_catch_log(category_finished, category=str(category), failed=False)
+
+    def mark_failed(self, category=None):
+        # Para los errores que el spider atrapa y registra sin cortar el crawl (p.ej. Chrome caído)
+        self.failed = True
+        if category is not None:
+            self.spider.crawler.signals.send_catch_log(category_finished, category=str(category), failed=True)
+
+    def spider_error(self, failure, response, spider):
+        self.failed = True
+
+    def close(self, reason):
+        self.state['status'] = 'finished' if reason == 'finished' and not self.failed else 'interrupted'
+        self.state['finish_reason'] = reason
+        self.save()
+
+    def save(self):
+        # Escritura atómica: un proceso que muere a mitad de save() deja el checkpoint anterior intacto
+        self.state['updated'] = now()
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.state, file, ensure_ascii=False, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+
+def now():
+    return datetime.now().isoformat(timespec='seconds')
@@ -0,0 +1,126 @@
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import logging
+from datetime import datetime
+from scrapy import Request
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_from_dict
+
+from .items import ScrPharmaItem, UnchangedScrPharmaItem
+from .helpers import format_datetime
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class ContentCache:
+    """Caché de contenido para re-crawls incrementales (ver middlewares.py).
+
+    Por cada página (fingerprint de la request o URL de Selenium) guarda el hash del
+    cuerpo, los validadores HTTP (ETag / Last-Modified) y lo que produjo el callback:
+    ítems y requests. Si la página vuelve igual (304 o mismo hash) no se parsea: se
+    re-emiten las requests guardadas y los ítems como UnchangedScrPharmaItem con un
+    timestamp nuevo, para que el pipeline solo les actualice last_seen."""
+
+    def __init__(self, path, max_age=None, stats=None):
+        self.path = path
+        self.max_age = max_age
+        self.stats = stats
+        # Autocommit + WAL: cada página se guarda al terminar su callback, sin dejar transacciones
+        # abiertas que bloqueen a otros spiders del mismo proceso que usan el mismo archivo
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, spider TEXT, content_hash TEXT, etag TEXT, last_modified TEXT,"
+            "outputs BLOB, stored_at REAL)")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('CONTENT_CACHE_FILE') or data_path('content_cache.sqlite', createdir=True)
+        max_age = settings.getfloat('CONTENT_CACHE_MAX_AGE', 0) or None
+        return cls(path, max_age=max_age, stats=crawler.stats)
+
+    def close(self):
+        self.connection.close()
+
+    def inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(f'content_cache/{key}', count)
+
+    def get(self, key):
+        # Las entradas más viejas que max_age se ignoran: la página se vuelve a parsear completa
+        row = self.connection.execute(
+            "SELECT content_hash, etag, last_modified, outputs, stored_at FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.max_age and time.time() - row[4] > self.max_age):
+            return None
+        return {'content_hash': row[0], 'etag': row[1], 'last_modified': row[2], 'outputs': row[3]}
+
+    def store(self, key, spider, body_hash, outputs, etag=None, last_modified=None):
+        try:
+            blob = self.serialize(outputs, spider)
+        except (ValueError, TypeError, pickle.PicklingError) as e:
+            # Salidas que no se pueden re-emitir (p.ej. callbacks que no son métodos del spider)
+            logger.debug(f"Not caching {key}: {e}")
+            self.inc_stat('uncacheable')
+            return
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pages (key, spider, content_hash, etag, last_modified, outputs, stored_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, spider.name, body_hash, etag, last_modified, blob, time.time()))
+        self.inc_stat('stored')
+
+    def serialize(self, outputs, spider):
+        records = []
+        for output in outputs:
+            if isinstance(output, ScrPharmaItem):
+                records.append(('item', dict(output)))
+            elif isinstance(output, Request):
+                records.append(('request', output.to_dict(spider=spider)))
+            else:
+                raise TypeError(f"unsupported output {type(output).__name__}")
+        return zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def replay(self, entry, spider):
+        # Un solo timestamp por página, igual que build_items
+        timestamp = format_datetime(datetime.now())
+        outputs = []
+        for kind, value in pickle.loads(zlib.decompress(entry['outputs'])):
+            if kind == 'request':
+                outputs.append(request_from_dict(value, spider=spider))
+            else:
+                item = UnchangedScrPharmaItem(value)
+                item['timestamp'] = timestamp
+                outputs.append(item)
+        self.inc_stat('replayed_items', sum(1 for output in outputs if isinstance(output, ScrPharmaItem)))
+        return outputs
+
+    def page_items(self, spider, key, body, parse):
+        # Hook para páginas cargadas con Selenium: parse() solo se llama si el DOM cambió
+        entry = self.get(key)
+        body_hash = content_hash(body)
+        if entry is not None and entry['content_hash'] == body_hash:
+            self.inc_stat('unchanged')
+            return self.replay(entry, spider)
+        self.inc_stat('changed')
+        items = list(parse())
+        self.store(key, spider, body_hash, items)
+        return items
+
+
+def page_items(spider, key, body, parse):
+    """Ítems de una página Selenium a través del caché de contenido del spider, si está activo.
+
+    `parse` es un callable sin argumentos que devuelve la lista de ítems de la página."""
+    cache = getattr(spider, 'content_cache', None)
+    if cache is None:
+        return parse()
+    return cache.page_items(spider, key, body if isinstance(body, bytes) else body.encode('utf-8'), parse)
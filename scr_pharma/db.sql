@@ -10,6 +10,15 @@ CREATE TABLE `scr_pharma` (
   `spider_name` VARCHAR(255) NOT NULL,
   `code` VARCHAR(255),
   `price_benef` DECIMAL(10,2),
+  `last_seen` DATETIME,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `url_unique` (`url`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
\ No newline at end of file
+  UNIQUE KEY `url_unique` (`url`),
+  KEY `spider_name_idx` (`spider_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Bases de datos creadas antes de las escrituras solo de cambios: el pipeline agrega solo la columna
+-- last_seen y el índice spider_name_idx al arrancar (pipelines.migrate_table); equivale a
+-- ALTER TABLE `scr_pharma` ADD COLUMN `last_seen` DATETIME, ADD KEY `spider_name_idx` (`spider_name`);
+
+-- Historial de precios (history.py): el pipeline crea solo las tablas scr_pharma_history_<AAAA>_<MM>
+-- (una por mes, clave (url, day)) y scr_pharma_price_intervals (clave (url, valid_from))
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import atexit
+import logging
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
+from scrapy.utils.project import get_project_settings, data_path
+
+from .replay import prepare_driver
+
+logger = logging.getLogger(__name__)
+
+# Estado compartido por todos los spiders del mismo proceso
+_driver_path = None
+_idle_drivers = []
+_cookies = {}
+
+
+def chromedriver_path(settings=None):
+    """Ruta al binario de chromedriver, resuelta una sola vez por proceso.
+
+    Orden: CHROMEDRIVER_PATH fijo, caché en memoria, caché en disco (válida por
+    CHROMEDRIVER_CACHE_TTL segundos) y por último webdriver_manager, que requiere red.
+    Con CHROMEDRIVER_OFFLINE nunca se usa la red."""
+    global _driver_path
+    settings = settings or get_project_settings()
+    if settings.get('CHROMEDRIVER_PATH'):
+        return settings.get('CHROMEDRIVER_PATH')
+    if _driver_path:
+        return _driver_path
+
+    cache_file = settings.get('CHROMEDRIVER_CACHE_FILE') or data_path('chromedriver.json', createdir=True)
+    offline = settings.getbool('CHROMEDRIVER_OFFLINE', False)
+    try:
+        with open(cache_file, encoding='utf-8') as file:
+            cached = json.load(file)
+        fresh = time.time() - cached['resolved_at'] < settings.getint('CHROMEDRIVER_CACHE_TTL', 24 * 60 * 60)
+        if os.path.isfile(cached['path']) and (fresh or offline):
+            _driver_path = cached['path']
+            return _driver_path
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if offline:
+        raise RuntimeError("CHROMEDRIVER_OFFLINE is set but no CHROMEDRIVER_PATH or cached chromedriver is available")
+
+    from webdriver_manager.chrome import ChromeDriverManager
+    _driver_path = ChromeDriverManager().install()
+    with open(cache_file, 'w', encoding='utf-8') as file:
+        json.dump({'path': _driver_path, 'resolved_at': time.time()}, file)
+    return _driver_path
+
+
+def chrome_options(settings=None):
+    settings = settings or get_project_settings()
+    options = Options()
+    for argument in settings.getlist('CHROME_ARGUMENTS', ['--headless']):
+        options.add_argument(argument)
+    options.page_load_strategy = settings.get('CHROME_PAGE_LOAD_STRATEGY', 'normal')
+    return options
+
+
+def is_alive(driver):
+    try:
+        driver.window_handles
+        return True
+    except WebDriverException:
+        return False
+
+
+def acquire_driver(settings=None):
+    """Entrega un Chrome listo para usar; si WEBDRIVER_REUSE está activo reutiliza
+    uno liberado por otro spider del mismo proceso en vez de lanzar uno nuevo."""
+    settings = settings or get_project_settings()
+    while _idle_drivers:
+        driver = _idle_drivers.pop()
+        if is_alive(driver):
+            return prepare_driver(driver)
+    service = Service(chromedriver_path(settings))
+    return prepare_driver(webdriver.Chrome(service=service, options=chrome_options(settings)))
+
+
+def release_driver(driver, settings=None):
+    settings = settings or get_project_settings()
+    if driver is None or not is_alive(driver):
+        return
+    if not settings.getbool('WEBDRIVER_REUSE', True):
+        driver.quit()
+        return
+    try:
+        # Dejar una sola pestaña abierta antes de devolverlo al pool
+        for handle in driver.window_handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        _idle_drivers.append(driver)
+    except WebDriverException:
+        driver.quit()
+
+
+def save_cookies(driver, key):
+    # Cookies de una sesión "calentada" (p.ej. la home de CruzVerde) para reutilizarlas en otro driver
+    _cookies[key] = driver.get_cookies()
+
+
+def restore_cookies(driver, key):
+    # El driver debe estar en una página del mismo dominio que las cookies
+    for cookie in _cookies.get(key, []):
+        try:
+            driver.add_cookie(cookie)
+        except WebDriverException as e:
+            logger.debug(f"Could not restore cookie {cookie.get('name')}: {str(e)}")
+    return bool(_cookies.get(key))
+
+
+@atexit.register
+def quit_idle_drivers():
+    while _idle_drivers:
+        driver = _idle_drivers.pop()
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
@@ -0,0 +1,184 @@
+import io
+import os
+import csv
+import gzip
+import time
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def next_midnight():
+    # Momento (epoch) en que cambia el día local y hay que rotar el archivo
+    tomorrow = datetime.now().date() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+
+class DailyCsvWriter:
+    """Writer CSV de larga vida para un spider: un archivo por día, con buffer
+    y compresión opcional (gzip o zstd) en streaming."""
+
+    def __init__(self, base_dir, spider_name, fieldnames, compression=None, buffer_size=1024 * 1024):
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unsupported CSV compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("CSV_COMPRESSION = 'zstd' requires the 'zstandard' package")
+        self.base_dir = base_dir
+        self.spider_name = spider_name
+        self.fieldnames = list(fieldnames)
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.raw_file = None
+        self.file = None
+        self.writer = None
+        self.file_path = None
+        self.rollover_at = 0
+
+    def path_for(self, day):
+        extension = COMPRESSION_EXTENSIONS[self.compression]
+        return os.path.join(self.base_dir, f'{self.spider_name}_{day.strftime("%Y_%m_%d")}.csv{extension}')
+
+    def open(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.file_path = self.path_for(datetime.now())
+        # Si el spider se vuelve a ejecutar el mismo día se sigue agregando al archivo
+        # existente; gzip y zstd admiten varios frames concatenados en un mismo archivo
+        write_header = not os.path.isfile(self.file_path) or os.path.getsize(self.file_path) == 0
+        self.raw_file = open(self.file_path, 'ab', buffering=self.buffer_size)
+        if self.compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=self.raw_file, mode='ab')
+        elif self.compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(self.raw_file, closefd=False)
+        else:
+            stream = self.raw_file
+        self.file = io.TextIOWrapper(stream, encoding='utf-8', newline='', write_through=False)
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+        if write_header:
+            self.writer.writeheader()
+        self.rollover_at = next_midnight()
+
+    def write(self, item):
+        if self.writer is None or time.time() >= self.rollover_at:
+            self.rotate()
+        self.writer.writerow(item)
+
+    def rotate(self):
+        self.close()
+        self.open()
+
+    def close(self):
+        if self.file is None:
+            return
+        # Cerrar el TextIOWrapper vacía su buffer y finaliza el frame gzip/zstd
+        self.file.close()
+        if not self.raw_file.closed:
+            self.raw_file.close()
+        self.file = None
+        self.raw_file = None
+        self.writer = None
+
+
+def parquet_schema():
+    # Esquema fijo derivado de ScrPharmaItem: precios enteros (pesos chilenos), columnas
+    # de baja cardinalidad codificadas como diccionario y timestamp nativo
+    text_dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('name', pa.string()),
+        ('url', pa.string()),
+        ('category', text_dictionary),
+        ('price', pa.int64()),
+        ('price_sale', pa.int64()),
+        ('brand', text_dictionary),
+        ('timestamp', pa.timestamp('s')),
+        ('spider_name', text_dictionary),
+        ('code', pa.string()),
+        ('price_benef', pa.int64()),
+    ])
+
+
+class DailyParquetWriter:
+    """Writer Parquet en streaming para un spider: un archivo por día, escrito en
+    row groups de row_group_size filas."""
+
+    price_fields = ('price', 'price_sale', 'price_benef')
+
+    def __init__(self, base_dir, spider_name, row_group_size=50000, compression='zstd'):
+        if pq is None:
+            raise ImportError("Parquet export requires the 'pyarrow' package")
+        self.base_dir = base_dir
+        self.spider_name = spider_name
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.schema = parquet_schema()
+        self.columns = {field.name: [] for field in self.schema}
+        self.pending = 0
+        self.writer = None
+        self.file_path = None
+        self.rollover_at = 0
+
+    def path_for(self, day):
+        # Parquet no admite agregar datos a un archivo cerrado: una segunda ejecución
+        # del mismo día escribe <spider>_<fecha>_1.parquet, _2, ...
+        base_name = f'{self.spider_name}_{day.strftime("%Y_%m_%d")}'
+        file_path = os.path.join(self.base_dir, f'{base_name}.parquet')
+        run = 0
+        while os.path.exists(file_path):
+            run += 1
+            file_path = os.path.join(self.base_dir, f'{base_name}_{run}.parquet')
+        return file_path
+
+    def open(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.file_path = self.path_for(datetime.now())
+        self.writer = pq.ParquetWriter(self.file_path, self.schema, compression=self.compression)
+        self.rollover_at = next_midnight()
+
+    def write(self, item):
+        if self.writer is None or time.time() >= self.rollover_at:
+            self.rotate()
+        for name, values in self.columns.items():
+            values.append(self.convert(name, item.get(name)))
+        self.pending += 1
+        if self.pending >= self.row_group_size:
+            self.flush()
+
+    def convert(self, name, value):
+        if value is None:
+            return None
+        if name in self.price_fields:
+            return int(round(float(value)))
+        if name == 'timestamp' and isinstance(value, str):
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return value
+
+    def flush(self):
+        if not self.pending:
+            return
+        table = pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        for values in self.columns.values():
+            values.clear()
+        self.pending = 0
+
+    def rotate(self):
+        self.close()
+        self.open()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        self.writer.close()
+        self.writer = None
@@ -0,0 +1,45 @@
+from scrapy.http import HtmlResponse
+
+
+# Extracción de listados en bloque: en vez de un product.find_element(...) por campo y por
+# producto (cada uno es un round-trip HTTP a chromedriver), se toma una sola foto del DOM y
+# los campos se leen localmente con los selectores parsel de Scrapy.
+
+# Hook para las fotos del DOM (url, html) -> url; lo instala replay.configure con REPLAY_MODE
+_snapshot_hook = None
+
+
+def set_snapshot_hook(hook):
+    global _snapshot_hook
+    _snapshot_hook = hook
+
+
+def page_snapshot(url, html):
+    """URL para el HtmlResponse de una foto del DOM: la misma URL, salvo que replay.py haya
+    instalado su hook (graba la foto o devuelve la URL original en vez de la del servidor)."""
+    return _snapshot_hook(url, html) if _snapshot_hook is not None else url
+
+
+def page_response(driver):
+    # Dos round-trips por página (current_url y page_source), sin importar cuántos productos tenga
+    html = driver.page_source
+    return HtmlResponse(url=page_snapshot(driver.current_url, html), body=html, encoding='utf-8')
+
+
+def extract_fields(product, fields, response):
+    """Aplica los XPaths relativos de `fields` ({campo: xpath}) a un producto.
+
+    Los campos sin valor quedan en None; los que terminan en @href se devuelven
+    como URL absoluta, igual que get_attribute('href') en Selenium."""
+    details = {}
+    for name, xpath in fields.items():
+        value = product.xpath(xpath).get()
+        value = value.strip() if value else None
+        if value and xpath.endswith('@href'):
+            value = response.urljoin(value)
+        details[name] = value or None
+    return details
+
+
+def extract_products(response, products_xpath, fields):
+    return [extract_fields(product, fields, response) for product in response.xpath(products_xpath)]
@@ -1,14 +1,24 @@
 import re
 from datetime import datetime
 
+NON_DIGITS = re.compile(r'\D')
+
 def safe_price(value):
     try:
         # Eliminar todos los caracteres que no sean números
-        clean_value = re.sub(r'\D', '', str(value))
+        clean_value = NON_DIGITS.sub('', str(value))
         return float(clean_value) if clean_value else 0
     except Exception:
         return 0
 
+def number_to_price(value):
+    # Precios numéricos de APIs JSON (p.ej. 12990.0): redondear antes de pasarlos a safe_price,
+    # que descarta el punto decimal y convertiría 12990.0 en 129900
+    try:
+        return str(int(round(float(value))))
+    except (TypeError, ValueError):
+        return '0'
+
 def replace_comma(value):
     # Reemplazar comas por puntos para correcta conversión decimal
     return str(value).replace(',', '.')
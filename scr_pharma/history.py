@@ -0,0 +1,299 @@
+"""Historial de precios de scr_pharma.
+
+Dos niveles de almacenamiento:
+
+- scr_pharma_history_<AAAA>_<MM>: una tabla (partición) por mes con los cambios de precio,
+  clave (url, day). El pipeline agrega una fila solo cuando un producto es nuevo o cambió
+  algún precio; si cambia varias veces en el día queda el último valor.
+- scr_pharma_price_intervals: intervalos de vigencia (valid_from, valid_to) que arma la
+  compactación a partir de los meses cerrados, plegando los cambios que repiten los mismos
+  precios. valid_to NULL es el intervalo vigente.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.history compact
+    python -m scr_pharma.history price <url> 2024-05-17
+    python -m scr_pharma.history import datafolder/ahumada_2024_05_*.csv"""
+import io
+import os
+import re
+import csv
+import gzip
+import argparse
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from sqlalchemy import (create_engine, inspect, bindparam, select, update, Table, Column, String, Float, Date,
+                        DateTime, MetaData)
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PARTITION_PREFIX = 'scr_pharma_history_'
+PARTITION_PATTERN = re.compile(rf'^{PARTITION_PREFIX}(\d{{4}}_\d{{2}})$')
+INTERVALS_TABLE = 'scr_pharma_price_intervals'
+PRICE_FIELDS = ('price', 'price_sale', 'price_benef')
+DAILY_CSV_PATTERN = re.compile(r'^(?P<spider>.+)_(?P<day>\d{4}_\d{2}_\d{2})\.csv(\.gz|\.zst)?$')
+
+
+def upsert_statement(engine, table, index_elements):
+    # INSERT ... ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT (SQLite, PostgreSQL) sobre una clave única
+    dialect = engine.dialect.name
+    updated_columns = [c.name for c in table.columns if c.name != 'id' and c.name not in index_elements]
+    if dialect in ('mysql', 'mariadb'):
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in updated_columns})
+    if dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        return stmt.on_conflict_do_update(index_elements=index_elements, set_={c: stmt.excluded[c] for c in updated_columns})
+    return table.insert()
+
+
+def month_of(day):
+    return day.strftime('%Y_%m')
+
+
+def observed_at(row):
+    return row.get('timestamp') or datetime.now()
+
+
+def prices_of(row):
+    # Igual que pipelines.price_key: MySQL devuelve DECIMAL y los ítems traen float
+    return tuple(float(row.get(field) or 0) for field in PRICE_FIELDS)
+
+
+class PriceHistory:
+    def __init__(self, engine):
+        self.engine = engine
+        self.metadata = MetaData()
+        self.partitions = {}
+        self.upserts = {}
+        self.intervals = Table(INTERVALS_TABLE, self.metadata,
+            Column('url', String(255), primary_key=True),
+            Column('valid_from', Date, primary_key=True),
+            Column('valid_to', Date),
+            Column('spider_name', String(255)),
+            *[Column(field, Float) for field in PRICE_FIELDS])
+        self.intervals.create(engine, checkfirst=True)
+
+    def partition(self, month):
+        # La clave primaria (url, day) es también el índice de las consultas por fecha. El CREATE TABLE
+        # usa su propia conexión: en MySQL un DDL hace commit implícito de la transacción abierta
+        if month not in self.partitions:
+            table = Table(f'{PARTITION_PREFIX}{month}', self.metadata,
+                Column('url', String(255), primary_key=True),
+                Column('day', Date, primary_key=True),
+                Column('spider_name', String(255)),
+                *[Column(field, Float) for field in PRICE_FIELDS],
+                Column('observed_at', DateTime))
+            table.create(self.engine, checkfirst=True)
+            self.partitions[month] = table
+            self.upserts[month] = upsert_statement(self.engine, table, ['url', 'day'])
+        return self.partitions[month]
+
+    def months(self):
+        # Meses con partición, es decir, con cambios todavía sin compactar
+        names = inspect(self.engine).get_table_names()
+        return sorted(match.group(1) for match in map(PARTITION_PATTERN.match, names) if match)
+
+    def prepare(self, rows):
+        """Crea las particiones que necesitan `rows`. Se llama antes de abrir la transacción de
+        record(), nunca dentro."""
+        for month in {month_of(observed_at(row).date()) for row in rows}:
+            self.partition(month)
+
+    def record(self, connection, rows):
+        """Agrega a las particiones las filas del pipeline (dicts con url, timestamp, spider_name y
+        precios). Se llama dentro de la transacción del upsert de scr_pharma, con las particiones
+        ya creadas por prepare(): así no hay DDL dentro de la transacción."""
+        changes = defaultdict(dict)
+        for row in rows:
+            observed = observed_at(row)
+            day = observed.date()
+            changes[month_of(day)][(row['url'], day)] = {
+                'url': row['url'], 'day': day, 'spider_name': row.get('spider_name'), 'observed_at': observed,
+                **{field: row.get(field) for field in PRICE_FIELDS}}
+        for month, month_changes in changes.items():
+            if month not in self.partitions:
+                raise RuntimeError(f"History partition {month} does not exist; call PriceHistory.prepare() before the transaction")
+            connection.execute(self.upserts[month], list(month_changes.values()))
+
+    def open_intervals(self, connection):
+        table = self.intervals
+        query = select(table.c.url, table.c.valid_from, *[table.c[field] for field in PRICE_FIELDS]).where(table.c.valid_to.is_(None))
+        return {url: (valid_from, prices_of(dict(zip(PRICE_FIELDS, prices))))
+                for url, valid_from, *prices in connection.execute(query)}
+
+    def compact(self, month, drop=True):
+        """Pliega los cambios de un mes en intervalos de vigencia y, con drop, elimina la partición.
+
+        Los meses se compactan en orden. Es idempotente: los cambios con fecha anterior o igual al
+        inicio del intervalo vigente de su url ya están incorporados y se ignoran. Devuelve None si el
+        mes no tiene partición."""
+        if month not in self.months():
+            return None
+        table = self.partition(month)
+        intervals = self.intervals
+        stats = {'changes': 0, 'folded': 0, 'stale': 0, 'intervals': 0}
+        with self.engine.begin() as connection:
+            current = self.open_intervals(connection)
+            closed, opened = [], {}
+            query = select(table).order_by(table.c.url, table.c.day)
+            for change in connection.execute(query).mappings():
+                stats['changes'] += 1
+                url, day, prices = change['url'], change['day'], prices_of(change)
+                if url in current and day <= current[url][0]:
+                    stats['stale'] += 1
+                    continue
+                if url in current and current[url][1] == prices:
+                    # Mismos precios que el intervalo vigente: se pliega en él
+                    stats['folded'] += 1
+                    continue
+                if url in current:
+                    valid_from = current[url][0]
+                    if (url, valid_from) in opened:
+                        opened[(url, valid_from)]['valid_to'] = day - timedelta(days=1)
+                    else:
+                        closed.append({'b_url': url, 'b_valid_from': valid_from, 'valid_to': day - timedelta(days=1)})
+                opened[(url, day)] = {'url': url, 'valid_from': day, 'valid_to': None, 'spider_name': change['spider_name'],
+                                      **{field: change[field] for field in PRICE_FIELDS}}
+                current[url] = (day, prices)
+            if closed:
+                connection.execute(
+                    update(intervals).where(intervals.c.url == bindparam('b_url'), intervals.c.valid_from == bindparam('b_valid_from'))
+                    .values(valid_to=bindparam('valid_to')), closed)
+            if opened:
+                connection.execute(intervals.insert(), list(opened.values()))
+            stats['intervals'] = len(opened)
+            if drop:
+                table.drop(connection)
+        if drop:
+            self.metadata.remove(table)
+            del self.partitions[month], self.upserts[month]
+        return stats
+
+    def price_on(self, url, day):
+        """Precios de `url` vigentes el día `day`, o None. Solo búsquedas por clave primaria:
+        primero las particiones sin compactar hasta ese mes, luego los intervalos."""
+        with self.engine.connect() as connection:
+            for month in reversed([month for month in self.months() if month <= month_of(day)]):
+                table = self.partition(month)
+                row = connection.execute(
+                    select(table).where(table.c.url == url, table.c.day <= day).order_by(table.c.day.desc()).limit(1)).mappings().first()
+                if row is not None:
+                    return {'url': url, 'valid_from': row['day'], 'valid_to': None, 'spider_name': row['spider_name'],
+                            **{field: row[field] for field in PRICE_FIELDS}}
+            table = self.intervals
+            row = connection.execute(
+                select(table).where(table.c.url == url, table.c.valid_from <= day)
+                .order_by(table.c.valid_from.desc()).limit(1)).mappings().first()
+        if row is None or (row['valid_to'] is not None and row['valid_to'] < day):
+            return None
+        return dict(row)
+
+    def latest_prices(self):
+        # Últimos precios conocidos por url: intervalos vigentes y luego las particiones en orden
+        with self.engine.connect() as connection:
+            latest = {url: prices for url, (valid_from, prices) in self.open_intervals(connection).items()}
+            for month in self.months():
+                table = self.partition(month)
+                for change in connection.execute(select(table).order_by(table.c.day)).mappings():
+                    latest[change['url']] = prices_of(change)
+        return latest
+
+    def import_csv(self, paths, batch_size=5000):
+        """Carga en el historial los CSV diarios del pipeline (uno o varios días), registrando solo
+        los cambios respecto de los últimos precios conocidos."""
+        latest = self.latest_prices()
+        imported = 0
+        rows = []
+        for path in sorted(paths, key=csv_date):
+            with open_csv(path) as file:
+                for record in csv.DictReader(file):
+                    if not record.get('url') or not record.get('timestamp'):
+                        continue
+                    row = {'url': record['url'], 'spider_name': record.get('spider_name'),
+                           'timestamp': datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S"),
+                           **{field: float(record[field]) if record.get(field) else None for field in PRICE_FIELDS}}
+                    prices = prices_of(row)
+                    if latest.get(row['url']) == prices:
+                        continue
+                    latest[row['url']] = prices
+                    rows.append(row)
+                    if len(rows) >= batch_size:
+                        imported += self.write(rows)
+                        rows = []
+        if rows:
+            imported += self.write(rows)
+        return imported
+
+    def write(self, rows):
+        self.prepare(rows)
+        with self.engine.begin() as connection:
+            self.record(connection, rows)
+        return len(rows)
+
+
+def csv_spider(path):
+    # Spider de un CSV diario <spider>_<AAAA>_<MM>_<DD>.csv[.gz|.zst]; None para cualquier otro archivo,
+    # p.ej. la cuarentena del pipeline (<spider>_quarantine_<fecha>.csv), que comparte datafolder
+    match = DAILY_CSV_PATTERN.match(os.path.basename(path))
+    if match is None or match.group('spider').endswith('_quarantine'):
+        return None
+    return match.group('spider')
+
+
+def csv_date(path):
+    # <spider>_<AAAA>_<MM>_<DD>.csv[.gz|.zst]: los días se importan en orden
+    match = re.search(r'(\d{4}_\d{2}_\d{2})\.csv', path)
+    return match.group(1) if match else path
+
+
+def open_csv(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("Reading .csv.zst files requires the 'zstandard' package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+                                encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', help="URI SQLAlchemy (por defecto la de credentials.py)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    compact = commands.add_parser('compact', help="compactar los meses cerrados en intervalos")
+    compact.add_argument('--month', nargs='+', help="meses AAAA_MM (por defecto todos los anteriores al actual)")
+    compact.add_argument('--keep-partitions', action='store_true', help="no eliminar las particiones compactadas")
+    price = commands.add_parser('price', help="precio de un producto en una fecha")
+    price.add_argument('url')
+    price.add_argument('day', type=date.fromisoformat)
+    load = commands.add_parser('import', help="cargar CSV diarios del pipeline en el historial")
+    load.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    if args.uri is None:
+        from .credentials import SQLALCHEMY_DATABASE_URI
+        args.uri = SQLALCHEMY_DATABASE_URI
+    history = PriceHistory(create_engine(args.uri))
+    if args.command == 'compact':
+        current_month = month_of(date.today())
+        for month in args.month or [month for month in history.months() if month < current_month]:
+            stats = history.compact(month, drop=not args.keep_partitions)
+            if stats is None:
+                print(f"{month}: no partition")
+                continue
+            print(f"{month}: {stats['changes']} changes, {stats['intervals']} new intervals, "
+                  f"{stats['folded']} folded, {stats['stale']} already compacted")
+    elif args.command == 'price':
+        print(history.price_on(args.url, args.day))
+    else:
+        print(f"Imported {history.import_csv(args.paths)} price changes")
+
+
+if __name__ == '__main__':
+    main()
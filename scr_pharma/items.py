@@ -1,3 +1,5 @@
+import sys
+from datetime import datetime
 from scrapy import Item, Field
 from itemloaders.processors import TakeFirst, MapCompose
 from .helpers import *
@@ -45,3 +47,73 @@ class ScrPharmaItem(Item):
         input_processor=MapCompose(safe_price),
         output_processor=TakeFirst()
     )
+
+
+class UnchangedScrPharmaItem(ScrPharmaItem):
+    # Ítem re-emitido desde el caché de contenido (contentcache.py): la página de la que sale no
+    # cambió desde el crawl anterior. Mismos campos, así el CSV y el Parquet lo escriben igual
+    pass
+
+
+# Construcción rápida de ítems: mismo resultado que ItemLoader + los processors de arriba, pero
+# para un lote de registros crudos en una sola pasada (sin un ItemLoader ni MapCompose por ítem).
+# Un registro es un dict con las claves name, url, category, price, price_sale, price_benef, code y brand.
+
+PRICE_FIELDS = ('price', 'price_sale', 'price_benef')
+
+
+def build_items(records, spider_name, timestamp=None):
+    # Un solo timestamp por lote (p.ej. por página) y strings de baja cardinalidad internados
+    timestamp = format_datetime(timestamp if timestamp is not None else datetime.now())
+    spider_name = sys.intern(str.strip(spider_name)[:255])
+    items = []
+    for record in records:
+        item = ScrPharmaItem()
+        name = record.get('name')
+        if name is not None:
+            name = str.strip(name).replace(',', '.')[:255]
+            if name:
+                item['name'] = name
+        url = record.get('url')
+        if url is not None:
+            url = str(url)[:255]
+            if url:
+                item['url'] = url
+        category = record.get('category')
+        if category is not None:
+            category = str.strip(category)[:255]
+            if category:
+                item['category'] = sys.intern(category)
+        for field in PRICE_FIELDS:
+            price = record.get(field)
+            if price is not None:
+                item[field] = safe_price(price)
+        brand = record.get('brand')
+        if brand is not None:
+            brand = str.strip(brand)[:255]
+            if brand:
+                item['brand'] = sys.intern(brand)
+        item['timestamp'] = timestamp
+        if spider_name:
+            item['spider_name'] = spider_name
+        code = record.get('code')
+        if code is not None:
+            code = str.strip(code)[:255]
+            if code:
+                item['code'] = code
+        items.append(item)
+    return items
+
+
+def build_item(record, spider_name, timestamp=None):
+    return build_items([record], spider_name, timestamp)[0]
+
+
+DETAIL_FIELDS = ('brand', 'url', 'name', 'price', 'price_sale', 'price_benef', 'code')
+
+
+def details_record(details, category):
+    # Tupla (brand, url, name, price, price_sale, price_benef, sku) de los extract_*_details de los spiders
+    record = dict(zip(DETAIL_FIELDS, details))
+    record['category'] = category
+    return record
@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import logging
 import pandas as pd
@@ -6,14 +7,44 @@ from datetime import datetime
 import subprocess
 from tqdm import tqdm
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 # Variables de configuración
 SAVE_LOGS = True
 SAVE_ERRORS = True
 PROGRESS_INTERVAL = 10  # Intervalo en segundos para mostrar progreso
+POLL_INTERVAL = 1  # Intervalo en segundos para revisar si los procesos terminaron
 LOG_DIR = 'logs'  # Directorio para guardar logs
 ERROR_LOG_FILE_NAME = 'scrapy_errors.log'
 DATE_STR = datetime.now().strftime("%Y-%m-%d")
 
+# Modo de ejecución:
+# - 'subprocess': cada spider corre en su propio proceso (`python -m scrapy crawl <spider>`)
+# - 'inprocess': todos los spiders corren en un único CrawlerProcess, compartiendo intérprete,
+#   settings y el engine/pool de conexiones de la base de datos
+RUNNER_MODE = 'subprocess'
+
+# Ejecución en paralelo: cada spider apunta a un dominio distinto
+MAX_PARALLEL_SPIDERS = 3
+SPIDER_TIMEOUT = 3 * 60 * 60  # Segundos; un spider que lo supere se termina y se registra como error
+SPIDER_TIMEOUTS = {'ligafarmacia': 4 * 60 * 60}  # Excepciones por spider (ligafarmacia es el más lento)
+TERMINATE_GRACE_PERIOD = 30  # Segundos entre SIGTERM y SIGKILL al terminar un spider por timeout
+# Cada spider Selenium lanza su propio Chrome: se limita la cantidad simultánea según memoria
+CHROME_MEMORY_PER_SPIDER_MB = 700
+MAX_CHROME_MEMORY_MB = None  # None: usar el 70% de la memoria disponible al iniciar (requiere psutil)
+# Reanudación (checkpoints.py): un spider Selenium que falla o queda interrumpido (p.ej. se cae Chrome)
+# se relanza con -a resume=true y retoma desde la última página completada.
+# `python main.py --resume` retoma además los spiders que no terminaron en la ejecución anterior
+RESUME_ATTEMPTS = 1
+RESUME = '--resume' in sys.argv[1:]
+# Cola compartida (workqueue.py): varios procesos del mismo spider Selenium se reparten sus categorías,
+# cada una con un solo dueño. Solo en RUNNER_MODE = 'subprocess'; p.ej. {'ligafarmacia': 2}
+SPIDER_WORKERS = {}
+RUN_ID = datetime.now().strftime("%Y-%m-%dT%H%M%S")  # Identifica la cola de esta ejecución
+
 # Crear directorio de logs si no existe
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
@@ -32,55 +63,242 @@ if SAVE_ERRORS:
     logging.getLogger('scrapy').addHandler(logging.FileHandler(os.path.join(LOG_DIR, f"{DATE_STR}_{ERROR_LOG_FILE_NAME}")))
 
 base_dir = 'datafolder/'
-spiders = ['cruzverde', 'ahumada', 'salcobrand', 'profar', 'ligafarmacia', 'farmex'] 
+spiders = ['cruzverde', 'ahumada', 'salcobrand', 'profar', 'ligafarmacia', 'farmex']
 if not os.path.exists(base_dir):
     os.makedirs(base_dir)
 
-total_start_time = time.time()
-spiders_times = []
 
-for spider in tqdm(spiders, desc="Running spiders", mininterval=2):
-    command = f'scrapy crawl {spider}'
-    spider_log_file = os.path.join(LOG_DIR, f"{DATE_STR}_{spider}_log.log") if SAVE_LOGS else None
-    start_time = time.time()
-    error_time = None
+def available_memory_mb():
+    if psutil is None:
+        return None
+    return psutil.virtual_memory().available / (1024 * 1024)
+
+
+def max_parallel_spiders():
+    # Cantidad de spiders simultáneos limitada por MAX_PARALLEL_SPIDERS y por la memoria para Chrome
+    memory_budget = MAX_CHROME_MEMORY_MB
+    if memory_budget is None and psutil is not None:
+        memory_budget = available_memory_mb() * 0.7
+    if memory_budget is None:
+        return MAX_PARALLEL_SPIDERS
+    return max(1, min(MAX_PARALLEL_SPIDERS, int(memory_budget // CHROME_MEMORY_PER_SPIDER_MB)))
+
+
+def checkpoint_interrupted(spider, since, worker=None):
+    # El spider dejó un checkpoint sin terminar durante esta ejecución (los backends HTTP no dejan checkpoint)
+    from scrapy.utils.project import get_project_settings
+    settings = get_project_settings()
+    from scr_pharma.checkpoints import checkpoint_path, load_checkpoint
+    state = load_checkpoint(checkpoint_path(settings, spider, worker))
+    return (state is not None and state.get('status') != 'finished'
+            and state.get('updated', '') >= since.isoformat(timespec='seconds'))
+
+
+def spider_jobs(spiders):
+    # (spider, worker): worker es None salvo para los spiders con varios procesos en SPIDER_WORKERS
+    jobs = []
+    for spider in spiders:
+        workers = SPIDER_WORKERS.get(spider, 1)
+        jobs += [(spider, None)] if workers <= 1 else [(spider, worker) for worker in range(1, workers + 1)]
+    return jobs
+
+
+def job_label(spider, worker):
+    return spider if worker is None else f"{spider}#{worker}"
+
+
+def start_spider(spider, resume=False, worker=None, first_run=None):
+    command = [sys.executable, '-m', 'scrapy', 'crawl', spider]
+    if resume:
+        command += ['-a', 'resume=true']
+    if worker is not None:
+        command += ['-a', f'work_queue={RUN_ID}', '-a', f'worker={worker}']
+    log_name = spider if worker is None else f"{spider}_{worker}"
+    spider_log_file = os.path.join(LOG_DIR, f"{DATE_STR}_{log_name}_log.log") if SAVE_LOGS else None
+    # Al retomar se agrega al log del intento anterior en vez de sobrescribirlo
+    log_file = open(spider_log_file, 'a' if resume else 'w') if SAVE_LOGS else subprocess.DEVNULL
+    process = subprocess.Popen(command, stdout=log_file, stderr=log_file, text=True)
+    return new_run({
+        'spider': job_label(spider, worker),
+        'name': spider,
+        'worker': worker,
+        'command': command,
+        'process': process,
+        'log_file': log_file,
+    }, first_run)
+
+
+def new_run(run, first_run=None):
+    # start_time es el del intento actual (timeout, checkpoint); first_start_* el del primer intento,
+    # para que el resumen de un spider retomado incluya también el tiempo de los intentos que fallaron
+    run['start_time'] = time.time()
+    run['start_datetime'] = datetime.now()
+    first_run = first_run or run
+    run['first_start_time'] = first_run['start_time']
+    run['first_start_datetime'] = first_run['start_datetime']
+    return run
+
+
+def stop_spider(run):
+    process = run['process']
+    process.terminate()
     try:
-        with open(spider_log_file, 'w') if SAVE_LOGS else subprocess.DEVNULL as log_file:
-            process = subprocess.Popen(command, shell=True, stdout=log_file, stderr=log_file, text=True)
-            while process.poll() is None:
-                tqdm.write(f"Spider {spider} is still running...")
-                time.sleep(PROGRESS_INTERVAL)
-            if process.returncode != 0:
-                raise subprocess.CalledProcessError(process.returncode, command)
-    except subprocess.CalledProcessError as e:
-        error_time = datetime.now()
-        error_message = f"Error running spider {spider} at {error_time}: {e}"
+        process.wait(timeout=TERMINATE_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def finish_spider(run, error_message=None):
+    if run['log_file'] is not subprocess.DEVNULL:
+        run['log_file'].close()
+    end_datetime = datetime.now()
+    error_time = None
+    if error_message is not None:
+        error_time = end_datetime
         if SAVE_ERRORS:
-            logging.error(error_message)
-        elapsed_time = time.time() - start_time
-        spiders_times.append({
-            'spider': spider,
-            'elapsed_time': elapsed_time,
-            'error_time': error_time
-        })
-        continue
-    elapsed_time = time.time() - start_time
-    spiders_times.append({
-        'spider': spider,
-        'elapsed_time': elapsed_time,
-        'error_time': error_time
-    })
-
-total_elapsed_time = time.time() - total_start_time
-print(f'Total elapsed time for all spiders: {total_elapsed_time:.2f} seconds')
-
-# Mostrar tabla resumen de tiempos usando pandas
-df = pd.DataFrame(spiders_times)
-print("\nSummary of individual spider times:")
-print(df)
-
-# Guardar el resumen en un archivo CSV
-summary_csv_path = os.path.join(LOG_DIR, f"{DATE_STR}_spiders_times_summary.csv")
-df.to_csv(summary_csv_path, index=False)
-print(f'Summary saved to {summary_csv_path}')
+            logging.error(f"Error running spider {run['spider']} at {error_time}: {error_message}")
+    return {
+        'spider': run['spider'],
+        'elapsed_time': time.time() - run['first_start_time'],
+        'error_time': error_time,
+        'start_time': run['first_start_datetime'],
+        'end_time': end_datetime,
+    }
+
+
+def run_spiders_parallel(spiders):
+    jobs = spider_jobs(spiders)
+    pending = list(jobs)
+    running = []
+    results = {}
+    resumes = {job_label(*job): 0 for job in jobs}
+    # Primer intento de cada spider retomado: su inicio cuenta en el resumen
+    first_runs = {}
+    slots = max_parallel_spiders()
+    tqdm.write(f"Running up to {slots} spiders in parallel")
+    last_progress = time.time()
+
+    with tqdm(total=len(jobs), desc="Running spiders", mininterval=2) as progress_bar:
+        while pending or running:
+            # Lanzar spiders mientras haya cupo y memoria para otro Chrome
+            while pending and len(running) < slots:
+                memory_mb = available_memory_mb()
+                if running and memory_mb is not None and memory_mb < CHROME_MEMORY_PER_SPIDER_MB:
+                    break
+                spider, worker = pending.pop(0)
+                resume = RESUME or resumes[job_label(spider, worker)] > 0
+                running.append(start_spider(spider, resume=resume, worker=worker,
+                                            first_run=first_runs.get(job_label(spider, worker))))
+
+            for run in list(running):
+                process = run['process']
+                timeout = SPIDER_TIMEOUTS.get(run['name'], SPIDER_TIMEOUT)
+                if process.poll() is None:
+                    if time.time() - run['start_time'] < timeout:
+                        continue
+                    stop_spider(run)
+                    result = finish_spider(run, f"Timed out after {timeout} seconds")
+                elif process.returncode != 0:
+                    result = finish_spider(run, subprocess.CalledProcessError(process.returncode, run['command']))
+                else:
+                    result = finish_spider(run)
+                running.remove(run)
+                if resumes[run['spider']] < RESUME_ATTEMPTS and checkpoint_interrupted(run['name'], run['start_datetime'], run['worker']):
+                    resumes[run['spider']] += 1
+                    first_runs.setdefault(run['spider'], run)
+                    tqdm.write(f"Resuming {run['spider']} from its last checkpoint")
+                    pending.insert(0, (run['name'], run['worker']))
+                    continue
+                results[run['spider']] = {**result, 'resumes': resumes[run['spider']]}
+                progress_bar.update(1)
+
+            if running and time.time() - last_progress >= PROGRESS_INTERVAL:
+                tqdm.write(f"Spiders still running: {', '.join(run['spider'] for run in running)}")
+                last_progress = time.time()
+            time.sleep(POLL_INTERVAL)
+
+    return [results[job_label(*job)] for job in jobs]
+
+
+def run_spiders_in_process(spiders):
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from twisted.internet import defer
+    from twisted.python.failure import Failure
+
+    process = CrawlerProcess(get_project_settings())
+    results = {}
+    resumes = dict.fromkeys(spiders, 0)
+    # Los spiders Selenium bloquean el reactor mientras esperan a Chrome, así que el
+    # paralelismo real depende de cuánto tiempo pasen en requests de Scrapy
+    semaphore = defer.DeferredSemaphore(max_parallel_spiders())
+    progress_bar = tqdm(total=len(spiders), desc="Running spiders", mininterval=2)
+
+    def crawl(spider, resume=RESUME, first_run=None):
+        run = new_run({'spider': spider, 'log_file': subprocess.DEVNULL, 'spider_errors': []}, first_run)
+        try:
+            crawler = process.create_crawler(spider)
+        except Exception as e:
+            results[spider] = finish_spider(run, e)
+            progress_bar.update(1)
+            return None
+        crawler.signals.connect(lambda failure, response, spider: run['spider_errors'].append(failure.getErrorMessage()),
+                                signal=signals.spider_error, weak=False)
+        crawl_deferred = process.crawl(crawler, resume='true') if resume else process.crawl(crawler)
+        # El reactor se importa recién aquí: el primer crawl instala el TWISTED_REACTOR configurado
+        from twisted.internet import reactor
+        timeout = SPIDER_TIMEOUTS.get(spider, SPIDER_TIMEOUT)
+        timeout_call = reactor.callLater(timeout, crawler.stop)
+
+        def finished(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            finish_reason = crawler.stats.get_value('finish_reason') if crawler.stats else None
+            error_message = None
+            if isinstance(result, Failure):
+                error_message = result.getErrorMessage()
+            elif timeout_call.called:
+                error_message = f"Timed out after {timeout} seconds"
+            elif finish_reason != 'finished':
+                error_message = f"Finished with reason {finish_reason}"
+            if run['spider_errors'] and SAVE_ERRORS:
+                logging.error(f"Spider {spider} raised {len(run['spider_errors'])} errors, last: {run['spider_errors'][-1]}")
+            if resumes[spider] < RESUME_ATTEMPTS and checkpoint_interrupted(spider, run['start_datetime']):
+                resumes[spider] += 1
+                finish_spider(run, error_message)
+                tqdm.write(f"Resuming {spider} from its last checkpoint")
+                return crawl(spider, resume=True, first_run=run)
+            results[spider] = {**finish_spider(run, error_message), 'resumes': resumes[spider]}
+            progress_bar.update(1)
+
+        return crawl_deferred.addBoth(finished)
+
+    crawls = [semaphore.run(crawl, spider) for spider in spiders]
+    from twisted.internet import reactor
+    defer.DeferredList(crawls).addBoth(lambda _: reactor.callLater(0, reactor.stop))
+    process.start(stop_after_crawl=False)
+    progress_bar.close()
+    return [results[spider] for spider in spiders]
+
+
+if __name__ == '__main__':
+    total_start_time = time.time()
+    if RUNNER_MODE == 'inprocess':
+        spiders_times = run_spiders_in_process(spiders)
+    else:
+        spiders_times = run_spiders_parallel(spiders)
+
+    total_elapsed_time = time.time() - total_start_time
+    print(f'Total elapsed time for all spiders: {total_elapsed_time:.2f} seconds')
+
+    # Mostrar tabla resumen de tiempos usando pandas
+    df = pd.DataFrame(spiders_times)
+    print("\nSummary of individual spider times:")
+    print(df)
 
+    # Guardar el resumen en un archivo CSV
+    summary_csv_path = os.path.join(LOG_DIR, f"{DATE_STR}_spiders_times_summary.csv")
+    df.to_csv(summary_csv_path, index=False)
+    print(f'Summary saved to {summary_csv_path}')
@@ -0,0 +1,343 @@
+"""Matching de productos entre cadenas: agrupa en clusters las urls que son el mismo producto.
+
+Los nombres se normalizan (acentos, dosis y unidades, tamaño del envase, forma farmacéutica)
+y cada producto se resume en una firma MinHash. Con LSH (bandas de la firma) solo se comparan
+los productos que comparten algún bucket, sin comparar todos contra todos. Los pares candidatos
+de cadenas distintas se confirman con Jaccard ponderado por IDF sobre los tokens y dosis/envase compatibles, o
+con el mismo código EAN. Los clusters se guardan en un archivo SQLite y se actualizan de forma
+incremental: cada ejecución solo procesa las urls nuevas o con nombre distinto.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.matching build datafolder/*_2024_06_01.csv
+    python -m scr_pharma.matching build --from-db
+    python -m scr_pharma.matching export matches.csv"""
+import re
+import csv
+import math
+import time
+import zlib
+import sqlite3
+import argparse
+import unicodedata
+from array import array
+from itertools import groupby, repeat
+from collections import Counter
+import numpy as np
+from scrapy.utils.project import data_path
+
+from .history import open_csv
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+PRIME = np.uint64((1 << 61) - 1)
+# Coeficientes fijos: las firmas guardadas siguen siendo comparables entre ejecuciones
+_rng = np.random.default_rng(20240601)
+PERM_A = _rng.integers(1, 1 << 31, NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.integers(0, 1 << 31, NUM_PERM, dtype=np.uint64)
+BAND_COEFFS = _rng.integers(1, 1 << 63, ROWS, dtype=np.uint64) | np.uint64(1)
+
+UNITS = {'mg': ('mg', 1), 'mcg': ('mg', 0.001), 'ug': ('mg', 0.001), 'g': ('mg', 1000), 'gr': ('mg', 1000),
+         'grs': ('mg', 1000), 'kg': ('mg', 1000000), 'ml': ('ml', 1), 'cc': ('ml', 1), 'l': ('ml', 1000),
+         'lt': ('ml', 1000), 'lts': ('ml', 1000), 'ui': ('ui', 1), 'iu': ('ui', 1), '%': ('%', 1)}
+DOSE = re.compile(r'(\d+(?:\.\d+)?)\s*(mcg|ug|mg|grs|gr|g|kg|ml|cc|lts|lt|l|ui|iu|%)(?![a-z])')
+FORMS = {'comprimidos': 'comprimido', 'comprimido': 'comprimido', 'comp': 'comprimido', 'tabletas': 'comprimido',
+         'tableta': 'comprimido', 'tabs': 'comprimido', 'tab': 'comprimido', 'capsulas': 'capsula',
+         'capsula': 'capsula', 'caps': 'capsula', 'cap': 'capsula', 'sobres': 'sobre', 'sobre': 'sobre',
+         'ampollas': 'ampolla', 'ampolla': 'ampolla', 'grageas': 'gragea', 'gragea': 'gragea',
+         'parches': 'parche', 'parche': 'parche', 'unidades': '', 'unidad': '', 'und': '', 'un': '', 'uds': ''}
+PACK = re.compile(r'\b(?:x|caja(?: de)?|pack(?: de)?|envase(?: de)?)\s*(\d+)\b(?!\.\d)'
+                  rf'|\b(\d+)\s*({"|".join(sorted(FORMS, key=len, reverse=True))})\b')
+STOPWORDS = {'de', 'del', 'la', 'el', 'los', 'las', 'con', 'para', 'y', 'en', 'x', 'por', 'caja', 'pack', 'envase',
+             'una', 'sin', 'laboratorio', 'laboratorios', 'lab', 'sa'}
+TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def strip_accents(text):
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+
+
+def normalize(name, brand=None):
+    """Tokens del nombre y la marca, dosis normalizada (p.ej. '500mg' para '0.5 g') y tamaño del envase."""
+    text = strip_accents(str(name or '')).lower()
+    doses = []
+
+    def dose(match):
+        unit, factor = UNITS[match.group(2)]
+        doses.append(f'{float(match.group(1)) * factor:g}{unit}')
+        return ' '
+
+    packs = []
+
+    def pack(match):
+        packs.append(int(match.group(1) or match.group(2)))
+        # La forma farmacéutica se conserva como token ('30 comprimidos' -> 'comprimido')
+        return f' {FORMS[match.group(3)]} ' if match.group(3) else ' '
+
+    text = PACK.sub(pack, DOSE.sub(dose, text))
+    tokens = {FORMS.get(token, token) for token in TOKEN.findall(text)}
+    tokens |= set(TOKEN.findall(strip_accents(str(brand or '')).lower()))
+    tokens = {token for token in tokens if len(token) > 1 and token not in STOPWORDS}
+    return tokens, '+'.join(sorted(set(doses))) or None, max(packs) if packs else None
+
+
+def normalize_code(code):
+    # Solo códigos de barra (EAN/UPC): los SKU internos de cada cadena no sirven para cruzarlas
+    digits = re.sub(r'\D', '', str(code or ''))
+    return digits.lstrip('0') if len(digits) >= 8 else None
+
+
+def shingles(tokens, dose, pack):
+    features = set(tokens)
+    if dose:
+        features.add(f'#dose:{dose}')
+    if pack:
+        features.add(f'#pack:{pack}')
+    return features
+
+
+def minhash_batch(feature_sets):
+    """Firmas MinHash (n, NUM_PERM) de una lista de conjuntos de features, sin loops por permutación:
+    todos los features van en un solo arreglo y el mínimo por producto sale de np.minimum.reduceat."""
+    lengths = np.fromiter((len(features) for features in feature_sets), dtype=np.int64, count=len(feature_sets))
+    hashes = np.fromiter((zlib.crc32(feature.encode('utf-8')) for features in feature_sets for feature in features),
+                         dtype=np.uint64, count=int(lengths.sum()))
+    permuted = (np.outer(hashes, PERM_A) + PERM_B) % PRIME
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.minimum.reduceat(permuted, offsets, axis=0)
+
+
+def band_buckets(signatures):
+    # Un bucket por banda: combinación lineal de las ROWS filas de la banda (overflow uint64 intencional)
+    bands = signatures.reshape(len(signatures), BANDS, ROWS)
+    return (bands * BAND_COEFFS).sum(axis=2).view(np.int64)
+
+
+class MatchIndex:
+    def __init__(self, path, threshold=0.6, max_bucket=200, chunk_size=20000):
+        self.path = path
+        self.threshold = threshold
+        # Buckets más grandes que max_bucket (nombres muy genéricos) no generan candidatos
+        self.max_bucket = max_bucket
+        self.chunk_size = chunk_size
+        self.weights = {}
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, url TEXT UNIQUE, spider TEXT, name TEXT,"
+            " brand TEXT, code TEXT, tokens TEXT, dose TEXT, pack INTEGER, cluster INTEGER);"
+            "CREATE INDEX IF NOT EXISTS products_cluster ON products (cluster);"
+            "CREATE INDEX IF NOT EXISTS products_code ON products (code);"
+            "CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, product INTEGER);"
+            "CREATE INDEX IF NOT EXISTS buckets_key ON buckets (band, bucket);"
+            "CREATE INDEX IF NOT EXISTS buckets_product ON buckets (product);")
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, records):
+        """Agrega o actualiza productos (dicts con url, name, brand, code y spider_name) y une en
+        clusters los que coinciden con otros productos del índice. Devuelve estadísticas."""
+        stats = {'products': 0, 'new': 0, 'changed': 0, 'candidates': 0, 'skipped_buckets': 0, 'matches': 0, 'merged': 0}
+        known = {url: (product_id, tokens) for url, product_id, tokens in
+                 self.connection.execute("SELECT url, id, tokens FROM products")}
+        pending = {}
+        for record in records:
+            if not record.get('url') or not record.get('name'):
+                continue
+            tokens, dose, pack = normalize(record['name'], record.get('brand'))
+            if not tokens:
+                continue
+            stats['products'] += 1
+            joined = ' '.join(sorted(tokens))
+            if record['url'] in known and known[record['url']][1] == joined:
+                continue
+            pending[record['url']] = (record, tokens, joined, dose, pack)
+        # Peso IDF de cada token: los raros (marca, variante) pesan más que los comunes ('comprimido', 'crema')
+        frequency = Counter(token for _, tokens in known.values() for token in tokens.split())
+        frequency.update(token for _, tokens, _, _, _ in pending.values() for token in tokens)
+        total = len(known) + len(pending)
+        self.weights = {token: math.log(1 + total / count) for token, count in frequency.items()}
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS touched (product INTEGER PRIMARY KEY)")
+            self.connection.execute("DELETE FROM touched")
+            entries = list(pending.values())
+            for start in range(0, len(entries), self.chunk_size):
+                self.store_chunk(entries[start:start + self.chunk_size], known, stats)
+            pairs = self.candidate_pairs(stats)
+            self.merge(pairs, stats)
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return stats
+
+    def store_chunk(self, entries, known, stats):
+        ids = []
+        for record, tokens, joined, dose, pack in entries:
+            values = (record.get('spider_name'), record['name'], record.get('brand'), normalize_code(record.get('code')),
+                      joined, dose, pack)
+            if record['url'] in known:
+                # Nombre distinto: se recalculan sus buckets; el cluster se conserva
+                product_id = known[record['url']][0]
+                self.connection.execute(
+                    "UPDATE products SET spider = ?, name = ?, brand = ?, code = ?, tokens = ?, dose = ?, pack = ? WHERE id = ?",
+                    (*values, product_id))
+                self.connection.execute("DELETE FROM buckets WHERE product = ?", (product_id,))
+                stats['changed'] += 1
+            else:
+                product_id = self.connection.execute(
+                    "INSERT INTO products (url, spider, name, brand, code, tokens, dose, pack) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (record['url'], *values)).lastrowid
+                self.connection.execute("UPDATE products SET cluster = id WHERE id = ?", (product_id,))
+                stats['new'] += 1
+            ids.append(product_id)
+        signatures = minhash_batch([shingles(tokens, dose, pack) for _, tokens, _, dose, pack in entries])
+        buckets = band_buckets(signatures)
+        self.connection.executemany(
+            "INSERT INTO buckets (band, bucket, product) VALUES (?, ?, ?)",
+            ((band, int(bucket), product_id) for product_id, row in zip(ids, buckets.tolist()) for band, bucket in enumerate(row)))
+        self.connection.executemany("INSERT OR IGNORE INTO touched (product) VALUES (?)", ((product_id,) for product_id in ids))
+
+    def candidate_pairs(self, stats):
+        """Pares que comparten un bucket con algún producto nuevo o modificado, como arreglo de enteros
+        (a << 32 | b, sin repetidos), y pares con el mismo código EAN."""
+        codes = array('q')
+        rows = self.connection.execute(
+            "SELECT b.band, b.bucket, b.product, p.spider FROM "
+            "(SELECT DISTINCT band, bucket FROM buckets WHERE product IN (SELECT product FROM touched)) k "
+            "JOIN buckets b ON b.band = k.band AND b.bucket = k.bucket JOIN products p ON p.id = b.product "
+            "ORDER BY b.band, b.bucket")
+        touched = {product for product, in self.connection.execute("SELECT product FROM touched")}
+        for _, group in groupby(rows, key=lambda row: (row[0], row[1])):
+            members = [(row[2], row[3]) for row in group]
+            if len(members) > self.max_bucket:
+                stats['skipped_buckets'] += 1
+                continue
+            for i, (a, spider_a) in enumerate(members):
+                for b, spider_b in members[i + 1:]:
+                    # Solo se cruzan cadenas distintas
+                    if spider_a != spider_b and (a in touched or b in touched):
+                        codes.append(min(a, b) << 32 | max(a, b))
+        pairs = np.unique(np.frombuffer(codes, dtype=np.int64)) if codes else np.empty(0, dtype=np.int64)
+        same_code = set(self.connection.execute(
+            "SELECT p.id, q.id FROM products p JOIN products q ON q.code = p.code AND q.id > p.id "
+            "WHERE p.code IS NOT NULL AND p.spider != q.spider "
+            "AND (p.id IN (SELECT product FROM touched) OR q.id IN (SELECT product FROM touched))"))
+        stats['candidates'] = len(pairs) + len(same_code)
+        return pairs, same_code
+
+    def products(self, ids):
+        products = {}
+        ids = list(ids)
+        for start in range(0, len(ids), 900):
+            chunk = ids[start:start + 900]
+            for product_id, spider, tokens, dose, pack, cluster in self.connection.execute(
+                    f"SELECT id, spider, tokens, dose, pack, cluster FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                tokens = set(tokens.split())
+                products[product_id] = (spider, tokens, dose, pack, cluster, sum(map(self.weights.get, tokens, repeat(1.0))))
+        return products
+
+    def is_match(self, a, b, same_code):
+        if a[0] == b[0]:
+            return False
+        if same_code:
+            return True
+        if a[2] and b[2] and a[2] != b[2]:
+            return False
+        if a[3] and b[3] and a[3] != b[3]:
+            return False
+        # Jaccard ponderado: peso de los tokens comunes sobre el peso de la unión
+        common = sum(map(self.weights.get, a[1] & b[1], repeat(1.0)))
+        return common >= self.threshold * (a[5] + b[5] - common)
+
+    def merge(self, candidates, stats):
+        pairs, same_code = candidates
+        ids = np.union1d(pairs >> 32, pairs & 0xFFFFFFFF).tolist()
+        products = self.products(set(ids) | {product for pair in same_code for product in pair})
+        parent = {}
+
+        def find(cluster):
+            while parent.get(cluster, cluster) != cluster:
+                parent[cluster] = parent.get(parent[cluster], parent[cluster])
+                cluster = parent[cluster]
+            return cluster
+
+        def union(a, b, same_code):
+            root_a, root_b = find(products[a][4]), find(products[b][4])
+            if root_a == root_b or not self.is_match(products[a], products[b], same_code):
+                return
+            stats['matches'] += 1
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        for a, b in same_code:
+            union(a, b, True)
+        for start in range(0, len(pairs), 1000000):
+            for pair in pairs[start:start + 1000000].tolist():
+                union(pair >> 32, pair & 0xFFFFFFFF, False)
+        relabel = [(find(cluster), cluster) for cluster in parent if find(cluster) != cluster]
+        self.connection.executemany("UPDATE products SET cluster = ? WHERE cluster = ?", relabel)
+        stats['merged'] = len(relabel)
+
+    def clusters(self, min_spiders=2):
+        # Filas (cluster, spider, url, name, brand) de los clusters con productos de al menos min_spiders cadenas
+        return self.connection.execute(
+            "SELECT cluster, spider, url, name, brand FROM products WHERE cluster IN "
+            "(SELECT cluster FROM products GROUP BY cluster HAVING COUNT(DISTINCT spider) >= ?) ORDER BY cluster, spider",
+            (min_spiders,))
+
+    def cluster_map(self):
+        return dict(self.connection.execute("SELECT url, cluster FROM products"))
+
+
+def read_csv_records(paths):
+    for path in paths:
+        with open_csv(path) as file:
+            yield from csv.DictReader(file)
+
+
+def read_db_records(uri):
+    from sqlalchemy import create_engine, text
+    with create_engine(uri).connect() as connection:
+        for row in connection.execute(text("SELECT url, name, brand, code, spider_name FROM scr_pharma")).mappings():
+            yield dict(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--index', help="archivo SQLite del índice (por defecto .scrapy/matching.sqlite)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="agregar productos al índice y actualizar los clusters")
+    build.add_argument('paths', nargs='*', help="CSV diarios del pipeline")
+    build.add_argument('--from-db', action='store_true', help="leer los productos de la tabla scr_pharma")
+    build.add_argument('--uri', help="URI SQLAlchemy (por defecto la de credentials.py)")
+    build.add_argument('--threshold', type=float, default=0.6, help="Jaccard ponderado mínimo entre tokens")
+    export = commands.add_parser('export', help="exportar los clusters con productos de varias cadenas")
+    export.add_argument('output')
+    export.add_argument('--min-spiders', type=int, default=2)
+    args = parser.parse_args()
+
+    index = MatchIndex(args.index or data_path('matching.sqlite', createdir=True), threshold=getattr(args, 'threshold', 0.6))
+    if args.command == 'build':
+        if args.from_db:
+            if args.uri is None:
+                from .credentials import SQLALCHEMY_DATABASE_URI
+                args.uri = SQLALCHEMY_DATABASE_URI
+            records = read_db_records(args.uri)
+        else:
+            records = read_csv_records(args.paths)
+        start = time.time()
+        stats = index.update(records)
+        print(', '.join(f'{key}: {value}' for key, value in stats.items()) + f' ({time.time() - start:.1f}s)')
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(['cluster', 'spider_name', 'url', 'name', 'brand'])
+            writer.writerows(index.clusters(args.min_spiders))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ from scrapy import signals
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from .contentcache import ContentCache, content_hash
+
 
 class ScrPharmaSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -33,8 +35,25 @@ class ScrPharmaSpiderMiddleware:
         # it has processed the response.
 
         # Must return an iterable of Request, or item objects.
+        cache = getattr(spider, 'content_cache', None)
+        state = response.meta.get('content_cache_state')
+        entry = cache.get(state['key']) if cache is not None and state is not None and state['unchanged'] else None
+        if entry is not None:
+            # La página no cambió: el callback no se ejecuta y se re-emite lo que produjo la última vez
+            result = cache.replay(entry, spider)
+
+        outputs = []
         for i in result:
+            outputs.append(i)
             yield i
+        if cache is not None and state is not None and entry is None:
+            # Solo se guarda si el callback terminó sin errores
+            cache.store(state['key'], spider, state['content_hash'], outputs,
+                        etag=state['etag'], last_modified=state['last_modified'])
+        # Aviso al spider de que la salida de la respuesta (parseada o re-emitida) terminó sin errores,
+        # p.ej. para dar por terminada una categoría que se recorre con requests en paralelo
+        if hasattr(spider, 'response_finished'):
+            spider.response_finished(response, outputs)
 
     def process_spider_exception(self, response, exception, spider):
         # Called when a spider or process_spider_input() method
@@ -61,11 +80,19 @@ class ScrPharmaDownloaderMiddleware:
     # scrapy acts as if the downloader middleware does not modify the
     # passed objects.
 
+    def __init__(self, crawler=None):
+        # Caché de contenido (contentcache.py) para las requests con meta['content_cache']
+        self.cache = None
+        if crawler is not None and crawler.settings.getbool('CONTENT_CACHE_ENABLED', False):
+            self.cache = ContentCache.from_crawler(crawler)
+            self.fingerprinter = crawler.request_fingerprinter
+
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
     def process_request(self, request, spider):
@@ -78,6 +105,17 @@ class ScrPharmaDownloaderMiddleware:
         # - or return a Request object
         # - or raise IgnoreRequest: process_exception() methods of
         #   installed downloader middleware will be called
+        if self.cache is None or not request.meta.get('content_cache'):
+            return None
+        key = self.fingerprinter.fingerprint(request).hex()
+        request.meta['content_cache_state'] = {'key': key}
+        entry = self.cache.get(key)
+        if entry is not None and request.method == 'GET':
+            # Pedir la página condicionalmente: si no cambió, el servidor responde 304 sin cuerpo
+            if entry['etag']:
+                request.headers.setdefault('If-None-Match', entry['etag'])
+            if entry['last_modified']:
+                request.headers.setdefault('If-Modified-Since', entry['last_modified'])
         return None
 
     def process_response(self, request, response, spider):
@@ -87,6 +125,27 @@ class ScrPharmaDownloaderMiddleware:
         # - return a Response object
         # - return a Request object
         # - or raise IgnoreRequest
+        state = request.meta.get('content_cache_state')
+        if self.cache is None or state is None:
+            return response
+        entry = self.cache.get(state['key'])
+        if response.status == 304 and entry is not None:
+            state.update(unchanged=True, content_hash=entry['content_hash'],
+                         etag=entry['etag'], last_modified=entry['last_modified'])
+            self.cache.inc_stat('not_modified')
+            # 304 no es 2xx: se entrega como 200 para que HttpErrorMiddleware no lo descarte
+            return response.replace(status=200)
+        if not 200 <= response.status < 300 or not response.body:
+            # Errores, bloqueos, redirecciones y respuestas sin cuerpo (204) no se cachean; sí cualquier
+            # otro 2xx, p.ej. los 206 de los rangos de la API de catálogo de VTEX
+            del request.meta['content_cache_state']
+            return response
+        body_hash = content_hash(response.body)
+        unchanged = entry is not None and entry['content_hash'] == body_hash
+        state.update(unchanged=unchanged, content_hash=body_hash,
+                     etag=header_text(response.headers.get('ETag')),
+                     last_modified=header_text(response.headers.get('Last-Modified')))
+        self.cache.inc_stat('unchanged' if unchanged else 'changed')
         return response
 
     def process_exception(self, request, exception, spider):
@@ -101,3 +160,13 @@ class ScrPharmaDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+        # Los spiders Selenium lo usan a través de contentcache.page_items
+        spider.content_cache = self.cache
+
+    def spider_closed(self, spider):
+        if self.cache is not None:
+            self.cache.close()
+
+
+def header_text(value):
+    return value.decode('latin-1') if value else None
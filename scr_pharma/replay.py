@@ -0,0 +1,391 @@
+"""Grabación y reproducción de crawls para benchmarks end-to-end sin red.
+
+- record: ReplayMiddleware guarda cada respuesta que recibe Scrapy (HTML, APIs JSON, robots.txt,
+  redirecciones) tal como llega, y los drivers de Selenium guardan el DOM de cada página que
+  cargan con driver.get y de cada foto que toma extraction.page_response.
+- replay: un servidor HTTP local sirve el archivo con latencia configurable. Scrapy y Chrome
+  piden todo a ese servidor (http://127.0.0.1:<puerto>/<tipo>/<url original>) y los spiders
+  siguen viendo las URLs originales, así que el crawl corre completo sin tocar los sitios.
+
+En las páginas Selenium se sirve el DOM grabado sin <script> y con <base href> a la URL original.
+La paginación por URL (Ahumada, CruzVerde, Farmex) se reproduce completa. La que depende de clicks
+con JavaScript (Liga Farmacia, Salcobrand y el "cargar más" de Profar) se reproduce solo hasta la
+primera página de cada categoría; Salcobrand y Profar conviene medirlos con su backend de API.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.replay record profar
+    python -m scr_pharma.replay run profar --latency 0.05 --output profar_replay.json
+    python -m scr_pharma.replay run profar --latency 0.05 -s CONCURRENT_REQUESTS=32
+    python -m scr_pharma.replay serve --port 8900 --latency 0.05"""
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from urllib.parse import quote, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import data_path
+
+from .extraction import set_snapshot_hook
+
+MODES = ('record', 'replay')
+# Estado del proceso: extraction.page_response y los drivers no tienen acceso a los settings del crawler
+_mode = None
+_archive = None
+_server_url = None
+
+SCRIPT_TAGS = re.compile(r'<script\b[^>]*>.*?</script\s*>', re.IGNORECASE | re.DOTALL)
+HEAD_TAG = re.compile(r'<head\b[^>]*>', re.IGNORECASE)
+HOP_BY_HOP = {'transfer-encoding', 'content-length', 'connection', 'keep-alive'}
+
+
+def body_hash(body):
+    return hashlib.blake2b(body or b'', digest_size=8).hexdigest()
+
+
+class ReplayArchive:
+    """Archivo SQLite de respuestas. kind es 'scrapy' (respuesta HTTP cruda), 'load' (DOM después de
+    driver.get) o 'page' (DOM de extraction.page_response). Una misma URL puede tener varias
+    entradas del mismo tipo; el servidor las entrega en el orden en que se grabaron."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # El servidor lee desde sus hilos; un lock serializa el acceso a la conexión
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (id INTEGER PRIMARY KEY, kind TEXT, method TEXT, url TEXT,"
+            "body_hash TEXT, status INTEGER, headers TEXT, body BLOB, spider TEXT, recorded_at REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_key ON responses (kind, method, url, body_hash)")
+
+    def close(self):
+        self.connection.close()
+
+    def store(self, kind, url, status, headers, body, method='GET', request_body=b'', spider=None):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO responses (kind, method, url, body_hash, status, headers, body, spider, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, method, url, body_hash(request_body), status, json.dumps(headers), body, spider, time.time()))
+
+    def lookup(self, kind, url, method='GET', request_body=b'', occurrence=0):
+        # La n-ésima grabación de la URL; pasada la última se repite la última
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT status, headers, body FROM responses WHERE kind = ? AND method = ? AND url = ? AND body_hash = ? ORDER BY id",
+                (kind, method, url, body_hash(request_body))).fetchall()
+        if not rows:
+            return None
+        status, headers, body = rows[min(occurrence, len(rows) - 1)]
+        return status, json.loads(headers), body
+
+    def summary(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT kind, COUNT(*) FROM responses GROUP BY kind"))
+
+
+def configure(settings):
+    """Activa el modo de REPLAY_MODE para este proceso; devuelve el modo o None."""
+    global _mode, _archive, _server_url
+    mode = settings.get('REPLAY_MODE')
+    if mode not in MODES:
+        return None
+    if mode == 'replay' and not settings.get('REPLAY_SERVER'):
+        raise NotConfigured("REPLAY_MODE = 'replay' requires REPLAY_SERVER (see python -m scr_pharma.replay run)")
+    if _mode != mode:
+        _mode = mode
+        _server_url = (settings.get('REPLAY_SERVER') or '').rstrip('/')
+        if mode == 'record':
+            _archive = ReplayArchive(settings.get('REPLAY_ARCHIVE') or data_path('replay.sqlite', createdir=True))
+        set_snapshot_hook(snapshot_url)
+    return _mode
+
+
+def mirror_url(kind, url):
+    return f"{_server_url}/{kind}/{quote(url, safe='')}"
+
+
+def original_url(url):
+    # http://127.0.0.1:<puerto>/<tipo>/<url codificada> -> url original; cualquier otra URL queda igual
+    if _server_url and url.startswith(f"{_server_url}/"):
+        return unquote(url[len(_server_url) + 1:].split('/', 1)[1])
+    return url
+
+
+def prepare_driver(driver):
+    # Llamado por drivers.acquire_driver: driver.get graba el DOM (record) o navega al servidor (replay).
+    # El modo lo activa ReplayMiddleware al arrancar el crawler, antes de que los spiders pidan un driver
+    if _mode is None or getattr(driver, 'replay_mode', None) == _mode:
+        return driver
+    live_get = driver.get
+
+    def get(url):
+        if _mode == 'replay':
+            return live_get(mirror_url('page', url))
+        live_get(url)
+        _archive.store('load', url, 200, {'Content-Type': ['text/html; charset=utf-8']}, driver.page_source.encode('utf-8'))
+
+    driver.get = get
+    driver.replay_mode = _mode
+    return driver
+
+
+def snapshot_url(url, html):
+    """Hook de extraction.page_snapshot: graba la foto del DOM (record) o devuelve la URL
+    original en vez de la del servidor (replay)."""
+    if _mode == 'record':
+        _archive.store('page', url, 200, {'Content-Type': ['text/html; charset=utf-8']}, html.encode('utf-8'))
+    elif _mode == 'replay':
+        return original_url(url)
+    return url
+
+
+class ReplayMiddleware:
+    """Middleware de descarga para REPLAY_MODE. Va cerca del downloader (950) para grabar la
+    respuesta cruda, antes de la descompresión y de las redirecciones, y para que en replay los
+    demás middlewares vean siempre la URL original."""
+
+    def __init__(self, crawler):
+        self.mode = configure(crawler.settings)
+        if self.mode is None:
+            raise NotConfigured("REPLAY_MODE is not set")
+        self.stats = crawler.stats
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        if self.mode != 'replay' or 'replay_url' in request.meta:
+            return None
+        # La request vuelve al scheduler apuntando al servidor local
+        return request.replace(url=mirror_url('scrapy', request.url), dont_filter=True,
+                               meta={**request.meta, 'replay_url': request.url})
+
+    def process_response(self, request, response, spider):
+        if self.mode == 'record':
+            headers = {key.decode('latin-1'): [value.decode('latin-1') for value in values]
+                       for key, values in response.headers.items()}
+            _archive.store('scrapy', request.url, response.status, headers, response.body,
+                           method=request.method, request_body=request.body, spider=spider.name)
+            self.stats.inc_value('replay/recorded')
+            return response
+        if 'replay_url' not in request.meta:
+            return response
+        self.stats.inc_value('replay/served' if response.status != 404 or 'X-Replay-Miss' not in response.headers else 'replay/missing')
+        return response.replace(url=request.meta['replay_url'])
+
+    def spider_closed(self, spider):
+        if self.mode == 'record':
+            spider.logger.info(f"Replay archive {_archive.path}: {_archive.summary()}")
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Sirve un ReplayArchive en 127.0.0.1 con `latency` segundos por respuesta, más un jitter
+    determinístico de hasta `jitter` segundos (el mismo para la misma URL y repetición)."""
+    daemon_threads = True
+
+    def __init__(self, archive, port=0, latency=0.0, jitter=0.0):
+        super().__init__(('127.0.0.1', port), ReplayHandler)
+        self.archive = archive
+        self.latency = latency
+        self.jitter = jitter
+        self.occurrences = {}
+        self.counts = {'served': 0, 'missing': 0}
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_occurrence(self, key):
+        with self.counts_lock:
+            occurrence = self.occurrences.get(key, 0)
+            self.occurrences[key] = occurrence + 1
+            return occurrence
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def delay(self, url, occurrence):
+        if self.jitter:
+            return self.latency + random.Random(f"{url}#{occurrence}").uniform(0, self.jitter)
+        return self.latency
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.replay()
+
+    def do_POST(self):
+        self.replay()
+
+    def do_HEAD(self):
+        self.replay()
+
+    def replay(self):
+        server = self.server
+        request_body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        kind, _, encoded = self.path.lstrip('/').partition('/')
+        url = unquote(encoded)
+        occurrence = server.next_occurrence((kind, self.command, url, body_hash(request_body)))
+        if kind == 'page':
+            # Navegación de Chrome: la siguiente foto de page_response o, si no hay, el DOM de la carga
+            found = server.archive.lookup('page', url, occurrence=occurrence) or server.archive.lookup('load', url, occurrence=occurrence)
+            if found is not None:
+                status, headers, body = found
+                found = status, headers, static_page(body.decode('utf-8'), url).encode('utf-8')
+        else:
+            found = server.archive.lookup(kind, url, method=self.command, request_body=request_body, occurrence=occurrence)
+        time.sleep(server.delay(url, occurrence))
+        if found is None:
+            server.count('missing')
+            self.send_response(404)
+            self.send_header('X-Replay-Miss', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        server.count('served')
+        status, headers, body = found
+        self.send_response(status)
+        for key, values in headers.items():
+            if key.lower() not in HOP_BY_HOP:
+                for value in values:
+                    self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def static_page(html, url):
+    # Sin JavaScript (no debe salir a la red) y con los links relativos resueltos contra la URL original
+    html = SCRIPT_TAGS.sub('', html)
+    base = f'<base href="{url}">'
+    return HEAD_TAG.sub(lambda match: match.group(0) + base, html, count=1) if HEAD_TAG.search(html) else base + html
+
+
+def crawl_stats(spider, settings, output):
+    """Corre el spider en este proceso y devuelve las stats del crawler."""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    project_settings = get_project_settings()
+    project_settings.setdict(settings, priority='cmdline')
+    process = CrawlerProcess(project_settings)
+    crawler = process.create_crawler(spider)
+    process.crawl(crawler)
+    process.start()
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(crawler.stats.get_stats(), file, default=str)
+
+
+def parse_overrides(values):
+    overrides = {}
+    for value in values or []:
+        key, _, setting = value.partition('=')
+        overrides[key] = setting
+    return overrides
+
+
+def run_crawl(spider, settings):
+    # Cada crawl en un proceso aparte: el reactor de Twisted no se puede reiniciar
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as file:
+        output = file.name
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'scr_pharma.replay', '_crawl', spider, output, json.dumps(settings)], check=True)
+    wall = time.perf_counter() - start
+    with open(output, encoding='utf-8') as file:
+        stats = json.load(file)
+    return wall, stats
+
+
+def benchmark_row(spider, wall, stats, server, args, overrides):
+    # Parte del tiempo que el spider pasa en esperas de Selenium (waits.py) y en la descarga
+    # (crawl_seconds es el crawl sin el arranque del proceso, que sí entra en wall_seconds)
+    items = stats.get('item_scraped_count', 0)
+    crawl = stats.get('elapsed_time_seconds') or wall
+    wait_seconds = sum(value for key, value in stats.items() if key.startswith('waits/') and key.endswith('/seconds'))
+    return {'spider': spider, 'created': datetime.now().isoformat(timespec='seconds'), 'latency': args.latency,
+            'jitter': args.jitter, 'settings': overrides, 'wall_seconds': round(wall, 3), 'crawl_seconds': round(crawl, 3),
+            'items': items, 'items_per_sec': round(items / crawl, 1) if crawl else None,
+            'wait_seconds': round(wait_seconds, 3), 'wait_share': round(wait_seconds / crawl, 4) if crawl else None,
+            'requests': stats.get('downloader/request_count', 0), 'served': server.counts['served'],
+            'missing': server.counts['missing'], 'finish_reason': stats.get('finish_reason')}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '_crawl':
+        crawl_stats(sys.argv[2], json.loads(sys.argv[4]), sys.argv[3])
+        return
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archive', help="archivo SQLite (por defecto .scrapy/replay.sqlite)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help="correr un spider contra los sitios reales grabando las respuestas")
+    record.add_argument('spider')
+    record.add_argument('-s', '--set', action='append', help="setting de Scrapy (CLAVE=VALOR)")
+    serve = commands.add_parser('serve', help="servir el archivo hasta Ctrl+C")
+    serve.add_argument('--port', type=int, default=8900)
+    run = commands.add_parser('run', help="correr un spider contra el archivo y medirlo")
+    run.add_argument('spider')
+    run.add_argument('-s', '--set', action='append', help="setting de Scrapy (CLAVE=VALOR), p.ej. para comparar estrategias")
+    run.add_argument('--output', help="agregar el resultado a este JSON (una lista de corridas)")
+    for command in (serve, run):
+        command.add_argument('--latency', type=float, default=0.0, help="segundos por respuesta")
+        command.add_argument('--jitter', type=float, default=0.0, help="segundos extra, determinísticos por URL")
+    args = parser.parse_args()
+
+    archive_path = args.archive or data_path('replay.sqlite', createdir=True)
+    overrides = parse_overrides(getattr(args, 'set', None))
+    if args.command == 'record':
+        wall, stats = run_crawl(args.spider, {**overrides, 'REPLAY_MODE': 'record', 'REPLAY_ARCHIVE': archive_path})
+        print(f"Recorded {stats.get('replay/recorded', 0)} responses in {wall:.1f}s into {archive_path}")
+        return
+
+    server = ReplayServer(ReplayArchive(archive_path), port=getattr(args, 'port', 0), latency=args.latency, jitter=args.jitter)
+    if args.command == 'serve':
+        print(f"Serving {archive_path} at {server.url} ({server.archive.summary()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Offline: sin base de datos ni caché de contenido, que cambiarían lo que se mide entre corridas
+    settings = {'ENABLE_DATABASE_INSERTION': False, 'CONTENT_CACHE_ENABLED': False, 'PARQUET_EXPORT_ENABLED': False,
+                **overrides, 'REPLAY_MODE': 'replay', 'REPLAY_SERVER': server.url}
+    wall, stats = run_crawl(args.spider, settings)
+    server.shutdown()
+    row = benchmark_row(args.spider, wall, stats, server, args, overrides)
+    print(json.dumps(row, indent=1))
+    if args.output:
+        try:
+            with open(args.output, encoding='utf-8') as file:
+                runs = json.load(file)
+        except (OSError, ValueError):
+            runs = []
+        runs.append(row)
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(runs, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Reporte de precios entre cadenas para un día (o los últimos N días) de datos del pipeline.
+
+Lee los CSV diarios de cada spider (o la tabla scr_pharma) con columnas y tipos fijos y calcula,
+con operaciones vectorizadas de pandas/NumPy:
+
+- por producto: precio mínimo, mediana y máximo entre cadenas, cadena más barata y descuentos;
+- por categoría: mínimo, mediana y máximo, y la cadena con la mediana más baja;
+- por cadena: productos, profundidad de descuento (price_sale y price_benef contra price) y
+  cuántas veces es la más barata.
+
+Un producto es un cluster de matching.py si existe el índice; si no, cada url es un producto.
+Con --days se conserva solo la última observación de cada url, además del mínimo y máximo del
+período, así que la memoria depende de la cantidad de productos y no de la cantidad de días.
+
+Uso (desde la raíz del repositorio):
+
+    python -m scr_pharma.report --date 2024-06-01
+    python -m scr_pharma.report --date 2024-06-30 --days 30
+    python -m scr_pharma.report --from-db"""
+import os
+import glob
+import sqlite3
+import argparse
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+from scrapy.utils.project import data_path
+
+from .exporters import pq
+from .history import csv_date, csv_spider
+
+COLUMNS = ['url', 'name', 'category', 'price', 'price_sale', 'price_benef', 'timestamp', 'spider_name']
+DTYPES = {'url': 'object', 'name': 'object', 'category': 'category', 'spider_name': 'category',
+          'price': 'float32', 'price_sale': 'float32', 'price_benef': 'float32'}
+PRICE_FIELDS = ['price', 'price_sale', 'price_benef']
+
+
+def day_paths(data_dir, day, days=1):
+    paths = []
+    for offset in range(days):
+        stamp = (day - timedelta(days=offset)).strftime('%Y_%m_%d')
+        # Solo los CSV diarios: la cuarentena del pipeline también termina en _<fecha>.csv
+        paths.extend(path for path in glob.glob(os.path.join(data_dir, f'*_{stamp}.csv*')) if csv_spider(path))
+    return sorted(paths, key=csv_date)
+
+
+def read_prices(path):
+    # Solo las columnas del reporte, con tipos chicos (float32, category) y la compresión según la extensión;
+    # con pyarrow instalado se usa su parser, multi-hilo
+    engine = 'pyarrow' if pq is not None and not path.endswith('.zst') else 'c'
+    frame = pd.read_csv(path, usecols=COLUMNS, dtype=DTYPES, engine=engine)
+    frame['timestamp'] = pd.to_datetime(frame['timestamp'], format="%Y-%m-%d %H:%M:%S")
+    return frame
+
+
+def effective_price(frame):
+    # Menor precio disponible entre price, price_sale y price_benef; 0 es "sin precio"
+    prices = frame[PRICE_FIELDS].to_numpy(dtype='float64', na_value=0)
+    prices = np.where(prices > 0, prices, np.inf)
+    best = prices.min(axis=1)
+    return np.where(np.isfinite(best), best, np.nan)
+
+
+def discount_depth(frame, field):
+    # Descuento relativo de `field` contra el precio normal; 0 si no hay descuento
+    price = frame['price'].to_numpy(dtype='float64', na_value=0)
+    other = frame[field].to_numpy(dtype='float64', na_value=0)
+    on_sale = (price > 0) & (other > 0) & (other < price)
+    return np.where(on_sale, 1 - other / np.where(price > 0, price, 1), 0).astype('float32')
+
+
+def load_csv_snapshot(paths):
+    """Última observación de cada url en `paths` más el mínimo y máximo del precio efectivo del período.
+
+    Los archivos se procesan spider por spider (sus urls no se cruzan con las de otros spiders), así
+    que cada paso combina solo los productos de un spider."""
+    by_spider = {}
+    for path in sorted(paths, key=csv_date):
+        spider = csv_spider(path)
+        if spider is not None:
+            by_spider.setdefault(spider, []).append(path)
+    snapshots = [spider_snapshot(spider_paths) for spider_paths in by_spider.values()]
+    if not snapshots:
+        return pd.DataFrame(columns=COLUMNS + ['effective', 'period_min', 'period_max'])
+    frame = pd.concat(snapshots, ignore_index=True)
+    for column in ('spider_name', 'category'):
+        frame[column] = frame[column].astype('category')
+    return frame
+
+
+def spider_snapshot(paths):
+    latest = None
+    for path in paths:
+        frame = read_prices(path)
+        frame['effective'] = effective_price(frame).astype('float32')
+        frame['period_min'] = frame['period_max'] = frame['effective']
+        for column in ('spider_name', 'category'):
+            frame[column] = frame[column].astype(str)
+        if latest is not None:
+            # Días en orden: la última observación de cada url gana, y el rango del período se acumula
+            frame = pd.concat([latest, frame], ignore_index=True)
+            grouped = frame.groupby('url', sort=False)
+            period_min, period_max = grouped['period_min'].transform('min'), grouped['period_max'].transform('max')
+            frame['period_min'], frame['period_max'] = period_min, period_max
+            frame = frame.drop_duplicates('url', keep='last')
+        latest = frame
+    return latest
+
+
+def load_db_snapshot(uri, since):
+    from sqlalchemy import create_engine, text
+    query = text(f"SELECT {', '.join(COLUMNS)} FROM scr_pharma WHERE COALESCE(last_seen, timestamp) >= :since")
+    with create_engine(uri).connect() as connection:
+        frame = pd.read_sql(query, connection, params={'since': since}, dtype={k: v for k, v in DTYPES.items() if k not in ('category', 'spider_name')})
+    frame['effective'] = effective_price(frame).astype('float32')
+    frame['period_min'] = frame['period_max'] = frame['effective']
+    return frame
+
+
+def assign_products(frame, matches_path=None):
+    # Cluster de matching.py por url; las urls sin cluster son un producto cada una
+    product = pd.Series(np.nan, index=frame.index)
+    if matches_path and os.path.isfile(matches_path):
+        connection = sqlite3.connect(matches_path)
+        clusters = pd.read_sql_query("SELECT url, cluster FROM products", connection).set_index('url')['cluster']
+        connection.close()
+        product = frame['url'].map(clusters)
+    # copy=True: con copy-on-write (pandas 3) to_numpy puede devolver un arreglo de solo lectura
+    values = product.to_numpy(dtype='float64', copy=True)
+    missing = np.isnan(values)
+    start = int(np.nanmax(values, initial=0)) + 1
+    values[missing] = np.arange(start, start + missing.sum())
+    frame['product'] = values.astype('int64')
+    return frame
+
+
+def product_report(frame):
+    priced = frame[frame['effective'].notna()]
+    grouped = priced.groupby('product', sort=False)
+    report = grouped['effective'].agg(min_price='min', median_price='median', max_price='max')
+    report['chains'] = grouped['spider_name'].nunique()
+    cheapest = priced.loc[grouped['effective'].idxmin().to_numpy()]
+    report['cheapest_chain'] = cheapest['spider_name'].to_numpy()
+    report['name'] = cheapest['name'].to_numpy()
+    report['url'] = cheapest['url'].to_numpy()
+    report['spread'] = (report['max_price'] / report['min_price'] - 1).astype('float32')
+    report['max_sale_depth'] = grouped['sale_depth'].max()
+    report['max_benef_depth'] = grouped['benef_depth'].max()
+    report['period_min'] = grouped['period_min'].min()
+    report['period_max'] = grouped['period_max'].max()
+    return report.reset_index().sort_values(['chains', 'spread'], ascending=False, kind='stable')
+
+
+def category_report(frame):
+    priced = frame[frame['effective'].notna()]
+    by_chain = priced.groupby(['category', 'spider_name'], sort=False)['effective'].median()
+    grouped = priced.groupby('category', sort=False)
+    report = grouped['effective'].agg(min_price='min', median_price='median', max_price='max', products='size')
+    report['chains'] = grouped['spider_name'].nunique()
+    report['mean_sale_depth'] = grouped['sale_depth'].mean().astype('float32')
+    report['cheapest_chain'] = by_chain.groupby(level=0, sort=False).idxmin().map(lambda key: key[1])
+    return report.reset_index().sort_values('products', ascending=False, kind='stable')
+
+
+def chain_report(frame, products):
+    grouped = frame.groupby('spider_name', sort=False)
+    report = pd.DataFrame({
+        'products': grouped.size(),
+        'median_price': grouped['effective'].median(),
+        'on_sale_share': (frame['sale_depth'] > 0).groupby(frame['spider_name'], sort=False).mean(),
+        'mean_sale_depth': grouped['sale_depth'].mean(),
+        'mean_benef_depth': grouped['benef_depth'].mean(),
+    })
+    # Solo cuentan los productos que están en más de una cadena
+    compared = products[products['chains'] > 1]
+    report['cheapest_in'] = compared['cheapest_chain'].value_counts().reindex(report.index, fill_value=0)
+    return report.reset_index().astype({'on_sale_share': 'float32', 'mean_sale_depth': 'float32', 'mean_benef_depth': 'float32'})
+
+
+def build_report(frame, matches_path=None):
+    frame['sale_depth'] = discount_depth(frame, 'price_sale')
+    frame['benef_depth'] = discount_depth(frame, 'price_benef')
+    frame = assign_products(frame, matches_path)
+    products = product_report(frame)
+    return {'products': products, 'categories': category_report(frame), 'chains': chain_report(frame, products)}
+
+
+def write_report(reports, output_dir, stamp):
+    # Parquet (zstd) si está pyarrow; si no, CSV comprimido
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, frame in reports.items():
+        if pq is not None:
+            path = os.path.join(output_dir, f'report_{stamp}_{name}.parquet')
+            frame.to_parquet(path, compression='zstd', index=False)
+        else:
+            path = os.path.join(output_dir, f'report_{stamp}_{name}.csv.gz')
+            frame.to_csv(path, index=False, compression='gzip')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--date', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--days', type=int, default=1, help="días hacia atrás desde --date")
+    parser.add_argument('--data-dir', default='datafolder', help="carpeta de los CSV del pipeline (CSV_OUTPUT_DIR)")
+    parser.add_argument('--from-db', action='store_true', help="leer la tabla scr_pharma en vez de los CSV")
+    parser.add_argument('--uri', help="URI SQLAlchemy (por defecto la de credentials.py)")
+    parser.add_argument('--matches', help="índice de matching.py (por defecto .scrapy/matching.sqlite)")
+    parser.add_argument('--output-dir', default=os.path.join('datafolder', 'reports'))
+    args = parser.parse_args()
+
+    if args.from_db:
+        if args.uri is None:
+            from .credentials import SQLALCHEMY_DATABASE_URI
+            args.uri = SQLALCHEMY_DATABASE_URI
+        since = datetime.combine(args.date - timedelta(days=args.days - 1), datetime.min.time())
+        frame = load_db_snapshot(args.uri, since)
+    else:
+        paths = day_paths(args.data_dir, args.date, args.days)
+        if not paths:
+            parser.error(f"No CSV files for {args.date} in {args.data_dir}")
+        frame = load_csv_snapshot(paths)
+    reports = build_report(frame, args.matches or data_path('matching.sqlite'))
+    stamp = args.date.strftime('%Y_%m_%d') + (f'_{args.days}d' if args.days > 1 else '')
+    for path in write_report(reports, args.output_dir, stamp):
+        print(path)
+    print(reports['chains'].to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -45,9 +45,9 @@ DOWNLOAD_DELAY = 2
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "scr_pharma.middlewares.ScrPharmaSpiderMiddleware": 543,
-#}
+SPIDER_MIDDLEWARES = {
+    "scr_pharma.middlewares.ScrPharmaSpiderMiddleware": 543,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
@@ -55,6 +55,8 @@ DOWNLOADER_MIDDLEWARES = {
     "scr_pharma.middlewares.ScrPharmaDownloaderMiddleware": 543,
     "scrapy.downloadermiddlewares.useragent.UserAgentMiddleware": None,
     "scrapy_user_agents.middlewares.RandomUserAgentMiddleware": 400,
+    # Inactivo salvo con REPLAY_MODE (ver replay.py)
+    "scr_pharma.replay.ReplayMiddleware": 950,
 }
 
 # Enable or disable extensions
@@ -67,10 +69,40 @@ DOWNLOADER_MIDDLEWARES = {
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     "scr_pharma.pipelines.ScrPharmaPipeline": 300,
-    
+    "scr_pharma.pipelines.ScrPharmaParquetPipeline": 400,
 }
 
 ENABLE_DATABASE_INSERTION = True
+DATABASE_URI = None  # None: SQLALCHEMY_DATABASE_URI de credentials.py; p.ej. 'sqlite:///datafolder/scr_pharma.sqlite'
+
+# Escritura por lotes en la base de datos: se acumulan ítems y se insertan con un
+# único INSERT multi-fila cuando se alcanza DB_BATCH_SIZE o pasan DB_FLUSH_INTERVAL segundos
+DB_BATCH_SIZE = 500
+DB_FLUSH_INTERVAL = 30  # Segundos
+# Si un lote falla se reintenta fila por fila; las filas que siguen fallando se
+# guardan en DB_QUARANTINE_DIR/<spider>_quarantine_<fecha>.csv
+DB_ROW_RETRIES = 2
+DB_QUARANTINE_DIR = 'datafolder'
+# Los lotes los escribe un hilo aparte; con DB_WRITE_QUEUE_SIZE lotes pendientes el pipeline
+# deja de procesar ítems hasta que el hilo libere lugar (backpressure)
+DB_WRITE_QUEUE_SIZE = 4
+# Escritura solo de cambios: al abrir el spider se carga el índice url -> precios y solo se
+# hace upsert de productos nuevos o con precios distintos; al resto se le actualiza last_seen
+ENABLE_CHANGE_ONLY_WRITES = True
+# Historial de precios (history.py): cada upsert de un producto nuevo o con precios distintos se
+# registra también en la partición mensual scr_pharma_history_<AAAA>_<MM> (con o sin escritura solo de cambios)
+PRICE_HISTORY_ENABLED = True
+
+# Exportación CSV: un writer persistente por spider y día (<spider>_<fecha>.csv)
+CSV_OUTPUT_DIR = 'datafolder'
+CSV_COMPRESSION = None  # None, 'gzip' (.csv.gz) o 'zstd' (.csv.zst, requiere el paquete zstandard)
+CSV_BUFFER_SIZE = 1024 * 1024  # Bytes
+
+# Exportación Parquet (columnar) para análisis: datafolder/parquet/<spider>_<fecha>.parquet
+PARQUET_EXPORT_ENABLED = True
+PARQUET_OUTPUT_DIR = 'datafolder/parquet'
+PARQUET_ROW_GROUP_SIZE = 50000  # Filas por row group
+PARQUET_COMPRESSION = 'zstd'
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -93,6 +125,68 @@ ENABLE_DATABASE_INSERTION = True
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
 
+# Selenium / Chrome compartido (ver drivers.py)
+CHROMEDRIVER_PATH = None  # Ruta fija a un chromedriver local; evita resolverlo con webdriver_manager
+CHROMEDRIVER_OFFLINE = False  # Nunca usar la red: requiere CHROMEDRIVER_PATH o una ruta ya cacheada
+CHROMEDRIVER_CACHE_FILE = None  # None: .scrapy/chromedriver.json
+CHROMEDRIVER_CACHE_TTL = 24 * 60 * 60  # Segundos antes de volver a resolver el chromedriver
+CHROME_ARGUMENTS = ['--headless', '--disable-gpu', '--disable-dev-shm-usage']
+CHROME_PAGE_LOAD_STRATEGY = 'normal'
+WEBDRIVER_REUSE = True  # Reutilizar el Chrome (y sus cookies) entre spiders del mismo proceso
+
+# Esperas por condición de los spiders Selenium (waits.py), en reemplazo de time.sleep fijos
+WAIT_TIMEOUT = 10  # Segundos máximos por espera; al agotarse el spider sigue igual que con el sleep
+WAIT_TIMEOUTS = {'ligafarmacia': 20}  # Excepciones por spider
+WAIT_POLL_INTERVAL = 0.25  # Cada cuánto se revisa la condición
+WAIT_STABLE_SECONDS = 1.0  # Tiempo sin cambios para considerar estable la grilla de productos o la red
+
+# CruzVerde: API JSON de productos (se puede apuntar a un servidor local con respuestas grabadas)
+CRUZVERDE_API_URL = 'https://api.cruzverde.cl'
+CRUZVERDE_INVENTORY_ZONE = 'zona308'
+
+# Salcobrand: índice Algolia que usa el buscador del sitio (la API key es la pública de solo búsqueda
+# que se ve en las requests del navegador). Si no se configuran, el spider usa el backend Selenium
+SALCOBRAND_ALGOLIA_APP_ID = None
+SALCOBRAND_ALGOLIA_API_KEY = None
+SALCOBRAND_ALGOLIA_INDEX = None
+SALCOBRAND_ALGOLIA_CATEGORY_ATTRIBUTE = 'categories'
+SALCOBRAND_ALGOLIA_URL = None  # None: https://<APP_ID>-dsn.algolia.net; se puede apuntar a un servidor local
+# Algolia entrega a lo sumo PAGINATION_LIMIT hits por consulta (paginationLimitedTo del índice): las
+# categorías más grandes se parten en una consulta por valor de SPLIT_ATTRIBUTE, que debe ser un facet
+SALCOBRAND_ALGOLIA_SPLIT_ATTRIBUTE = 'brand'
+SALCOBRAND_ALGOLIA_PAGINATION_LIMIT = 1000
+# Atributo de los hits para cada campo, sobre algolia_fields del spider, p.ej. {'price': 'list_price'}
+SALCOBRAND_ALGOLIA_FIELDS = {}
+
+# Profar: tienda VTEX; el backend por defecto pagina su API pública de catálogo
+PROFAR_API_URL = 'https://www.profar.cl'  # Se puede apuntar a un servidor local con respuestas grabadas
+
+# Farmex: caché persistente url -> marca para no volver a visitar productos ya conocidos
+FARMEX_BRAND_CACHE_FILE = None  # None: .scrapy/farmex_brands.json
+
+# Caché de contenido para re-crawls incrementales (contentcache.py y middlewares.py): las páginas
+# que vuelven sin cambios (304 o mismo hash del cuerpo) no se parsean y sus productos se re-emiten
+# como UnchangedScrPharmaItem, a los que el pipeline solo les actualiza last_seen
+CONTENT_CACHE_ENABLED = True
+CONTENT_CACHE_FILE = None  # None: .scrapy/content_cache.sqlite
+CONTENT_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # Segundos; las entradas más viejas se vuelven a parsear (0: sin límite)
+
+# Checkpoints por página de los spiders Selenium (checkpoints.py). Con CHECKPOINT_RESUME o
+# -a resume=true un spider que no terminó retoma desde la última página completada
+CHECKPOINT_DIR = None  # None: .scrapy/checkpoints/<spider>.json
+CHECKPOINT_RESUME = False
+
+# Cola de categorías compartida entre procesos del mismo spider (workqueue.py), activa con
+# -a work_queue=<id de ejecución> (true: la fecha de hoy) o WORK_QUEUE_RUN
+WORK_QUEUE_FILE = None  # None: .scrapy/work_queue.sqlite; para varias máquinas, un archivo en disco compartido
+WORK_QUEUE_RUN = None
+WORK_QUEUE_LEASE_SECONDS = 600  # Si un worker deja de renovar su lease este tiempo, otro toma la categoría
+
+# Grabación y reproducción de crawls (replay.py). Normalmente los fija python -m scr_pharma.replay
+REPLAY_MODE = None  # None, 'record' (graba las respuestas reales) o 'replay' (las pide a REPLAY_SERVER)
+REPLAY_ARCHIVE = None  # None: .scrapy/replay.sqlite
+REPLAY_SERVER = None  # URL del servidor de replay, p.ej. http://127.0.0.1:8900
+
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
@@ -1,26 +1,40 @@
 import re
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
-import time
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem 
+from ..items import build_items, details_record
+from ..drivers import acquire_driver, release_driver
+from ..waits import Waiter
+from ..extraction import extract_products, page_response
+from ..contentcache import page_items
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
 
 class AhumadaSpider(scrapy.Spider):
     name = 'ahumada'
     allowed_domains = ['farmaciasahumada.cl']
+    base_url = 'https://www.farmaciasahumada.cl/on/demandware.store/Sites-ahumada-cl-Site/default/Search-UpdateGrid'
+    page_size = 48
+    product_tiles_xpath = "//div[contains(@class, 'product-tile')]//div[contains(@class, 'product-tile h-100')]"
+    # XPaths de cada campo, relativos a un producto de la grilla
+    product_fields = {
+        'brand': "normalize-space(.//div[@class='product-tile-brand']//span)",
+        'url': "(.//a[@class='link'])[1]/@href",
+        'name': "normalize-space((.//a[@class='link'])[1])",
+        'price': ".//del//span//span[@class='value']/@content",
+        'price_sale': "normalize-space(.//span[@class = 'sales']//span)",
+    }
+    # El backend HTTP pide las grillas directamente: se permiten varias requests en paralelo
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.25,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, backend='http', *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Descomentar para ejecución en modo headless
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        # backend='http': requests de Scrapy a Search-UpdateGrid; backend='selenium': cargar cada grilla en Chrome
+        self.backend = backend
+        self.driver = None
+        self.waiter = None
+        self.checkpoint = None
         self.categories = [
             'medicamentos',
             'belleza',
@@ -34,85 +48,100 @@ class AhumadaSpider(scrapy.Spider):
             'recetario-magistral'
         ]
 
+    def grid_url(self, category, start):
+        return f"{self.base_url}?cgid={category}&start={start}&sz={self.page_size}"
+
     def start_requests(self):
-        yield scrapy.Request(url='https://www.farmaciasahumada.cl', callback=self.parse, dont_filter=True)
+        if self.backend == 'selenium':
+            yield scrapy.Request(url='https://www.farmaciasahumada.cl', callback=self.parse, dont_filter=True)
+            return
+        # Search-UpdateGrid devuelve HTML renderizado en el servidor: todas las categorías en paralelo
+        for category in self.categories:
+            yield scrapy.Request(self.grid_url(category, 0), callback=self.parse_grid,
+                                 meta={'category': category, 'start': 0, 'handle_httpstatus_list': [403], 'content_cache': True})
+
+    def parse_grid(self, response):
+        category = response.meta['category']
+        start = response.meta['start']
+        if response.status != 200:
+            # Si el sitio bloquea las requests directas, la categoría se procesa con Chrome
+            self.logger.warning(f"Grid request for {category} returned {response.status}, falling back to Selenium")
+            yield scrapy.Request(url='https://www.farmaciasahumada.cl', callback=self.parse, dont_filter=True,
+                                 meta={'categories': [category], 'start': start})
+            return
+
+        products = extract_products(response, self.product_tiles_xpath, self.product_fields)
+        if not products:
+            self.logger.info(f"No products found for category {category} at start {start}, moving to next category.")
+            return
+
+        # Todos los ítems de la grilla se construyen juntos, con un solo timestamp
+        yield from build_items([details_record(self.tile_details(details), category) for details in products], self.name)
+
+        if response.xpath("//button[contains(@class, 'more')]"):
+            next_start = start + self.page_size
+            yield scrapy.Request(self.grid_url(category, next_start), callback=self.parse_grid,
+                                 meta={'category': category, 'start': next_start, 'handle_httpstatus_list': [403], 'content_cache': True})
+
+    def tile_details(self, details):
+        # Campos leídos con product_fields (mismo HTML para el backend HTTP y el Selenium)
+        product_url = details['url'] or 'No URL'
+        product_name = details['name'] if details['url'] else 'No name'
+        brand = details['brand'] or 'No brand'
+        price = details['price'] or '0'
+        price_sale = details['price_sale'] or '0'
+        price_benef = '0'
+
+        # Extract SKU from the URL
+        sku_match = re.search(r'-(\d+)\.html$', product_url)
+        sku = sku_match.group(1) if sku_match else 'No SKU'
+
+        return brand, product_url, product_name, price, price_sale, price_benef, sku
 
     def parse(self, response):
+        self.driver = self.driver or acquire_driver(self.settings)
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
         self.driver.get(response.url)
-        base_url = 'https://www.farmaciasahumada.cl/on/demandware.store/Sites-ahumada-cl-Site/default/Search-UpdateGrid'
 
-        for category in self.categories:
-            start = 0
-            size = 48
+        for category in claim_categories(self, response.meta.get('categories', self.categories)):
+            if self.checkpoint.is_done(category):
+                continue
+            size = self.page_size
+            # Al retomar, seguir en la grilla siguiente a la última completada
+            last_start = self.checkpoint.cursor(category)
+            start = last_start + size if last_start is not None else response.meta.get('start', 0)
             
             while True:
-                url = f"{base_url}?cgid={category}&start={start}&sz={size}"
+                url = self.grid_url(category, start)
                 self.driver.get(url)
-                time.sleep(3)  # Wait for JavaScript to load contents
+                self.waiter.product_count_stable(self.product_tiles_xpath)
+                # Una sola foto del DOM por grilla en lugar de un find_element por campo y producto
+                page = page_response(self.driver)
                 
-                try:
-                    products = self.driver.find_elements(By.XPATH, "//div[contains(@class, 'product-tile')]//div[contains(@class, 'product-tile h-100')]")
-                    
-                    if not products:
-                        print(f"No products found for category {category}, breaking the loop.")
-                        break
-                    
-                    for product in products:
-                        loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-                        brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_product_details(product)
-                        loader.add_value('brand', brand)
-                        loader.add_value('url', product_url)
-                        loader.add_value('name', product_name)
-                        loader.add_value('price', price)
-                        loader.add_value('price_sale', price_sale)
-                        loader.add_value('price_benef', price_benef)
-                        loader.add_value('code', sku)
-                        loader.add_value('category', category)
-                        loader.add_value('timestamp', datetime.now())
-                        loader.add_value('spider_name', self.name)
-                        yield loader.load_item()
+                # Si la grilla es idéntica a la del crawl anterior se re-emiten sus ítems sin parsearla
+                items = page_items(self, url, page.body, lambda: build_items(
+                    [details_record(self.tile_details(details), category)
+                     for details in extract_products(page, self.product_tiles_xpath, self.product_fields)], self.name))
                 
-                except NoSuchElementException:
-                    print(f"No products found due to NoSuchElementException for category {category}, breaking the loop.")
+                if not items:
+                    print(f"No products found for category {category}, breaking the loop.")
+                    self.checkpoint.category_done(category)
                     break
                 
-                more_button = self.driver.find_elements(By.XPATH, "//button[contains(@class, 'more')]")
+                yield from items
+                self.checkpoint.page_done(category, start, len(items))
+
+                more_button = page.xpath("//button[contains(@class, 'more')]")
                 if not more_button:
                     print(f"No more button found for category {category}, moving to next category.")
+                    self.checkpoint.category_done(category)
                     break
 
-                more_button[0].click()
+                # No hace falta hacer clic en "more": la siguiente grilla se carga por URL
                 start += size
 
-    def extract_product_details(self, product):
-        try:
-            brand = product.find_element(By.XPATH, ".//div[@class='product-tile-brand']//span").text
-        except NoSuchElementException:
-            brand = 'No brand'
-        try:
-            product_url = product.find_element(By.XPATH, ".//a[@class='link']").get_attribute('href')
-            product_name = product.find_element(By.XPATH, ".//a[@class='link']").text
-        except NoSuchElementException:
-            product_url = 'No URL'
-            product_name = 'No name'
-        try:
-            price = product.find_element(By.XPATH, ".//del//span//span[@class='value']").get_attribute('content')
-        except NoSuchElementException:
-            price = '0'
-        try:
-            price_sale = product.find_element(By.XPATH, ".//span[@class = 'sales']//span").text
-        except NoSuchElementException:
-            price_sale = '0'
-        price_benef = '0' 
-        
-        # Extract SKU from the URL
-        sku_match = re.search(r'-(\d+)\.html$', product_url)
-        if sku_match:
-            sku = sku_match.group(1)
-        else:
-            sku = 'No SKU'
-        
-        return brand, product_url, product_name, price, price_sale, price_benef, sku
-
     def closed(self, reason):
-        self.driver.quit()
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        release_driver(self.driver, self.settings)
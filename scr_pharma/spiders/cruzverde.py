@@ -1,54 +1,171 @@
 import json
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.common.exceptions import WebDriverException, NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
-import time
+from urllib.parse import urlparse
 
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem 
+from ..items import build_items
+from ..drivers import acquire_driver, release_driver, restore_cookies, save_cookies
+from ..waits import Waiter
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
 
 
 class CruzVerdeSpider(scrapy.Spider):
     name = 'cruzverde'
     allowed_domains = ['cruzverde.cl']
     start_urls = ['https://www.cruzverde.cl/']
-
-    def __init__(self, *args, **kwargs):
+    # El backend HTTP consulta la API JSON directamente: se permiten varias requests en paralelo
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.25,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    }
+    page_size = 48
+
+    def __init__(self, backend='http', *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Descomentar para ejecución en modo headless
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        # backend='http': requests de Scrapy a la API; backend='selenium': navegar la API con Chrome
+        self.backend = backend
+        self.driver = None
+        self.waiter = None
+        self.checkpoint = None
+        self.api_cookies = None
         self.visited_urls = set()
         self.processed_categories = set()
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.api_url = crawler.settings.get('CRUZVERDE_API_URL', 'https://api.cruzverde.cl').rstrip('/')
+        spider.inventory_zone = crawler.settings.get('CRUZVERDE_INVENTORY_ZONE', 'zona308')
+        # Permitir un servidor local con respuestas grabadas (p.ej. http://127.0.0.1:8000)
+        api_host = urlparse(spider.api_url).hostname
+        if api_host and not api_host.endswith('cruzverde.cl'):
+            spider.allowed_domains = spider.allowed_domains + [api_host]
+        return spider
+
+    def category_tree_url(self):
+        return f"{self.api_url}/product-service/categories/category-tree?showInMenu=true"
+
+    def search_url(self, category_id, offset):
+        return (f"{self.api_url}/product-service/products/search?limit={self.page_size}&offset={offset}"
+                f"&sort=&q=&refine[]=cgid={category_id}&inventoryId={self.inventory_zone}&inventoryZone={self.inventory_zone}")
+
+    def start_requests(self):
+        if self.backend == 'selenium':
+            for url in self.start_urls:
+                yield scrapy.Request(url, callback=self.parse, dont_filter=True)
+        else:
+            yield self.api_request(self.category_tree_url(), self.parse_category_tree)
+
+    def api_request(self, url, callback, meta=None):
+        return scrapy.Request(
+            url,
+            callback=callback,
+            headers={'Accept': 'application/json'},
+            cookies=self.api_cookies or {},
+            # with_cookies: la request ya salió con las cookies del warm-up; si la rechazan no se reintenta
+            meta={**(meta or {}), 'handle_httpstatus_list': [401, 403], 'content_cache': True,
+                  'with_cookies': self.api_cookies is not None},
+            dont_filter=True,
+        )
+
+    def warm_up_cookies(self):
+        # Solo si la API rechaza las requests: abrir la home una vez en Chrome y copiar sus cookies
+        self.driver = self.driver or acquire_driver(self.settings)
+        self.waiter = self.waiter or Waiter(self)
+        self.driver.get(self.start_urls[0])
+        self.waiter.element_present('//body')
+        restore_cookies(self.driver, self.name)
+        save_cookies(self.driver, self.name)
+        self.api_cookies = {cookie['name']: cookie['value'] for cookie in self.driver.get_cookies()}
+        self.logger.info(f"Seeded {len(self.api_cookies)} cookies from a browser warm-up")
+
+    def retry_with_cookies(self, response):
+        if response.status not in (401, 403):
+            return None
+        if response.meta.get('with_cookies'):
+            self.logger.error(f"API request rejected with status {response.status} even after warm-up: {response.url}")
+            return []
+        # El primer rechazo calienta las cookies; las demás requests que ya estaban en vuelo sin
+        # cookies se reenvían con las nuevas
+        if self.api_cookies is None:
+            self.warm_up_cookies()
+        return [self.api_request(response.url, response.request.callback, meta=response.meta)]
+
+    def parse_category_tree(self, response):
+        retry = self.retry_with_cookies(response)
+        if retry is not None:
+            yield from retry
+            return
+        for category in json.loads(response.text):
+            new_path = [category['name']]
+            category_id = category['id']
+            if category_id in self.processed_categories:
+                continue
+            self.processed_categories.add(category_id)
+            yield self.api_request(self.search_url(category_id, 0), self.parse_search_page,
+                                   meta={'category_path': new_path, 'category_id': category_id, 'offset': 0})
+
+    def parse_search_page(self, response):
+        retry = self.retry_with_cookies(response)
+        if retry is not None:
+            yield from retry
+            return
+        data = json.loads(response.text)
+        category_id = response.meta['category_id']
+        category_path = response.meta['category_path']
+
+        # La primera página trae el total: el resto de offsets se piden todos en paralelo
+        if response.meta['offset'] == 0:
+            total_products = data.get('total', 0)
+            for offset in range(self.page_size, total_products, self.page_size):
+                yield self.api_request(self.search_url(category_id, offset), self.parse_search_page,
+                                       meta={'category_path': category_path, 'category_id': category_id, 'offset': offset})
+
+        yield from build_items([self.product_record(product, category_path) for product in data.get('hits', [])], self.name)
+
+    def product_record(self, product, category_path):
+        image_link = product['image']['link']
+        # Extraer el código del producto y el código de categoría
+        product_code, cat_code = image_link.split('/')[-1].split('-', 1)
+        cat_code = cat_code.split('.jpg')[0]
+        product_url = f"https://www.cruzverde.cl/{cat_code}/{product_code}.html"
+
+        return {
+            'brand': product.get('brand', 'Unknown Brand'),
+            'name': product.get('productName', 'Unknown Product Name'),
+            'url': product_url,
+            'price': product.get('prices', {}).get('price-list-cl', '0'),
+            'price_sale': product.get('prices', {}).get('price-sale-cl', '0'),
+            'price_benef': '0',
+            'code': product.get('productId', 'No SKU'),
+            'category': ' > '.join(category_path),
+        }
+
     def parse(self, response):
+        self.driver = self.driver or acquire_driver(self.settings)
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
         self.driver.get(response.url)
         try:
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, 'body'))
-            )
-            cookies = self.driver.get_cookies()
-            for cookie in cookies:
-                self.driver.add_cookie(cookie)
-
-            api_url = 'https://api.cruzverde.cl/product-service/categories/category-tree?showInMenu=true'
-            self.driver.get(api_url)
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, 'body'))
-            )
+            self.waiter.element_present('//body')
+            # Reusar las cookies de una sesión ya calentada en este proceso y guardar las actuales
+            restore_cookies(self.driver, self.name)
+            save_cookies(self.driver, self.name)
+
+            self.driver.get(self.category_tree_url())
+            self.waiter.element_present('//body')
             data = json.loads(self.driver.find_element(By.TAG_NAME, 'body').text)
+            categories = []
             for item in data:
-                yield from self.extract_category(item, path=[])
+                categories.extend(self.extract_category(item, path=[]))
+            # Las categorías se recorren en línea con el mismo driver (con -a work_queue, solo las que tome este worker)
+            for category_id, category_path in claim_categories(self, categories, key=lambda category: str(category[0])):
+                yield from self.scrape_category(category_id, category_path)
         except Exception as e:
             self.logger.error(f"Error loading page: {str(e)}")
+            self.checkpoint.mark_failed()
             self.driver.quit()
 
     def extract_category(self, category, path):
@@ -59,66 +176,41 @@ class CruzVerdeSpider(scrapy.Spider):
         if full_url not in self.visited_urls and category_id not in self.processed_categories:
             self.visited_urls.add(full_url)
             self.processed_categories.add(category_id)
-            yield scrapy.Request(full_url, callback=self.load_category_page, meta={'category_path': new_path, 'category_id': category_id, 'category_url': full_url})
+            yield category_id, new_path
 
         '''if 'categories' in category:
             for subcategory in category['categories']:
                 yield from self.extract_category(subcategory, new_path)'''
 
-    def load_category_page(self, response):
+    def scrape_category(self, category_id, category_path):
         try:
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, 'body'))
-            )
-
-            category_id = response.meta['category_id']
-            category_path = response.meta['category_path']
-            offset = 0
-            limit = 48
-
-            # Obtener el total de productos en la primera iteración
-            api_url = f"https://api.cruzverde.cl/product-service/products/search?limit={limit}&offset={offset}&sort=&q=&refine[]=cgid={category_id}&inventoryId=zona308&inventoryZone=zona308"
-            self.driver.get(api_url)
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, 'body'))
-            )
-            data = json.loads(self.driver.find_element(By.TAG_NAME, 'body').text)
-
-            total_products = data.get('total', 0)
-            iterations = (total_products + limit - 1) // limit  # Número total de iteraciones necesarias
-
-            for i in range(iterations):
-                offset = i * limit
-                api_url = f"https://api.cruzverde.cl/product-service/products/search?limit={limit}&offset={offset}&sort=&q=&refine[]=cgid={category_id}&inventoryId=zona308&inventoryZone=zona308"
-                self.driver.get(api_url)
-                WebDriverWait(self.driver, 10).until(
-                    EC.presence_of_element_located((By.TAG_NAME, 'body'))
-                )
+            if self.checkpoint.is_done(category_id):
+                return
+            # Al retomar, seguir en el offset siguiente al último completado
+            last_offset = self.checkpoint.cursor(category_id)
+            offset = last_offset + self.page_size if last_offset is not None else 0
+
+            # La primera página trae el total y sus productos: no se vuelve a pedir el offset 0
+            while True:
+                self.driver.get(self.search_url(category_id, offset))
+                self.waiter.element_present('//body')
                 data = json.loads(self.driver.find_element(By.TAG_NAME, 'body').text)
-                
-                for product in data.get('hits', []):
-                    image_link = product['image']['link']
-                    # Extraer el código del producto y el código de categoría
-                    product_code, cat_code = image_link.split('/')[-1].split('-', 1)
-                    cat_code = cat_code.split('.jpg')[0]
-                    product_url = f"https://www.cruzverde.cl/{cat_code}/{product_code}.html"
-                    
-                    loader = ItemLoader(item=ScrPharmaItem())
-                    loader.add_value('brand', product.get('brand', 'Unknown Brand'))
-                    loader.add_value('name', product.get('productName', 'Unknown Product Name'))
-                    loader.add_value('url', product_url)                    
-                    loader.add_value('price', product.get('prices', {}).get('price-list-cl', '0'))
-                    loader.add_value('price_sale', product.get('prices', {}).get('price-sale-cl', '0'))
-                    loader.add_value('price_benef', '0')
-                    loader.add_value('code', product.get('productId', 'No SKU'))
-                    loader.add_value('category', ' > '.join(category_path))                    
-                    loader.add_value('timestamp', datetime.now())
-                    loader.add_value('spider_name', self.name)
-                    yield loader.load_item()
+
+                items = build_items([self.product_record(product, category_path) for product in data.get('hits', [])], self.name)
+                yield from items
+                self.checkpoint.page_done(category_id, offset, len(items))
+
+                offset += self.page_size
+                if offset >= data.get('total', 0):
+                    self.checkpoint.category_done(category_id)
+                    break
 
         except Exception as e:
             self.logger.error(f"Error loading category page: {str(e)}")
+            self.checkpoint.mark_failed(category_id)
 
 
     def closed(self, reason):
-        self.driver.quit()
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        release_driver(self.driver, self.settings)
@@ -1,238 +1,380 @@
+import json
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.action_chains import ActionChains
-import time
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem
+from scrapy.utils.project import data_path
+from ..items import build_item, build_items
+from ..drivers import acquire_driver, release_driver
+from ..waits import Waiter
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
+from ..extraction import extract_products, page_response
+from ..helpers import number_to_price
 
 class FarmexSpider(scrapy.Spider):
     name = 'farmex'
     allowed_domains = ['farmex.cl']
     start_urls = ['https://farmex.cl/']
+    # Las páginas de producto (marca) se piden como requests de Scrapy, varias en paralelo
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.25,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    }
+    products_per_page = 250  # Máximo que acepta el products.json de Shopify
+    page_window = 4  # Páginas de products.json pedidas en paralelo por colección
+    grid_products_xpath = "//div[contains(@class, 'product-grid-item')]"
+    page_products_xpath = "//div[@class='item-content']"
+    # XPaths de cada campo, relativos a un producto de la grilla de colecciones / de las páginas simples
+    grid_product_fields = {
+        'url': "(.//h5[contains(@class, 'product-name')]//a)[1]/@href",
+        'name': "normalize-space((.//h5[contains(@class, 'product-name')]//a)[1])",
+        'price_1': "normalize-space((.//div[contains(@class, 'product-price')]//span)[1])",
+        'price_2': "normalize-space((.//div[contains(@class, 'product-price')]//span)[2])",
+        'price_3': "normalize-space((.//div[contains(@class, 'product-price')]//span)[3])",
+    }
+    page_product_fields = {
+        'url': "(.//a[contains(@class, 'product-title')])[1]/@href",
+        'name': "normalize-space((.//a[contains(@class, 'product-title')])[1])",
+        'compare_price': "normalize-space((.//span[contains(@class, 'product-compare-price')])[1])",
+        'price': "normalize-space((.//span[contains(@class, 'product-price')])[1])",
+    }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, backend='shopify', *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Uncomment for headless execution
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
-        self.action = ActionChains(self.driver)
+        # backend='shopify': las colecciones se leen desde products.json; backend='selenium': listado en Chrome
+        self.backend = backend
+        # Chrome se abre recién cuando hace falta (start_driver): con backend='shopify' puede no abrirse nunca
+        self.driver = None
+        self.action = None
+        self.waiter = None
+        self.checkpoint = None
+        # Páginas de listado con páginas de producto todavía en vuelo, en orden, por categoría
+        self.pending_pages = {}
+        self.finished_categories = set()
+        # Páginas de products.json terminadas y primera página incompleta (la última), por colección
+        self.collection_pages = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # Caché persistente url -> marca: un producto con marca conocida no se vuelve a visitar
+        spider.brand_cache_file = (crawler.settings.get('FARMEX_BRAND_CACHE_FILE')
+                                   or data_path('farmex_brands.json', createdir=True))
+        spider.brand_cache = spider.load_brand_cache()
+        return spider
+
+    def start_driver(self):
+        if self.driver is None:
+            self.driver = acquire_driver(self.settings)
+            self.action = ActionChains(self.driver)
+        return self.driver
 
     def start_requests(self):
         yield scrapy.Request(url=self.start_urls[0], callback=self.parse_categories)
 
     def parse_categories(self, response):
-        self.driver.get(response.url)
-        time.sleep(2)  # Wait for JavaScript to load contents
-        self.close_popup()
-        category_elements = self.driver.find_elements(By.XPATH, "//ul[@class='nav main-nav']//li[@class='dropdown'][1]//ul[@class='dropdown-menu']//li[@class='dropdown dropdown-submenu']//a[@class='dropdown-link']")
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
+        category_xpath = "//ul[@class='nav main-nav']//li[@class='dropdown'][1]//ul[@class='dropdown-menu']//li[@class='dropdown dropdown-submenu']//a[@class='dropdown-link']"
+        # El menú viene en el HTML de la home: con backend='shopify' se lee de la respuesta, sin Chrome
+        category_urls = response.xpath(f"{category_xpath}/@href").getall() if self.backend == 'shopify' else []
+        if not category_urls:
+            self.start_driver().get(response.url)
+            self.waiter.element_present(category_xpath)
+            self.close_popup()
+            category_urls = [element.get_attribute('href') for element in self.driver.find_elements(By.XPATH, category_xpath)]
         
         categories = []
-        for element in category_elements:
-            category_url = element.get_attribute('href')
+        for category_url in map(response.urljoin, category_urls):
             category_name = category_url.split('/')[-1]
             categories.append((category_name, category_url))
         
-        # Process categories one by one
-        for category_name, category_url in categories:
-            yield scrapy.Request(url=category_url, callback=self.parse_category, meta={'category_name': category_name, 'category_url': category_url})
+        # Process categories one by one, en línea con el mismo driver (con -a work_queue, solo las que tome este worker)
+        # La clave en la cola es la misma que en el checkpoint (el nombre): la cola completa la categoría con category_done
+        for category_name, category_url in claim_categories(self, categories, key=lambda category: category[0]):
+            yield from self.parse_category(category_name, category_url)
 
-    def parse_category(self, response):
-        category = response.meta['category_name']
-        category_url = response.meta['category_url']
-        
-        if 'collections' in category_url or 'collections' in category:
-            yield from self.parse_collections(response, category)
+    def parse_category(self, category, category_url):
+        if ('collections' in category_url or 'collections' in category) and self.backend == 'shopify':
+            if self.checkpoint.is_done(category):
+                return
+            collection_url = category_url.split('?')[0].rstrip('/')
+            for page in range(1, self.page_window + 1):
+                yield self.products_json_request(collection_url, category, page)
+        elif 'collections' in category_url or 'collections' in category:
+            yield from self.parse_collections(category_url, category)
+        else:
+            yield from self.parse_pages(category_url, category)
+
+    def products_json_request(self, collection_url, category, page):
+        return scrapy.Request(
+            f"{collection_url}/products.json?limit={self.products_per_page}&page={page}",
+            callback=self.parse_products_json,
+            errback=self.products_json_failed,
+            headers={'Accept': 'application/json'},
+            meta={'collection_url': collection_url, 'category': category, 'page': page, 'content_cache': True},
+            dont_filter=True,
+        )
+
+    def parse_products_json(self, response):
+        products = json.loads(response.text).get('products', [])
+        collection_url = response.meta['collection_url']
+        category = response.meta['category']
+
+        # products.json no informa el total: se mantienen page_window páginas en vuelo y cada
+        # página llena pide la que está page_window más adelante; una página incompleta es la última
+        if len(products) >= self.products_per_page:
+            yield self.products_json_request(collection_url, category, response.meta['page'] + self.page_window)
+
+        yield from build_items([self.product_json_record(product, collection_url, category) for product in products], self.name)
+
+    def response_finished(self, response, outputs):
+        # Llamado por ScrPharmaSpiderMiddleware cuando terminó la salida de una respuesta, también si el
+        # caché de contenido la re-emitió sin ejecutar parse_products_json
+        if 'collection_url' in response.meta:
+            full = any(isinstance(output, scrapy.Request) for output in outputs)
+            self.collection_page_finished(response.meta['category'], response.meta['page'], full)
+
+    def collection_page_finished(self, category, page, full):
+        # La colección termina cuando terminaron todas las páginas hasta la primera incompleta; las que
+        # siguen en vuelo por la ventana están más allá del final y vuelven vacías
+        if self.checkpoint.is_done(category):
+            return
+        pages = self.collection_pages.setdefault(category, {'finished': set(), 'last': None})
+        pages['finished'].add(page)
+        if not full and (pages['last'] is None or page < pages['last']):
+            pages['last'] = page
+        if pages['last'] is not None and pages['finished'].issuperset(range(1, pages['last'] + 1)):
+            del self.collection_pages[category]
+            self.finish_category(category)
+
+    def products_json_failed(self, failure):
+        request = failure.request
+        self.logger.error(f"Could not fetch {request.url}: {failure.getErrorMessage()}")
+        self.collection_pages.pop(request.meta['category'], None)
+        self.checkpoint.mark_failed(request.meta['category'])
+
+    def product_json_record(self, product, collection_url, category):
+        variants = product.get('variants') or [{}]
+        # Primera variante disponible (la que muestra el listado); si ninguna lo está, la primera
+        variant = next((v for v in variants if v.get('available')), variants[0])
+        compare_at_price = variant.get('compare_at_price')
+        # Igual que el listado: con oferta, price es el precio tachado y price_sale el precio actual
+        if compare_at_price and float(compare_at_price) > float(variant.get('price') or 0):
+            price = number_to_price(compare_at_price)
+            price_sale = number_to_price(variant.get('price'))
         else:
-            yield from self.parse_pages(response, category)
+            price = number_to_price(variant.get('price'))
+            price_sale = '0'
+        return {
+            'brand': product.get('vendor') or 'No brand',
+            'url': f"{collection_url}/products/{product.get('handle')}",
+            'name': product.get('title') or 'No name',
+            'price': price,
+            'price_sale': price_sale,
+            'price_benef': '0',
+            'code': variant.get('sku') or 'No SKU',
+            'category': category,
+        }
 
-    def parse_collections(self, response, category):
-        self.driver.get(response.url)
-        time.sleep(2)  # Wait for JavaScript to load contents
+    def parse_collections(self, category_url, category):
+        if self.checkpoint.is_done(category):
+            return
+        # Al retomar, seguir en la página siguiente a la última completada
+        page_number = self.checkpoint.pages_done(category) + 1
+        self.start_driver().get(category_url if page_number == 1 else f"{category_url.split('?')[0]}?page={page_number}")
+        self.waiter.product_count_stable(self.grid_products_xpath)
         self.close_popup()
 
-        page_number = 1
         while True:
             # Extract items from the current page
             items = list(self.extract_items(category))
             
             if not items:
                 self.logger.info(f"No more products found in category {category}. Ending pagination.")
+                self.finish_category(category)
                 break
 
+            page = self.track_page(category, page_number, items)
             for item in items:
                 yield item
+            self.page_emitted(category, page)
 
             # Try to navigate to the next page
             page_number += 1
-            next_page_url = f"{response.url.split('?')[0]}?page={page_number}"
+            next_page_url = f"{category_url.split('?')[0]}?page={page_number}"
             self.driver.get(next_page_url)
-            time.sleep(2)  # Wait for the new page to load
+            self.waiter.product_count_stable(self.grid_products_xpath)
             self.close_popup()
 
             # Check if there are products on the new page
-            if not self.driver.find_elements(By.XPATH, "//div[contains(@class, 'product-grid-item')]"):
+            if not self.driver.find_elements(By.XPATH, self.grid_products_xpath):
                 self.logger.info(f"No more products found on page {page_number} of category {category}. Ending pagination.")
+                self.finish_category(category)
                 break
 
+    def track_page(self, category, cursor, results):
+        # Una página cuenta como completada recién cuando sus páginas de producto (Requests) terminaron:
+        # si no, un resume la saltaría aunque esos productos nunca se hayan escrito
+        requests = [result for result in results if isinstance(result, scrapy.Request)]
+        page = {'cursor': cursor, 'pending': len(requests), 'items': len(results) - len(requests), 'emitted': False}
+        for request in requests:
+            request.meta['page'] = page
+        self.pending_pages.setdefault(category, []).append(page)
+        return page
+
+    def page_emitted(self, category, page):
+        page['emitted'] = True
+        self.commit_pages(category)
+
+    def detail_finished(self, request):
+        page = request.meta['page']
+        page['pending'] -= 1
+        page['items'] += 1
+        self.commit_pages(request.meta['category'])
+
+    def finish_category(self, category):
+        self.finished_categories.add(category)
+        self.commit_pages(category)
+
+    def commit_pages(self, category):
+        # Checkpoint de las páginas terminadas en orden: una página pendiente frena a las siguientes
+        pages = self.pending_pages.get(category, [])
+        while pages and pages[0]['emitted'] and pages[0]['pending'] == 0:
+            page = pages.pop(0)
+            self.checkpoint.page_done(category, page['cursor'], page['items'])
+        if not pages and category in self.finished_categories:
+            self.finished_categories.discard(category)
+            self.pending_pages.pop(category, None)
+            self.checkpoint.category_done(category)
+
     def extract_items(self, category):
-        products = self.driver.find_elements(By.XPATH, "//div[contains(@class, 'product-grid-item')]")
-        for product in products:
-            loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-            brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_product_details(product)
-            loader.add_value('brand', brand)
-            loader.add_value('url', product_url)
-            loader.add_value('name', product_name)
-            loader.add_value('price', price)
-            loader.add_value('price_sale', price_sale)
-            loader.add_value('price_benef', price_benef)
-            loader.add_value('code', sku)
-            loader.add_value('category', category)
-            loader.add_value('timestamp', datetime.now())
-            loader.add_value('spider_name', self.name)
-            yield loader.load_item()
+        # Una sola foto del DOM por página en lugar de un find_element por campo y producto
+        for fields in extract_products(page_response(self.driver), self.grid_products_xpath, self.grid_product_fields):
+            yield self.complete_details(self.extract_product_details(fields), category)
 
     def close_popup(self):
         try:
             body = self.driver.find_element(By.TAG_NAME, 'body')
             self.action.move_to_element(body).click().perform()
-            time.sleep(1)
+            # El clic es síncrono: basta con que la página no tenga requests pendientes
+            self.waiter.network_idle(idle_for=0.3, timeout=2)
         except Exception as e:
             print(f"Error closing popup: {str(e)}")
 
-    def parse_pages(self, response, category):
-        self.driver.get(response.url)
-        time.sleep(2)  # Wait for JavaScript to load contents
+    def parse_pages(self, category_url, category):
+        if self.checkpoint.is_done(category):
+            return
+        self.start_driver().get(category_url)
+        self.waiter.product_count_stable(self.page_products_xpath)
         self.close_popup()
 
         # Extract items from the single page
         items = list(self.extract_page_items(category))
         
+        page = self.track_page(category, category_url, items)
         for item in items:
             yield item           
+        self.page_emitted(category, page)
+        self.finish_category(category)
                 
-    def extract_product_details(self, product):
-        try:
-            product_name_element = product.find_element(By.XPATH, ".//h5[contains(@class, 'product-name')]//a")
-            product_url = product_name_element.get_attribute('href')
-            product_name = product_name_element.text
-        except NoSuchElementException:
-            product_url = 'No URL'
-            product_name = 'No name'
+    def extract_product_details(self, fields):
+        product_url = fields['url'] or 'No URL'
+        product_name = (fields['name'] or '') if fields['url'] else 'No name'
         
-        # Extract prices and other details
-        try:
-            price_elements = product.find_elements(By.XPATH, ".//div[contains(@class, 'product-price')]//span")
-            if len(price_elements) == 1:
-                price = price_elements[0].text
-                price_sale = 'No sale price'
-            elif len(price_elements) == 2:
-                price = price_elements[0].text
-                price_sale = price_elements[1].text
-            else:
-                price = 'No price'
-                price_sale = 'No sale price'
-        except NoSuchElementException:
+        # Uno o dos precios en el listado (normal y oferta); con más de dos no se reconoce el formato
+        if fields['price_1'] and not fields['price_3']:
+            price = fields['price_1']
+            price_sale = fields['price_2'] or 'No sale price'
+        else:
             price = 'No price'
             price_sale = 'No sale price'
 
         price_benef = '0'  
         sku = 'No SKU'
-        
-        # Open product URL to extract additional information
-        self.driver.execute_script("window.open(arguments[0], '_blank');", product_url)
-        self.driver.switch_to.window(self.driver.window_handles[-1])
-        
-        try:
-            WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//div[@class='product-availability-wrapper']//ul[@class='list-unstyled']//a")))
-            brand_element = self.driver.find_element(By.XPATH, "//div[@class='product-availability-wrapper']//ul[@class='list-unstyled']//a")
-            brand = brand_element.text
-        except NoSuchElementException:
-            brand = 'No brand'
-
-        # If price_sale is "Sin Stock" or does not exist, extract price from the product page
-        if price_sale == 'No sale price' or "Sin Stock" in price_sale:
-            try:
-                WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//div[@class='product-price']//div[@class='detail-price']")))
-                price = self.driver.find_element(By.XPATH, "//div[@class='product-price']//div[@class='detail-price']").text
-            except NoSuchElementException:
-                price = 'No price'
-        
-        self.driver.close()
-        self.driver.switch_to.window(self.driver.window_handles[0])
-        
-        return brand, product_url, product_name, price, price_sale, price_benef, sku
+        # La marca (y a veces el precio) se completa desde la página del producto en complete_details
+        return {'brand': None, 'url': product_url, 'name': product_name, 'price': price,
+                'price_sale': price_sale, 'price_benef': price_benef, 'code': sku}
 
     def extract_page_items(self, category):
-        products = self.driver.find_elements(By.XPATH, "//div[@class='item-content']")
-        for product in products:
-            loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-            brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_page_product_details(product)
-            loader.add_value('brand', brand)
-            loader.add_value('url', product_url)
-            loader.add_value('name', product_name)
-            loader.add_value('price', price)
-            loader.add_value('price_sale', price_sale)
-            loader.add_value('price_benef', price_benef)
-            loader.add_value('code', sku)
-            loader.add_value('category', category)
-            loader.add_value('timestamp', datetime.now())
-            loader.add_value('spider_name', self.name)
-            yield loader.load_item()
-
-    def extract_page_product_details(self, product):
-        try:
-            product_name_element = product.find_element(By.XPATH, ".//a[contains(@class, 'product-title')]")
-            product_url = product_name_element.get_attribute('href')
-            product_name = product_name_element.text
-        except NoSuchElementException:
-            product_url = 'No URL'
-            product_name = 'No name'
+        for fields in extract_products(page_response(self.driver), self.page_products_xpath, self.page_product_fields):
+            yield self.complete_details(self.extract_page_product_details(fields), category)
+
+    def extract_page_product_details(self, fields):
+        product_url = fields['url'] or 'No URL'
+        product_name = (fields['name'] or '') if fields['url'] else 'No name'
         
         # Extract prices and other details
-        try:
-            price_element = product.find_element(By.XPATH, ".//span[contains(@class, 'product-compare-price')]")
-            price = price_element.text
-            price_sale_element = product.find_element(By.XPATH, ".//span[contains(@class, 'product-price')]")
-            price_sale = price_sale_element.text
-        except NoSuchElementException:
+        if fields['compare_price'] and fields['price']:
+            price = fields['compare_price']
+            price_sale = fields['price']
+        else:
             price = 'No price'
             price_sale = 'No sale price'
 
         price_benef = '0'  
         sku = 'No SKU'  
-        
-        # Open product URL to extract additional information
-        self.driver.execute_script("window.open(arguments[0], '_blank');", product_url)
-        self.driver.switch_to.window(self.driver.window_handles[-1])
-        
-        try:
-            WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//div[@class='product-availability-wrapper']//ul[@class='list-unstyled']//a")))
-            brand_element = self.driver.find_element(By.XPATH, "//div[@class='product-availability-wrapper']//ul[@class='list-unstyled']//a")
-            brand = brand_element.text
-        except NoSuchElementException:
-            brand = 'No brand'
+        return {'brand': None, 'url': product_url, 'name': product_name, 'price': price,
+                'price_sale': price_sale, 'price_benef': price_benef, 'code': sku}
+
+    def needs_detail_price(self, details):
+        # Sin precio de oferta o "Sin Stock": el precio real solo está en la página del producto
+        return details['price_sale'] == 'No sale price' or "Sin Stock" in details['price_sale']
+
+    def complete_details(self, details, category):
+        # Con la marca ya conocida (caché) y el precio del listado no hace falta visitar el producto;
+        # si no, la página del producto se pide como request de Scrapy y se descarga en paralelo
+        details['brand'] = self.brand_cache.get(details['url'])
+        if details['url'] == 'No URL' or (details['brand'] and not self.needs_detail_price(details)):
+            details['brand'] = details['brand'] or 'No brand'
+            return self.build_item(details, category)
+        return scrapy.Request(details['url'], callback=self.parse_product_page, errback=self.product_page_failed,
+                              meta={'details': details, 'category': category}, dont_filter=True)
+
+    def parse_product_page(self, response):
+        details = response.meta['details']
+        brand = response.xpath("//div[@class='product-availability-wrapper']//ul[@class='list-unstyled']//a/text()").get()
+        if brand and brand.strip():
+            details['brand'] = brand.strip()
+            self.brand_cache[details['url']] = details['brand']
+        else:
+            details['brand'] = details['brand'] or 'No brand'
 
         # If price_sale is "Sin Stock" or does not exist, extract price from the product page
-        if price_sale == 'No sale price' or "Sin Stock" in price_sale:
-            try:
-                WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//div[@class='product-price']//div[@class='detail-price']")))
-                price = self.driver.find_element(By.XPATH, "//div[@class='product-price']//div[@class='detail-price']").text
-            except NoSuchElementException:
-                price = 'No price'
-        
-        self.driver.close()
-        self.driver.switch_to.window(self.driver.window_handles[0])
-        
-        return brand, product_url, product_name, price, price_sale, price_benef, sku
+        if self.needs_detail_price(details):
+            detail_price = response.xpath("normalize-space(//div[@class='product-price']//div[@class='detail-price'])").get()
+            details['price'] = detail_price or 'No price'
+        yield self.build_item(details, response.meta['category'])
+        if 'page' in response.meta:
+            self.detail_finished(response.request)
+
+    def product_page_failed(self, failure):
+        # Si la página del producto falla se guarda igual el ítem con los datos del listado
+        request = failure.request
+        details = request.meta['details']
+        self.logger.warning(f"Could not fetch product page {request.url}: {failure.getErrorMessage()}")
+        details['brand'] = details['brand'] or 'No brand'
+        yield self.build_item(details, request.meta['category'])
+        if 'page' in request.meta:
+            self.detail_finished(request)
+
+    def build_item(self, details, category):
+        return build_item({**details, 'category': category}, self.name)
+
+    def load_brand_cache(self):
+        try:
+            with open(self.brand_cache_file, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_brand_cache(self):
+        with open(self.brand_cache_file, 'w', encoding='utf-8') as file:
+            json.dump(self.brand_cache, file, ensure_ascii=False)
     
     def closed(self, reason):
-        self.driver.quit()
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        self.save_brand_cache()
+        self.logger.info(f"Saved {len(self.brand_cache)} cached brands to {self.brand_cache_file}")
+        release_driver(self.driver, self.settings)
@@ -1,30 +1,34 @@
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
-import time
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem 
+from ..items import build_items, details_record
+from ..drivers import acquire_driver, release_driver
+from ..waits import Waiter
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
+from ..extraction import extract_products, page_response
+from ..contentcache import page_items
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import ElementClickInterceptedException
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
 
 class LigaFarmaciaSpider(scrapy.Spider):
     name = 'ligafarmacia'
     allowed_domains = ['ligafarmacia.cl']
     start_urls = ['https://ligafarmacia.cl']
+    products_xpath = "//div[@class='product-wrap mb-25']"
+    # XPaths de cada campo, relativos a un producto del listado
+    product_fields = {
+        'url': "(.//a)[1]/@href",
+        'name': "normalize-space((.//p[contains(@class, 'nombre')])[1])",
+        'brand': "normalize-space((.//p[contains(@class, 'laboratorio')])[1])",
+        'price': "normalize-space((.//p[contains(@class, 'precio')])[1])",
+    }
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Uncomment for headless execution
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        self.driver = None  # Chrome se abre en parse, no al instanciar el spider
+        self.waiter = None
+        self.checkpoint = None
         self.categories = []
 
     def start_requests(self):
@@ -32,80 +36,71 @@ class LigaFarmaciaSpider(scrapy.Spider):
             yield scrapy.Request(url=url, callback=self.parse, dont_filter=True)
 
     def parse(self, response):
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
+        self.driver = self.driver or acquire_driver(self.settings)
         self.driver.get(response.url)
-        time.sleep(5)  # Wait for JavaScript to load contents
+        category_xpath = "//div[@class='container pt-40 pb-40']//div[@class='row']//div[contains(@class, 'contenedor-categoria')]//a[contains(@class, 'titulos-categoria')]"
+        self.waiter.element_present(category_xpath)
         
         # Extraer categorías y URLs
-        category_elements = self.driver.find_elements(By.XPATH, "//div[@class='container pt-40 pb-40']//div[@class='row']//div[contains(@class, 'contenedor-categoria')]//a[contains(@class, 'titulos-categoria')]")
+        category_elements = self.driver.find_elements(By.XPATH, category_xpath)
         for element in category_elements:
             category_name = element.text
             category_url = element.get_attribute('href')
             self.categories.append((category_name, category_url))
 
-        # Iterar sobre cada categoría y extraer los productos
-        for category_name, category_url in self.categories:
+        # Iterar sobre cada categoría y extraer los productos (con -a work_queue, solo las que tome este worker)
+        for category_name, category_url in claim_categories(self, self.categories, key=lambda category: category[1]):
+            if self.checkpoint.is_done(category_url):
+                continue
             self.driver.get(category_url)
-            time.sleep(5)  # Wait for JavaScript to load contents
+            self.waiter.product_count_stable(self.products_xpath, min_count=1)
             
+            page_number = 1  # La paginación es por JavaScript: la URL no cambia entre páginas
+            # Al retomar, las páginas ya emitidas antes de la interrupción solo se recorren
+            pages_done = self.checkpoint.pages_done(category_url)
             while True:
-                try:
-                    products = self.driver.find_elements(By.XPATH, "//div[@class='product-wrap mb-25']")
-                    if not products:
+                if page_number > pages_done:
+                    # Una sola foto del DOM por página en lugar de un find_element por campo y producto
+                    page = page_response(self.driver)
+                    # Si la página es idéntica a la del crawl anterior se re-emiten sus ítems sin parsearla
+                    items = page_items(self, f"{page.url}#{page_number}", page.body, lambda: build_items(
+                        [details_record(self.product_details(details), category_name)
+                         for details in extract_products(page, self.products_xpath, self.product_fields)], self.name))
+                    if not items:
                         print("No products found, breaking the loop.")
+                        self.checkpoint.category_done(category_url)
                         break
 
-                    for product in products:
-                        loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-                        brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_product_details(product)
-                        loader.add_value('brand', brand)
-                        loader.add_value('url', product_url)
-                        loader.add_value('name', product_name)
-                        loader.add_value('price', price)
-                        loader.add_value('price_sale', price_sale)
-                        loader.add_value('price_benef', price_benef)
-                        loader.add_value('code', sku)
-                        loader.add_value('category', category_name)
-                        loader.add_value('timestamp', datetime.now())
-                        loader.add_value('spider_name', self.name)
-                        yield loader.load_item()
-
-                except NoSuchElementException:
-                    print("No products found due to NoSuchElementException, breaking the loop.")
-                    break
+                    yield from items
+                    self.checkpoint.page_done(category_url, page_number, len(items))
 
                 # Navegación a la siguiente página
-                time.sleep(5)
                 self.scroll_to_pagination()
-                time.sleep(5)
                 next_page_button = self.get_next_page_button()
                 if next_page_button:
                     try:
+                        previous_page = self.waiter.snapshot(self.products_xpath)
                         self.driver.execute_script("arguments[0].click();", next_page_button)
-                        time.sleep(5)  # Espera a que la página se cargue
+                        # La paginación es por JavaScript: esperar a que cambien los productos y se estabilicen
+                        self.waiter.content_changed(self.products_xpath, previous_page)
+                        self.waiter.product_count_stable(self.products_xpath, min_count=1)
+                        page_number += 1
                     except Exception as e:
                         print(f"Error clicking next page button: {str(e)}")
+                        self.checkpoint.mark_failed(category_url)
                         break
                 else:
                     print("No more pages to navigate.")
+                    self.checkpoint.category_done(category_url)
                     break
 
-    def extract_product_details(self, product):
-        try:
-            product_url = product.find_element(By.XPATH, ".//a").get_attribute('href')
-        except NoSuchElementException:
-            product_url = 'No URL'
-        try:
-            product_name = product.find_element(By.XPATH, ".//p[contains(@class, 'nombre')]").text
-        except NoSuchElementException:
-            product_name = 'No name'
-        try:
-            brand = product.find_element(By.XPATH, ".//p[contains(@class, 'laboratorio')]").text
-        except NoSuchElementException:
-            brand = 'No brand'
-        try:
-            price = product.find_element(By.XPATH, ".//p[contains(@class, 'precio')]").text
-        except NoSuchElementException:
-            price = 'No price'
+    def product_details(self, details):
+        product_url = details['url'] or 'No URL'
+        product_name = details['name'] or 'No name'
+        brand = details['brand'] or 'No brand'
+        price = details['price'] or 'No price'
         price_benef = '0'  # Adjust this XPath to retrieve benefit price if available
         price_sale = '0'  # Adjust this XPath to retrieve benefit price if available
         sku = 'No SKU'  # Adjust this XPath to retrieve sku price if available
@@ -115,8 +110,9 @@ class LigaFarmaciaSpider(scrapy.Spider):
         try:
             pagination_element = self.driver.find_element(By.XPATH, "//div[contains(@class, 'pagination')]")
             self.driver.execute_script("arguments[0].scrollIntoView(true);", pagination_element)
-            WebDriverWait(self.driver, 10).until(EC.visibility_of(pagination_element))
-        except (NoSuchElementException, TimeoutException):
+            if not self.waiter.until(EC.visibility_of(pagination_element), 'pagination_visible'):
+                print("Pagination element not visible.")
+        except NoSuchElementException:
             print("Pagination element not found or not visible.")
 
     def get_next_page_button(self):
@@ -129,4 +125,6 @@ class LigaFarmaciaSpider(scrapy.Spider):
             return None
     
     def closed(self, reason):
-        self.driver.quit()
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        release_driver(self.driver, self.settings)
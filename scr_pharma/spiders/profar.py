@@ -1,26 +1,46 @@
+import re
+import json
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
+from urllib.parse import urlparse
 from selenium.common.exceptions import NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
-import time
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem
+from ..items import build_items, details_record
+from ..drivers import acquire_driver, release_driver
+from ..waits import Waiter
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
+from ..extraction import extract_products, page_response
+from ..contentcache import page_items
+from ..helpers import number_to_price
 
 class ProfarSpider(scrapy.Spider):
     name = 'profar'
     allowed_domains = ['profar.cl']
     start_urls = ['https://www.profar.cl']
+    # El backend VTEX pagina la API de catálogo: varias requests en paralelo
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.25,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    }
+    page_size = 50  # Máximo de productos por request que acepta la API de catálogo de VTEX
+    max_offset = 2500  # VTEX rechaza _from mayores a este valor
+    products_xpath = "//section[contains(@class, 'product-summary')]"
+    # XPaths de cada campo, relativos a un producto del listado
+    product_fields = {
+        'url': "(.//a)[1]/@href",
+        'name': "normalize-space((.//article//div[12]//span)[1])",
+        'price': "normalize-space((.//article//div[14]//span[contains(@class,'sellingPriceValue')])[1])",
+        'price_sale': "normalize-space((.//article//div[14]//span[contains(@class,'listPriceValue')])[1])",
+        'price_without_stock': "normalize-space((.//div[contains(@class, 'priceWithoutStock')]//span)[1])",
+    }
+    load_more_xpath = "//button[contains(@class, 'vtex-button bw1 ba fw5 v-mid relative pa0 lh-solid br2 min-h-small t-action--small bg-action-primary b--action-primary c-on-action-primary hover-bg-action-primary hover-b--action-primary hover-c-on-action-primary pointer')]"
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, backend='vtex', *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Uncomment for headless execution
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        # backend='vtex': API de catálogo de VTEX; backend='selenium': recorrer la UI con Chrome
+        self.backend = backend
+        self.driver = None
+        self.waiter = None
+        self.checkpoint = None
         self.categories = [
             'dermocosmetica',
             'medicamentos',            
@@ -29,106 +49,169 @@ class ProfarSpider(scrapy.Spider):
             'salud-animal'
             ]
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.api_url = crawler.settings.get('PROFAR_API_URL', 'https://www.profar.cl').rstrip('/')
+        # Permitir un servidor local con respuestas grabadas
+        api_host = urlparse(spider.api_url).hostname
+        if api_host and not api_host.endswith('profar.cl'):
+            spider.allowed_domains = spider.allowed_domains + [api_host]
+        return spider
+
     def start_requests(self):
-        for url in self.start_urls:
-            yield scrapy.Request(url=url, callback=self.parse, dont_filter=True)
+        if self.backend == 'selenium':
+            for url in self.start_urls:
+                yield scrapy.Request(url=url, callback=self.parse, dont_filter=True)
+            return
+        for category in self.categories:
+            yield self.search_request(category, 0)
+
+    def search_request(self, category, offset):
+        # _from y _to son inclusivos: _from=0&_to=49 devuelve los primeros 50 productos
+        url = (f"{self.api_url}/api/catalog_system/pub/products/search/{category}"
+               f"?_from={offset}&_to={offset + self.page_size - 1}")
+        return scrapy.Request(
+            url,
+            callback=self.parse_search,
+            headers={'Accept': 'application/json'},
+            meta={'category': category, 'offset': offset, 'content_cache': True},
+            dont_filter=True,
+        )
+
+    def parse_search(self, response):
+        category = response.meta['category']
+
+        # La primera página trae el total en el header "resources: 0-49/1234": el resto se pide en paralelo
+        if response.meta['offset'] == 0:
+            total = self.total_resources(response)
+            if total > self.max_offset + self.page_size:
+                self.logger.warning(f"VTEX only pages the first {self.max_offset + self.page_size} of {total} products for {category}")
+            for offset in range(self.page_size, min(total, self.max_offset + 1), self.page_size):
+                yield self.search_request(category, offset)
+
+        yield from build_items([self.product_record(product, category) for product in json.loads(response.text)], self.name)
+
+    def total_resources(self, response):
+        resources = response.headers.get('resources', b'').decode()
+        try:
+            return int(resources.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return 0
+
+    def product_record(self, product, category):
+        product_url = product.get('link') or 'No URL'
+        # Mismo SKU que el backend Selenium: sufijo numérico del slug (.../<nombre>-<sku>/p)
+        sku_match = re.search(r'-(\d+)$', product.get('linkText') or '')
+        sku = sku_match.group(1) if sku_match else str(product.get('productReference') or 'No SKU')
+
+        item = (product.get('items') or [{}])[0]
+        offer = ((item.get('sellers') or [{}])[0]).get('commertialOffer', {})
+        price = number_to_price(offer.get('Price'))
+        list_price = offer.get('ListPrice') or 0
+        # Como en la UI: price_sale es el precio "normal" tachado, solo si hay descuento
+        price_sale = number_to_price(list_price) if list_price > (offer.get('Price') or 0) else '0'
+        if not offer.get('AvailableQuantity') and price == '0':
+            # Sin stock VTEX deja Price en 0; la UI muestra el precio sin stock y no el SKU
+            price = number_to_price(offer.get('PriceWithoutDiscount'))
+            price_sale = '0'
+            sku = 'No SKU'
+
+        return {
+            'brand': product.get('brand') or self.name,
+            'url': product_url,
+            'name': product.get('productName') or 'No name',
+            'price': price,
+            'price_sale': price_sale,
+            'price_benef': '0',
+            'code': sku,
+            'category': category,
+        }
 
     def parse(self, response):
+        self.driver = self.driver or acquire_driver(self.settings)
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
         self.driver.get(response.url)
         base_url = 'https://www.profar.cl/'
-        time.sleep(5)  # Esperar a que se cargue el JavaScript
-        for category in self.categories:
+        self.waiter.page_ready()
+        for category in claim_categories(self, self.categories):
+            # El "Mostrar más" no se puede retomar a mitad de camino: el checkpoint es por categoría
+            if self.checkpoint.is_done(category):
+                continue
             url = f"{base_url}{category}"
             self.driver.get(url)
-            time.sleep(5)  # Esperar a que se cargue el JavaScript
+            self.waiter.product_count_stable(self.products_xpath, min_count=1)
             
             current_url = self.driver.current_url  # Almacenar la URL actual
             while True:
-                self.scroll_to_pagination()  # Desplazarse al botón de paginación y hacer clic
-                time.sleep(2)  # Esperar a que carguen los productos
+                clicked = self.scroll_to_pagination()  # Desplazarse al botón de paginación y hacer clic
                 
-                new_url = self.driver.current_url  # Obtener la nueva URL después del clic
-                if current_url == new_url:
+                # El clic en "Mostrar más" agrega ?page=N a la URL; si no cambia, no hay más páginas
+                if not clicked or not self.waiter.url_changed(current_url):
                     print("URL has not changed after clicking 'Show more', stopping pagination.")
                     break  # Si la URL no cambia, detener la paginación
-                else:
-                    current_url = new_url  # Actualizar la URL actual para la siguiente iteración
+                current_url = self.driver.current_url  # Actualizar la URL actual para la siguiente iteración
                 
-                # Desplazarse de nuevo al inicio de la página para asegurar que todos los elementos estén cargados
-                self.driver.execute_script("window.scrollTo(0, 0);")
-                time.sleep(2)  # Dar tiempo para que el scroll y la carga se completen
-
-            # Extracción de productos después de asegurar que todos los elementos estén visibles
-            products_after_click = self.driver.find_elements(By.XPATH, "//section[contains(@class, 'product-summary')]")
-            for product in products_after_click:
-                loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-                brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_product_details(product)
-                loader.add_value('brand', brand)
-                loader.add_value('url', product_url)
-                loader.add_value('name', product_name)
-                loader.add_value('price', price)
-                loader.add_value('price_sale', price_sale)
-                loader.add_value('price_benef', price_benef)
-                loader.add_value('code', sku)
-                loader.add_value('category', category)
-                loader.add_value('timestamp', datetime.now())
-                loader.add_value('spider_name', self.name)
-                yield loader.load_item()
+                # Esperar a que se agreguen los productos de la nueva página
+                self.waiter.product_count_stable(self.products_xpath, min_count=1)
+
+            # Extracción de productos después de asegurar que todos los elementos estén visibles,
+            # con una sola foto del DOM en lugar de un find_element por campo y producto
+            # Si la categoría completa es idéntica a la del crawl anterior se re-emiten sus ítems sin parsearla
+            page = page_response(self.driver)
+            items = page_items(self, page.url, page.body, lambda: build_items(
+                [details_record(self.product_details(details), category)
+                 for details in extract_products(page, self.products_xpath, self.product_fields)], self.name))
+            yield from items
+            self.checkpoint.page_done(category, page.url, len(items))
+            self.checkpoint.category_done(category)
 
     def scroll_to_pagination(self):
         try:
             # Desplazarse al final de la página primero para cargar todos los elementos
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(2)  # Esperar a que se carguen todos los productos
             
-            # Luego, localizar el botón de cargar más resultados
-            load_more_button = self.driver.find_element(By.XPATH, "//button[contains(@class, 'vtex-button bw1 ba fw5 v-mid relative pa0 lh-solid br2 min-h-small t-action--small bg-action-primary b--action-primary c-on-action-primary hover-bg-action-primary hover-b--action-primary hover-c-on-action-primary pointer')]")
+            # Luego, localizar el botón de cargar más resultados; los productos ya están cargados,
+            # así que si no aparece pronto es porque no quedan más páginas
+            load_more_button = self.waiter.element_present(self.load_more_xpath, timeout=2)
+            if not load_more_button:
+                raise NoSuchElementException(self.load_more_xpath)
             
             # Hacer scroll hasta el botón
             self.driver.execute_script("arguments[0].scrollIntoView(true);", load_more_button)
-            time.sleep(2)  # Pequeña espera para asegurar que el scroll se ha completado
 
             # Hacer clic en el botón
             self.driver.execute_script("arguments[0].click();", load_more_button)
+            return True
         except NoSuchElementException:
             print("Load more button not found.")
+            return False
 
                 
-    def extract_product_details(self, product):
-        try:
-            product_url = product.find_element(By.XPATH, ".//a").get_attribute('href')
+    def product_details(self, details):
+        if details['url']:
+            product_url = details['url']
             sku_part = product_url.split('/')[-2].split('-')[-1]
             # Check if SKU is numeric
             sku = sku_part if sku_part.isnumeric() else 'No SKU'
-        except NoSuchElementException:
+        else:
             product_url = 'No URL'
             sku = 'No SKU'
-        try:
-            product_name = product.find_element(By.XPATH, ".//article//div[12]//span").text
-        except NoSuchElementException:
-            product_name = 'No name'
-
-        # Try to find the normal price or sale price
-        try:
-            price = product.find_element(By.XPATH, ".//article//div[14]//span[contains(@class,'sellingPriceValue')]").text
-        except NoSuchElementException:
-            price = '0'
-        try:
-            price_sale = product.find_element(By.XPATH, ".//article//div[14]//span[contains(@class,'listPriceValue')]").text
-        except NoSuchElementException:
-            price_sale = '0'
+        product_name = details['name'] or 'No name'
+        price = details['price'] or '0'
+        price_sale = details['price_sale'] or '0'
 
         # Fallback for price if both normal and sale prices are missing
         if price == '0' and price_sale == '0':
             sku = 'No SKU'
-            try:
-                price = product.find_element(By.XPATH, "//div[contains(@class, 'priceWithoutStock')]//span").text
-            except NoSuchElementException:
-                price = '0'
+            price = details['price_without_stock'] or '0'
 
         price_benef = '0'  # Adjust this XPath to retrieve benefit price if available
         brand = self.name
         return brand, product_url, product_name, price, price_sale, price_benef, sku
     
     def closed(self, reason):
-        self.driver.quit()
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        release_driver(self.driver, self.settings)
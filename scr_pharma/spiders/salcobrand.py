@@ -1,32 +1,59 @@
 import scrapy
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
-from webdriver_manager.chrome import ChromeDriverManager
-import time
-from scrapy.loader import ItemLoader
-from datetime import datetime
-from ..items import ScrPharmaItem 
+from ..items import build_items, details_record
+from ..drivers import acquire_driver, release_driver
+from ..waits import Waiter
+from ..checkpoints import Checkpoint
+from ..workqueue import claim_categories
+from ..extraction import extract_products, page_response
+from ..contentcache import page_items
+from ..helpers import number_to_price
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import ElementClickInterceptedException
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import Select
 
 
+import json
 import urllib.parse
 class SalcobrandSpider(scrapy.Spider):
     name = 'salcobrand'
     allowed_domains = ['salcobrand.cl']
+    # El backend Algolia consulta el índice de búsqueda directamente: varias requests en paralelo
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.25,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+    }
+    hits_per_page = 1000  # Máximo permitido por Algolia
+    products_xpath = "//div[contains(@class, 'product clickable')]"
+    # XPaths de cada campo, relativos a un producto del listado
+    product_fields = {
+        'brand': "normalize-space((.//div[contains(@class, 'info')]//a//span[contains(@class, 'product-name truncate')])[1])",
+        'url': "(.//a)[1]/@href",
+        'name': "normalize-space((.//div[contains(@class, 'info')]//a//span[contains(@class, 'product-info')])[1])",
+        'internet_sale_price': "normalize-space((.//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'internet-sale-price')]//span)[1])",
+        'secondary_sale_price': "normalize-space((.//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'sale-price secondary-price')]//span)[1])",
+        'sale_price': "normalize-space((.//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'sale-price')]//span)[1])",
+        'original_price': "normalize-space((.//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'original-price')]//span)[1])",
+    }
+    # Atributos de cada hit de Algolia que se copian a ScrPharmaItem
+    algolia_fields = {
+        'name': 'name',
+        'brand': 'brand',
+        'slug': 'slug',
+        'code': 'default_sku',
+        'price': 'normal_price',
+        'price_sale': 'sale_price',
+        'price_benef': 'internet_sale_price',
+    }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, backend='algolia', *args, **kwargs):
         super().__init__(*args, **kwargs)
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")  # Uncomment for headless execution
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        # backend='algolia': consultar el índice de búsqueda; backend='selenium': recorrer la UI con Chrome
+        self.backend = backend
+        self.driver = None
+        self.waiter = None
+        self.checkpoint = None
         self.categories = [
             'adulto-mayor',
             'vitaminas-y-suplementos',
@@ -45,19 +72,17 @@ class SalcobrandSpider(scrapy.Spider):
             pagination_element = self.driver.find_element(By.XPATH, "//nav[contains(@class, 'paginator')]")
             self.driver.execute_script("arguments[0].scrollIntoView(true);", pagination_element)
             # Use explicit wait to ensure the pagination is ready for interaction
-            WebDriverWait(self.driver, 10).until(
-                EC.visibility_of(pagination_element)
-            )
+            if not self.waiter.until(EC.visibility_of(pagination_element), 'pagination_visible'):
+                print("Pagination element not visible after waiting.")
         except NoSuchElementException:
             print("Pagination element not found, maybe it's a single page without pagination.")
-        except TimeoutException:
-            print("Pagination element not visible after 10 seconds.")
     def select_max_results_per_page(self):
         try:
             # Espera a que el elemento select esté presente
-            select_element = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, "//select[contains(@class, 'ais-HitsPerPage-select')]"))
-            )
+            select_element = self.waiter.element_present("//select[contains(@class, 'ais-HitsPerPage-select')]")
+            if not select_element:
+                print("No se encontró el selector de resultados por página.")
+                return
             
             # Crea un objeto Select
             select = Select(select_element)
@@ -65,56 +90,177 @@ class SalcobrandSpider(scrapy.Spider):
             # Selecciona la última opción
             select.select_by_index(len(select.options) - 1)
             
-            # Espera a que la página se actualice
-            time.sleep(5)
+            # Espera a que InstantSearch termine la consulta y se estabilice la grilla
+            self.waiter.network_idle()
+            self.waiter.product_count_stable(self.products_xpath)
             
             print("Seleccionado el máximo número de resultados por página.")
         except Exception as e:
             print(f"Error al seleccionar el máximo número de resultados por página: {str(e)}")
             
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        spider.algolia_app_id = settings.get('SALCOBRAND_ALGOLIA_APP_ID')
+        spider.algolia_api_key = settings.get('SALCOBRAND_ALGOLIA_API_KEY')
+        spider.algolia_index = settings.get('SALCOBRAND_ALGOLIA_INDEX')
+        spider.algolia_category_attribute = settings.get('SALCOBRAND_ALGOLIA_CATEGORY_ATTRIBUTE', 'categories')
+        spider.algolia_split_attribute = settings.get('SALCOBRAND_ALGOLIA_SPLIT_ATTRIBUTE', 'brand')
+        spider.algolia_pagination_limit = settings.getint('SALCOBRAND_ALGOLIA_PAGINATION_LIMIT', 1000)
+        # Los nombres de los atributos dependen del índice: se pueden corregir sin tocar el spider
+        spider.algolia_fields = {**cls.algolia_fields, **settings.getdict('SALCOBRAND_ALGOLIA_FIELDS')}
+        spider.algolia_url = (settings.get('SALCOBRAND_ALGOLIA_URL')
+                              or f"https://{spider.algolia_app_id}-dsn.algolia.net").rstrip('/')
+        algolia_host = urllib.parse.urlparse(spider.algolia_url).hostname
+        if algolia_host:
+            spider.allowed_domains = spider.allowed_domains + [algolia_host]
+        return spider
+
     def start_requests(self):
-        yield scrapy.Request(url='https://salcobrand.cl', callback=self.parse, dont_filter=True)
-          
+        if self.backend == 'algolia' and not (self.algolia_app_id and self.algolia_api_key and self.algolia_index):
+            self.logger.warning("Algolia credentials are not configured, falling back to the Selenium backend")
+            self.backend = 'selenium'
+        if self.backend == 'selenium':
+            yield scrapy.Request(url='https://salcobrand.cl', callback=self.parse, dont_filter=True)
+            return
+        for category in self.categories:
+            yield self.algolia_request(category, 0)
+
+    def algolia_request(self, category, page, split_value=None):
+        facet_filters = [[facet_filter(self.algolia_category_attribute, category)]]
+        if split_value is not None:
+            facet_filters.append([facet_filter(self.algolia_split_attribute, split_value)])
+        query = {
+            'query': '',
+            'hitsPerPage': self.hits_per_page,
+            'page': page,
+            'facetFilters': json.dumps(facet_filters),
+        }
+        if page == 0 and split_value is None:
+            # Cantidad de hits por valor de split_attribute, por si la categoría hay que partirla
+            query.update({'facets': json.dumps([self.algolia_split_attribute]), 'maxValuesPerFacet': 1000})
+        params = urllib.parse.urlencode(query)
+        return scrapy.Request(
+            f"{self.algolia_url}/1/indexes/{self.algolia_index}/query",
+            method='POST',
+            body=json.dumps({'params': params}),
+            headers={
+                'Content-Type': 'application/json',
+                'X-Algolia-Application-Id': self.algolia_app_id,
+                'X-Algolia-API-Key': self.algolia_api_key,
+            },
+            callback=self.parse_algolia,
+            meta={'category': category, 'page': page, 'split_value': split_value, 'content_cache': True},
+            dont_filter=True,
+        )
+
+    def parse_algolia(self, response):
+        data = json.loads(response.text)
+        category = response.meta['category']
+        split_value = response.meta.get('split_value')
+
+        if response.meta['page'] == 0:
+            nb_hits = data.get('nbHits', 0)
+            # Algolia no entrega más de paginationLimitedTo hits por consulta (1000 por defecto), sin
+            # importar hitsPerPage: una categoría más grande se parte en una consulta por valor de
+            # split_attribute (la marca) y los hits de esta página se descartan, porque se repetirían
+            if nb_hits > self.algolia_pagination_limit and split_value is None:
+                yield from self.split_category(category, data)
+                return
+            if nb_hits > self.algolia_pagination_limit:
+                self.logger.error(f"Algolia query for {category} / {split_value} has {nb_hits} hits; only "
+                                  f"{self.algolia_pagination_limit} can be retrieved")
+                self.crawler.stats.inc_value('algolia/truncated_hits', nb_hits - self.algolia_pagination_limit)
+            self.check_fields(data.get('hits', []))
+            # La primera página trae nbPages: el resto se pide de una vez, en paralelo
+            for page in range(1, data.get('nbPages', 0)):
+                yield self.algolia_request(category, page, split_value)
+
+        yield from build_items([self.hit_record(hit, category) for hit in data.get('hits', [])], self.name)
+
+    def split_category(self, category, data):
+        counts = data.get('facets', {}).get(self.algolia_split_attribute, {})
+        # Hits sin valor en split_attribute, o valores más allá de maxValuesPerFacet, no se pueden pedir
+        missing = data.get('nbHits', 0) - sum(counts.values())
+        if missing > 0:
+            self.logger.error(f"Splitting {category} by {self.algolia_split_attribute} misses {missing} of "
+                              f"{data['nbHits']} hits; set SALCOBRAND_ALGOLIA_SPLIT_ATTRIBUTE to a facet every hit has")
+            self.crawler.stats.inc_value('algolia/truncated_hits', missing)
+        self.logger.info(f"Splitting {category} ({data.get('nbHits')} hits) into {len(counts)} queries by {self.algolia_split_attribute}")
+        for value in counts:
+            yield self.algolia_request(category, 0, value)
+
+    def check_fields(self, hits):
+        # Si ningún hit trae los atributos de algolia_fields, el índice usa otros nombres: mejor
+        # avisar que guardar productos sin URL ni precio
+        if not hits:
+            return
+        absent = [field for field, attribute in self.algolia_fields.items()
+                  if field in ('slug', 'price') and not any(attribute in hit for hit in hits)]
+        if absent:
+            self.logger.error(f"Algolia hits have no {', '.join(self.algolia_fields[field] for field in absent)} "
+                              f"attribute; fix SALCOBRAND_ALGOLIA_FIELDS (hit attributes: {sorted(hits[0])})")
+            self.crawler.stats.inc_value('algolia/unmapped_pages')
+
+    def hit_record(self, hit, category):
+        fields = self.algolia_fields
+        slug = hit.get(fields['slug'])
+        price, price_sale = number_to_price(hit.get(fields['price'])), number_to_price(hit.get(fields['price_sale']))
+        # Misma convención que product_details (backend Selenium): price es el precio normal y
+        # price_sale solo trae valor si es menor
+        if price == '0':
+            price, price_sale = price_sale, '0'
+        elif int(price_sale) >= int(price):
+            price_sale = '0'
+        return {
+            'brand': hit.get(fields['brand']) or 'No brand',
+            'url': f"https://salcobrand.cl/products/{slug}" if slug else 'No URL',
+            'name': hit.get(fields['name']) or 'No name',
+            'price': price,
+            'price_sale': price_sale,
+            'price_benef': number_to_price(hit.get(fields['price_benef'])),
+            'code': str(hit.get(fields['code']) or 'No SKU'),
+            'category': category,
+        }
+
     def parse(self, response):
+        self.driver = self.driver or acquire_driver(self.settings)
+        self.waiter = self.waiter or Waiter(self)
+        self.checkpoint = self.checkpoint or Checkpoint(self)
         self.driver.get(response.url)
         base_url = 'https://salcobrand.cl/t/'
 
-        for category in self.categories:
+        for category in claim_categories(self, self.categories):
+            if self.checkpoint.is_done(category):
+                continue
             url = f"{base_url}{category}"
             self.driver.get(url)
-            time.sleep(5)  # Wait for JavaScript to load contents
+            self.waiter.product_count_stable(self.products_xpath, min_count=1)
             
             # Selecciona el máximo número de resultados por página
             
             self.select_max_results_per_page()
             
+            page_number = 1  # La paginación es por JavaScript: la URL no cambia entre páginas
+            # Al retomar, las páginas ya emitidas antes de la interrupción solo se recorren
+            pages_done = self.checkpoint.pages_done(category)
             while True:  
-                try:
-                    
-                    products = self.driver.find_elements(By.XPATH, "//div[contains(@class, 'product clickable')]")
+                if page_number > pages_done:
+                    # Una sola foto del DOM por página en lugar de un find_element por campo y producto
+                    page = page_response(self.driver)
+                    # Si la página es idéntica a la del crawl anterior se re-emiten sus ítems sin parsearla
+                    items = page_items(self, f"{page.url}#{page_number}", page.body, lambda: build_items(
+                        [details_record(self.product_details(details), category)
+                         for details in extract_products(page, self.products_xpath, self.product_fields)], self.name))
                     
-                    if not products:
+                    if not items:
                         print(f"No products found for category {category}, breaking the loop.")
+                        self.checkpoint.category_done(category)
                         break
                     
-                    for product in products:
-                        loader = ItemLoader(item=ScrPharmaItem(), selector=product)
-                        brand, product_url, product_name, price, price_sale, price_benef, sku = self.extract_product_details(product)
-                        loader.add_value('brand', brand)
-                        loader.add_value('url', product_url)
-                        loader.add_value('name', product_name)
-                        loader.add_value('price', price)
-                        loader.add_value('price_sale', price_sale)
-                        loader.add_value('price_benef', price_benef)
-                        loader.add_value('code', sku)
-                        loader.add_value('category', category)
-                        loader.add_value('timestamp', datetime.now())
-                        loader.add_value('spider_name', self.name)
-                        yield loader.load_item()
-                
-                except NoSuchElementException:
-                    print(f"No products found due to NoSuchElementException for category {category}, breaking the loop.")
-                    break
+                    yield from items
+                    self.checkpoint.page_done(category, page_number, len(items))
                 
                 # Desplaza hasta el final antes de buscar el botón de la próxima página
                 self.scroll_to_pagination()
@@ -124,64 +270,49 @@ class SalcobrandSpider(scrapy.Spider):
                 if next_page_button:
                     try:
                         self.driver.execute_script("arguments[0].scrollIntoView(true);", next_page_button)
-                        WebDriverWait(self.driver, 10).until(
-                            EC.element_to_be_clickable(next_page_button)
-                        )
+                        self.waiter.until(EC.element_to_be_clickable(next_page_button), 'next_page_clickable')
+                        previous_page = self.waiter.snapshot(self.products_xpath)
                         self.driver.execute_script("arguments[0].click();", next_page_button)
-                        time.sleep(5)  # Espera a que la página se cargue
+                        # Espera a que la página cambie y termine de cargar
+                        self.waiter.content_changed(self.products_xpath, previous_page)
+                        self.waiter.product_count_stable(self.products_xpath, min_count=1)
+                        page_number += 1
                     except Exception as e:
                         print(f"Error al hacer clic en el botón de siguiente página: {str(e)}")
+                        self.checkpoint.mark_failed(category)
                         break
                 else:
                     print("No más páginas para navegar.")
+                    self.checkpoint.category_done(category)
                     break
 
-    def extract_product_details(self, product):
-        try:
-            brand = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//span[contains(@class, 'product-name truncate')]").text
-        except NoSuchElementException:
-            brand = 'No brand'
-        try:
-            product_url = product.find_element(By.XPATH, ".//a").get_attribute('href')
-            product_name = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//span[contains(@class, 'product-info')]").text
-            parsed_url = urllib.parse.urlparse(product_url)
+    def product_details(self, details):
+        brand = details['brand'] or 'No brand'
+        if details['url'] and details['name']:
+            parsed_url = urllib.parse.urlparse(details['url'])
             params = urllib.parse.parse_qs(parsed_url.query)
             sku = params.get('default_sku', [''])[0]
             product_url = urllib.parse.urlunparse(parsed_url._replace(query=''))
-        except NoSuchElementException:
+            product_name = details['name']
+        else:
             product_url = 'No URL'
             product_name = 'No name'
             sku = 'No SKU'
-        
-        try:
-            price_benef = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'internet-sale-price')]//span").text
-        except NoSuchElementException:
-            price_benef = '0'
-        
+
+        # Misma convención que hit_record (backend Algolia): price es el precio normal y price_sale o
+        # price_benef solo traen valor si hay descuento; si no, al cambiar de backend cada producto
+        # sin oferta parecería un cambio de precio
+        price_benef = details['internet_sale_price'] or '0'
         if price_benef != '0':
-            try:
-                price_sale = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'sale-price secondary-price')]//span").text
-            except NoSuchElementException:
-                price_sale = '0'
-            try:
-                price = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'original-price')]//span").text
-            except NoSuchElementException:
-                price = '0'
+            price_sale = details['secondary_sale_price'] or '0'
+            price = details['original_price'] or '0'
+        elif details['original_price']:
+            price = details['original_price']
+            price_sale = details['sale_price'] or '0'
         else:
-            try:
-                price_sale = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'sale-price')]//span").text
-            except NoSuchElementException:
-                price_sale = '0'
-            if price_sale == '0':
-                try:
-                    price = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'sale-price')]//span").text
-                except NoSuchElementException:
-                    price = '0'
-            else:
-                try:
-                    price = product.find_element(By.XPATH, ".//div[contains(@class, 'info')]//a//div[contains(@class, 'product-prices')]//div[contains(@class, 'original-price')]//span").text
-                except NoSuchElementException:
-                    price = '0'
+            # Sin oferta la tarjeta muestra un solo precio, en sale-price: es el precio normal
+            price = details['sale_price'] or '0'
+            price_sale = '0'
 
         return brand, product_url, product_name, price, price_sale, price_benef, sku
     
@@ -194,4 +325,14 @@ class SalcobrandSpider(scrapy.Spider):
         except NoSuchElementException:
             return None
     def closed(self, reason):
-        self.driver.quit()
\ No newline at end of file
+        if self.checkpoint is not None:
+            self.checkpoint.close(reason)
+        release_driver(self.driver, self.settings)
+
+
+def facet_filter(attribute, value):
+    # En facetFilters un valor que empieza con '-' es una negación: se escapa
+    value = str(value)
+    if value.startswith('-'):
+        value = '\\' + value
+    return f"{attribute}:{value}"
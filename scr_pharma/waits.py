@@ -0,0 +1,128 @@
+import time
+import logging
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+logger = logging.getLogger(__name__)
+
+
+# Condiciones reutilizables: callables que reciben el driver y devuelven un valor "verdadero"
+# cuando se cumplen, igual que las de selenium.webdriver.support.expected_conditions
+
+def page_ready():
+    def condition(driver):
+        return driver.execute_script("return document.readyState") == 'complete'
+    return condition
+
+
+def element_present(xpath):
+    def condition(driver):
+        elements = driver.find_elements(By.XPATH, xpath)
+        return elements[0] if elements else False
+    return condition
+
+
+def url_changed(previous_url):
+    def condition(driver):
+        return driver.current_url != previous_url
+    return condition
+
+
+def content_changed(xpath, previous_snapshot):
+    # Para paginaciones por JavaScript: el primer elemento de la lista cambió respecto al snapshot
+    def condition(driver):
+        return snapshot(driver, xpath) != previous_snapshot
+    return condition
+
+
+def product_count_stable(xpath, stable_for=1.0, min_count=0):
+    # La cantidad de productos no cambia durante stable_for segundos con la página ya cargada
+    state = {'count': None, 'since': None}
+
+    def condition(driver):
+        if driver.execute_script("return document.readyState") != 'complete':
+            state['count'] = None
+            return False
+        count = len(driver.find_elements(By.XPATH, xpath))
+        now = time.monotonic()
+        if count != state['count']:
+            state['count'], state['since'] = count, now
+            return False
+        return count >= min_count and now - state['since'] >= stable_for
+    return condition
+
+
+def network_idle(idle_for=1.0):
+    # Ninguna request nueva (XHR, fetch, imágenes...) durante idle_for segundos
+    state = {'count': None, 'since': None}
+
+    def condition(driver):
+        count = driver.execute_script("return window.performance.getEntriesByType('resource').length")
+        now = time.monotonic()
+        if count != state['count']:
+            state['count'], state['since'] = count, now
+            return False
+        return now - state['since'] >= idle_for
+    return condition
+
+
+def snapshot(driver, xpath):
+    # Texto y href del primer elemento; se lee con JavaScript para no quedar con referencias obsoletas
+    return driver.execute_script(
+        "var node = document.evaluate(arguments[0], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;"
+        "if (!node) { return null; }"
+        "var link = node.querySelector('a');"
+        "return [node.textContent, link ? link.href : null];", xpath)
+
+
+class Waiter:
+    """Esperas por condición para los spiders Selenium, en lugar de time.sleep fijos.
+
+    El timeout sale de WAIT_TIMEOUTS[spider] o WAIT_TIMEOUT. Si se agota, la espera
+    devuelve False y el spider sigue, como hacía el sleep. Cada espera registra su
+    duración en las stats del crawler (waits/<nombre>/count, /seconds y /timeouts)."""
+
+    def __init__(self, spider):
+        self.spider = spider
+        settings = spider.settings
+        self.timeout = settings.getdict('WAIT_TIMEOUTS').get(spider.name, settings.getfloat('WAIT_TIMEOUT', 10))
+        self.poll_interval = settings.getfloat('WAIT_POLL_INTERVAL', 0.25)
+        self.stable_for = settings.getfloat('WAIT_STABLE_SECONDS', 1.0)
+        self.stats = spider.crawler.stats
+
+    def until(self, condition, name, timeout=None):
+        start = time.monotonic()
+        timeout = timeout or self.timeout
+        try:
+            result = WebDriverWait(self.spider.driver, timeout, poll_frequency=self.poll_interval).until(condition)
+        except (TimeoutException, WebDriverException) as e:
+            result = False
+            self.stats.inc_value(f'waits/{name}/timeouts')
+            logger.debug(f"Wait '{name}' gave up after {timeout}s: {e.__class__.__name__}")
+        elapsed = time.monotonic() - start
+        self.stats.inc_value(f'waits/{name}/count')
+        self.stats.inc_value(f'waits/{name}/seconds', round(elapsed, 3))
+        self.stats.max_value(f'waits/{name}/max_seconds', round(elapsed, 3))
+        return result
+
+    def page_ready(self, timeout=None):
+        return self.until(page_ready(), 'page_ready', timeout)
+
+    def element_present(self, xpath, timeout=None):
+        return self.until(element_present(xpath), 'element_present', timeout)
+
+    def url_changed(self, previous_url, timeout=None):
+        return self.until(url_changed(previous_url), 'url_changed', timeout)
+
+    def content_changed(self, xpath, previous_snapshot, timeout=None):
+        return self.until(content_changed(xpath, previous_snapshot), 'content_changed', timeout)
+
+    def product_count_stable(self, xpath, min_count=0, timeout=None):
+        return self.until(product_count_stable(xpath, self.stable_for, min_count), 'product_count_stable', timeout)
+
+    def network_idle(self, idle_for=None, timeout=None):
+        return self.until(network_idle(idle_for or self.stable_for), 'network_idle', timeout)
+
+    def snapshot(self, xpath):
+        return snapshot(self.spider.driver, xpath)
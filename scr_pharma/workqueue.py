@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from datetime import date
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.project import data_path
+
+from .checkpoints import category_finished
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Cola de categorías compartida entre varios procesos del mismo spider (SQLite con leases).
+
+    Cada worker toma una categoría pendiente con un lease de `lease_seconds`; un hilo la
+    renueva mientras el proceso siga vivo. Si el worker muere, el lease vence y otro worker
+    vuelve a tomar la categoría, de modo que cada una tiene un solo dueño a la vez. Los
+    workers de una misma ejecución comparten el `run` (p.ej. la fecha o un id de main.py).
+
+    Una categoría se completa cuando el checkpoint del spider la da por terminada (señal
+    category_finished), no cuando se entrega: así las categorías que siguen en requests de
+    Scrapy no se pierden si el worker muere."""
+
+    def __init__(self, path, spider_name, run, worker_id=None, lease_seconds=600, stats=None):
+        self.path = path
+        self.spider_name = spider_name
+        self.run = run
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.stats = stats
+        # Categorías entregadas a este worker que todavía no terminaron
+        self.in_progress = set()
+        self.seeded = False
+        self.connection = self.connect()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS work ("
+            "spider TEXT, run TEXT, key TEXT, payload TEXT, status TEXT, worker TEXT, lease_expires REAL,"
+            "attempts INTEGER DEFAULT 0, position INTEGER, PRIMARY KEY (spider, run, key))")
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, name='work-queue-heartbeat', daemon=True)
+        self.heartbeat.start()
+
+    @classmethod
+    def from_spider(cls, spider):
+        # Activa con -a work_queue=<run> (true: la fecha de hoy) o WORK_QUEUE_RUN en settings
+        settings = spider.settings
+        run = str(getattr(spider, 'work_queue', '') or settings.get('WORK_QUEUE_RUN') or '')
+        if not run or run.lower() in ('0', 'false', 'no'):
+            return None
+        if run.lower() in ('1', 'true', 'yes'):
+            run = date.today().isoformat()
+        path = settings.get('WORK_QUEUE_FILE') or data_path('work_queue.sqlite', createdir=True)
+        worker = getattr(spider, 'worker', None)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}" + (f":{worker}" if worker else '')
+        queue = cls(path, spider.name, run, worker_id=worker_id,
+                    lease_seconds=settings.getfloat('WORK_QUEUE_LEASE_SECONDS', 600), stats=spider.crawler.stats)
+        spider.crawler.signals.connect(queue.category_finished, signal=category_finished)
+        spider.crawler.signals.connect(queue.spider_idle, signal=signals.spider_idle)
+        spider.crawler.signals.connect(queue.spider_closed, signal=signals.spider_closed)
+        return queue
+
+    def connect(self):
+        # Autocommit: las transacciones se abren explícitamente con BEGIN IMMEDIATE
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(f'work_queue/{key}')
+
+    def seed(self, items, key=str):
+        # Idempotente: el primer worker agrega las categorías y los demás no duplican nada
+        # Las categorías que fallaron vuelven a la cola cuando arranca un worker (p.ej. el resume de main.py),
+        # no cada vez que este worker vuelve a sembrar
+        rows = [(self.spider_name, self.run, key(item), json.dumps(item), position) for position, item in enumerate(items)]
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO work (spider, run, key, payload, status, position) VALUES (?, ?, ?, ?, 'pending', ?)", rows)
+        if not self.seeded:
+            self.connection.execute(
+                "UPDATE work SET status = 'pending', worker = NULL WHERE spider = ? AND run = ? AND status = 'failed'",
+                (self.spider_name, self.run))
+        self.connection.execute("COMMIT")
+        self.seeded = True
+
+    def lease(self):
+        # BEGIN IMMEDIATE toma el lock de escritura: dos workers no pueden tomar la misma fila
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT key, payload, status FROM work WHERE spider = ? AND run = ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) ORDER BY position LIMIT 1",
+                (self.spider_name, self.run, now)).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE work SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE spider = ? AND run = ? AND key = ?",
+                    (self.worker_id, now + self.lease_seconds, self.spider_name, self.run, row[0]))
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        if row[2] == 'leased':
+            logger.warning(f"Reclaiming {row[0]} from an expired lease")
+            self.inc_stat('reclaimed')
+        self.inc_stat('leased')
+        return row[0], json.loads(row[1])
+
+    def leased_count(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM work WHERE spider = ? AND run = ? AND status = 'leased'",
+            (self.spider_name, self.run)).fetchone()[0]
+
+    def available_count(self):
+        # Pendientes o con el lease vencido (su worker murió): las que lease() entregaría ahora
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM work WHERE spider = ? AND run = ? "
+            "AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?))",
+            (self.spider_name, self.run, time.time())).fetchone()[0]
+
+    def complete(self, key):
+        cursor = self.connection.execute(
+            "UPDATE work SET status = 'done', lease_expires = NULL WHERE spider = ? AND run = ? AND key = ? "
+            "AND worker = ? AND status = 'leased'", (self.spider_name, self.run, key, self.worker_id))
+        if cursor.rowcount == 0:
+            # El lease venció y otro worker tomó la categoría: ese worker queda como dueño
+            logger.warning(f"Lost the lease on {key} before completing it")
+            self.inc_stat('lost')
+            return False
+        self.inc_stat('completed')
+        return True
+
+    def fail(self, key):
+        # Fuera de la rotación de los workers que siguen vivos, para que no la reintenten en loop;
+        # el próximo worker que arranque en esta ejecución la vuelve a sembrar como pendiente
+        cursor = self.connection.execute(
+            "UPDATE work SET status = 'failed', lease_expires = NULL WHERE spider = ? AND run = ? AND key = ? "
+            "AND worker = ? AND status = 'leased'", (self.spider_name, self.run, key, self.worker_id))
+        if cursor.rowcount:
+            logger.warning(f"Category {key} failed; it will be retried by the next worker of run {self.run}")
+            self.inc_stat('failed')
+
+    def release(self, key):
+        # Devolver la categoría a la cola sin completarla (p.ej. el worker se detiene)
+        self.connection.execute(
+            "UPDATE work SET status = 'pending', worker = NULL, lease_expires = NULL WHERE spider = ? AND run = ? "
+            "AND key = ? AND worker = ? AND status = 'leased'", (self.spider_name, self.run, key, self.worker_id))
+
+    def claim(self, items, key=str, done=None):
+        """Siembra la cola con `items` y entrega los que este worker obtiene en lease.
+
+        Las categorías entregadas siguen en lease (renovado por el heartbeat) hasta que el
+        checkpoint del spider las termina o las marca fallidas; las que `done(payload)` ya da por
+        terminadas (p.ej. al retomar) se completan sin entregarlas. Si el loop se abandona a
+        mitad de una categoría, esta vuelve a la cola; si el proceso muere, queda en lease hasta
+        que vence y otro worker la retoma. Los payloads pasan por JSON: las tuplas vuelven como listas."""
+        self.seed(items, key)
+        current = None
+        try:
+            while True:
+                # Sin pendientes no se espera acá: spider_idle mantiene vivo al worker mientras otros
+                # tengan categorías en lease, sin bloquear el reactor
+                leased = self.lease()
+                if leased is None:
+                    return
+                current, payload = leased
+                if done is not None and done(payload):
+                    self.complete(current)
+                    continue
+                self.in_progress.add(current)
+                yield payload
+        except GeneratorExit:
+            # El spider cerró el loop antes de terminar la categoría: se devuelve a la cola
+            if current in self.in_progress:
+                self.in_progress.discard(current)
+                self.release(current)
+            raise
+
+    def category_finished(self, category, failed):
+        # Señal del checkpoint: solo cuentan las categorías que este worker tiene en lease
+        if category not in self.in_progress:
+            return
+        self.in_progress.discard(category)
+        if failed:
+            self.fail(category)
+        else:
+            self.complete(category)
+
+    def spider_idle(self, spider):
+        # Sin requests en vuelo, lo que quedó en lease de este worker ya no va a terminar
+        for key in list(self.in_progress):
+            logger.warning(f"Category {key} was not finished before the spider went idle")
+            self.in_progress.discard(key)
+            self.fail(key)
+        if self.available_count():
+            # Un lease vencido de otro worker: se vuelve a entrar al loop de categorías del spider
+            for request in spider.start_requests():
+                spider.crawler.engine.crawl(request.replace(dont_filter=True))
+            raise DontCloseSpider
+        if self.leased_count():
+            # Otros workers siguen con categorías en lease: spider_idle vuelve a llamarse en unos
+            # segundos, por si alguno muere y su lease vence
+            raise DontCloseSpider
+
+    def renew_leases(self):
+        # Heartbeat: mientras el proceso viva, sus leases no vencen
+        connection = self.connect()
+        try:
+            while not self.stop_heartbeat.wait(self.lease_seconds / 3):
+                connection.execute(
+                    "UPDATE work SET lease_expires = ? WHERE worker = ? AND status = 'leased'",
+                    (time.time() + self.lease_seconds, self.worker_id))
+        except sqlite3.Error as e:
+            logger.error(f"Work queue heartbeat stopped: {e}")
+        finally:
+            connection.close()
+
+    def close(self):
+        self.stop_heartbeat.set()
+        self.connection.close()
+
+    def spider_closed(self, spider):
+        self.close()
+
+
+def claim_categories(spider, categories, key=str):
+    """Categorías a procesar por este proceso: todas, o las que entrega la cola compartida
+    si el spider se lanzó con -a work_queue=<run>. `key` es también la clave de la categoría en
+    el checkpoint del spider: la cola la completa cuando el checkpoint llama a category_done(categoría),
+    o la marca fallida con mark_failed(categoría)."""
+    if not hasattr(spider, 'category_queue'):
+        spider.category_queue = WorkQueue.from_spider(spider)
+    if spider.category_queue is None:
+        return iter(categories)
+    checkpoint = getattr(spider, 'checkpoint', None)
+    done = (lambda payload: checkpoint.is_done(key(payload))) if checkpoint is not None else None
+    return spider.category_queue.claim(categories, key, done)
@@ -0,0 +1,106 @@
+import sys
+import json
+import subprocess
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from scrapy.http import Request, TextResponse
+from scrapy.utils.test import get_crawler
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+
+def load_fixture(*parts):
+    return json.loads(FIXTURES.joinpath(*parts).read_text(encoding='utf-8'))
+
+
+def make_spider(spider_class, settings=None, **kwargs):
+    crawler = get_crawler(spider_class, settings or {})
+    return spider_class.from_crawler(crawler, **kwargs)
+
+
+def json_response(request, payload, status=200, headers=None):
+    # Respuesta de una API JSON para `request`, como la entrega el downloader
+    return TextResponse(request.url, status=status, body=json.dumps(payload).encode('utf-8'), encoding='utf-8',
+                        request=request, headers={'Content-Type': 'application/json', **(headers or {})})
+
+
+def requests_and_items(results):
+    results = list(results)
+    return [r for r in results if isinstance(r, Request)], [r for r in results if not isinstance(r, Request)]
+
+
+class StubServer(ThreadingHTTPServer):
+    """Servidor local que responde con `route(method, path, query, body) -> (status, payload)`,
+    o `(status, payload, headers)`, para correr un spider completo contra respuestas JSON grabadas."""
+    daemon_threads = True
+
+    def __init__(self, route):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.route = route
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        self.server.requests.append((self.command, self.path))
+        status, payload, *headers = self.server.route(self.command, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(route):
+        server = StubServer(route)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def crawl(tmp_path):
+    """Corre `scrapy crawl` en un proceso aparte (el reactor no se puede reiniciar) y devuelve
+    los ítems exportados. Sin pipelines: no hace falta credentials.py ni se escribe en datafolder."""
+    def run(spider, *settings, args=()):
+        output = tmp_path / f'{spider}.json'
+        command = [sys.executable, '-m', 'scrapy', 'crawl', spider, '-O', str(output),
+                   '-s', 'ITEM_PIPELINES={}', '-s', 'CONTENT_CACHE_ENABLED=False', '-s', 'ROBOTSTXT_OBEY=False',
+                   '-s', 'DOWNLOAD_DELAY=0', '-s', 'LOG_LEVEL=WARNING']
+        for setting in settings:
+            command += ['-s', setting]
+        for arg in args:
+            command += ['-a', arg]
+        subprocess.run(command, cwd=ROOT, check=True)
+        return json.loads(output.read_text(encoding='utf-8'))
+    return run
@@ -0,0 +1,39 @@
+import pytest
+from scrapy import Spider
+from scrapy.http import Request, TextResponse
+
+from scr_pharma.middlewares import ScrPharmaDownloaderMiddleware
+
+from conftest import make_spider
+
+
+@pytest.fixture
+def cached(tmp_path):
+    spider = make_spider(Spider, {'CONTENT_CACHE_ENABLED': True, 'CONTENT_CACHE_FILE': str(tmp_path / 'cache.sqlite')}, name='vtex')
+    middleware = ScrPharmaDownloaderMiddleware(spider.crawler)
+    yield spider, middleware
+    middleware.cache.close()
+
+
+def download(spider, middleware, status, body):
+    request = Request('https://www.profar.cl/api/catalog_system/pub/products/search?_from=0&_to=49',
+                      meta={'content_cache': True})
+    middleware.process_request(request, spider)
+    response = TextResponse(request.url, status=status, body=body, encoding='utf-8', request=request)
+    return request, middleware.process_response(request, response, spider)
+
+
+@pytest.mark.parametrize('status', [200, 206])
+def test_successful_responses_with_a_body_are_cached(cached, status):
+    spider, middleware = cached
+    request, response = download(spider, middleware, status, b'[{"productId": "1"}]')
+    assert response.status == status
+    assert request.meta['content_cache_state']['content_hash']
+    assert spider.crawler.stats.get_value('content_cache/changed') == 1
+
+
+@pytest.mark.parametrize('status, body', [(204, b''), (302, b''), (404, b'not found'), (503, b'blocked')])
+def test_other_responses_are_not_cached(cached, status, body):
+    spider, middleware = cached
+    request, _ = download(spider, middleware, status, body)
+    assert 'content_cache_state' not in request.meta
@@ -0,0 +1,100 @@
+from urllib.parse import parse_qs, urlparse
+
+from scr_pharma.spiders.cruzverde import CruzVerdeSpider
+
+from conftest import load_fixture, make_spider, json_response, requests_and_items
+
+
+def search_fixture(category_id, offset):
+    return load_fixture('cruzverde', f'search_{category_id}_{offset}.json')
+
+
+def search_route(method, path, query, body):
+    # Mismas rutas que api.cruzverde.cl, con las respuestas grabadas en fixtures/cruzverde
+    if path == '/product-service/categories/category-tree':
+        return 200, load_fixture('cruzverde', 'category_tree.json')
+    if path == '/product-service/products/search':
+        category_id = query['refine[]'][0].split('=', 1)[1]
+        return 200, search_fixture(category_id, int(query['offset'][0]))
+    return 404, {}
+
+
+def offset_of(request):
+    return int(parse_qs(urlparse(request.url).query)['offset'][0])
+
+
+def test_category_tree_requests_first_page_of_each_category():
+    spider = make_spider(CruzVerdeSpider)
+    tree = spider.api_request(spider.category_tree_url(), spider.parse_category_tree)
+    requests, items = requests_and_items(spider.parse_category_tree(json_response(tree, load_fixture('cruzverde', 'category_tree.json'))))
+    assert items == []
+    assert [request.meta['category_id'] for request in requests] == ['medicamentos', 'dermocosmetica']
+    assert all(offset_of(request) == 0 and request.meta['offset'] == 0 for request in requests)
+
+
+def test_first_search_page_fans_out_remaining_offsets():
+    spider = make_spider(CruzVerdeSpider)
+    request = spider.api_request(spider.search_url('medicamentos', 0), spider.parse_search_page,
+                                 meta={'category_path': ['Medicamentos'], 'category_id': 'medicamentos', 'offset': 0})
+    requests, items = requests_and_items(spider.parse_search_page(json_response(request, search_fixture('medicamentos', 0))))
+    assert sorted(offset_of(request) for request in requests) == [48, 96]
+    assert len(items) == 48
+
+    # Las páginas siguientes no vuelven a pedir offsets
+    later = requests[0]
+    more, items = requests_and_items(spider.parse_search_page(json_response(later, search_fixture('medicamentos', offset_of(later)))))
+    assert more == [] and items
+
+
+def test_product_mapping():
+    spider = make_spider(CruzVerdeSpider)
+    request = spider.api_request(spider.search_url('medicamentos', 0), spider.parse_search_page,
+                                 meta={'category_path': ['Medicamentos'], 'category_id': 'medicamentos', 'offset': 0})
+    _, items = requests_and_items(spider.parse_search_page(json_response(request, search_fixture('medicamentos', 0))))
+    first, second = items[0], items[1]
+    assert first['url'] == 'https://www.cruzverde.cl/medicamentos/100000.html'
+    assert first['name'] == 'Producto medicamentos 0'
+    assert first['brand'] == 'Bayer'
+    assert first['code'] == 'MED00000'
+    assert first['category'] == 'Medicamentos'
+    assert first['price'] == 5990 and first['price_sale'] == 4990
+    # Sin price-sale-cl en la respuesta no hay precio de oferta
+    assert second['price'] == 6000 and second['price_sale'] == 0
+    assert first['spider_name'] == 'cruzverde'
+
+
+def test_rejected_requests_in_flight_are_retried_with_cookies(monkeypatch):
+    spider = make_spider(CruzVerdeSpider)
+    warm_ups = []
+
+    def warm_up_cookies():
+        warm_ups.append(1)
+        spider.api_cookies = {'session': 'abc'}
+    monkeypatch.setattr(spider, 'warm_up_cookies', warm_up_cookies)
+
+    # Dos offsets ya en vuelo sin cookies cuando llega el primer 401
+    in_flight = [spider.api_request(spider.search_url('medicamentos', offset), spider.parse_search_page,
+                                    meta={'category_path': ['Medicamentos'], 'category_id': 'medicamentos', 'offset': offset})
+                 for offset in (48, 96)]
+    retries = [list(spider.parse_search_page(json_response(request, {}, status=401))) for request in in_flight]
+
+    assert len(warm_ups) == 1
+    assert [len(retry) for retry in retries] == [1, 1]
+    for request, (retry,) in zip(in_flight, retries):
+        assert retry.url == request.url
+        assert retry.cookies == {'session': 'abc'}
+        assert retry.meta['with_cookies'] and retry.meta['offset'] == request.meta['offset']
+
+    # Rechazada otra vez con las cookies del warm-up: se abandona
+    assert list(spider.parse_search_page(json_response(retries[0][0], {}, status=403))) == []
+    assert len(warm_ups) == 1
+
+
+def test_crawl_against_stub_server(stub_server, crawl):
+    server = stub_server(search_route)
+    items = crawl('cruzverde', f'CRUZVERDE_API_URL={server.url}')
+    assert len(items) == 103
+    assert len({item['url'] for item in items}) == 103
+    # Un request por offset: el offset 0 no se pide dos veces
+    searches = [path for method, path in server.requests if 'products/search' in path]
+    assert len(searches) == 4
@@ -0,0 +1,197 @@
+import json
+
+from scrapy.http import HtmlResponse, Request, TextResponse
+from twisted.python.failure import Failure
+
+from scr_pharma.checkpoints import Checkpoint
+from scr_pharma.spiders import farmex
+from scr_pharma.spiders.farmex import FarmexSpider
+
+from conftest import load_fixture, make_spider, requests_and_items
+
+# Menú de la home de farmex.cl tal como viene en el HTML, sin JavaScript
+HOME = """<html><body><ul class="nav main-nav"><li class="dropdown"><ul class="dropdown-menu">
+<li class="dropdown dropdown-submenu"><a class="dropdown-link" href="/collections/medicamentos">Medicamentos</a></li>
+<li class="dropdown dropdown-submenu"><a class="dropdown-link" href="/collections/dermocosmetica">Dermocosmética</a></li>
+</ul></li></ul></body></html>"""
+
+
+def no_chrome(settings=None):
+    raise AssertionError("Chrome should not be started")
+
+
+def test_shopify_backend_reads_categories_without_chrome(monkeypatch, tmp_path):
+    monkeypatch.setattr(farmex, 'acquire_driver', no_chrome)
+    spider = make_spider(FarmexSpider, {'CHECKPOINT_DIR': str(tmp_path)})
+    assert spider.driver is None
+    home = HtmlResponse('https://farmex.cl/', body=HOME, encoding='utf-8', request=Request('https://farmex.cl/'))
+    requests, items = requests_and_items(spider.parse_categories(home))
+    assert items == []
+    assert {request.meta['category'] for request in requests} == {'medicamentos', 'dermocosmetica'}
+    assert all(request.url.startswith('https://farmex.cl/collections/') and 'products.json' in request.url
+               for request in requests)
+    assert spider.driver is None
+
+
+def products_page(request, count):
+    products = [{'handle': f"p{request.meta['page']}-{n}", 'title': 'Producto', 'vendor': 'Marca',
+                 'variants': [{'price': '1990', 'sku': str(n), 'available': True}]} for n in range(count)]
+    return TextResponse(request.url, body=json.dumps({'products': products}), encoding='utf-8', request=request)
+
+
+def finish(spider, request, count):
+    # Lo que hace ScrPharmaSpiderMiddleware: el callback y luego response_finished con su salida
+    response = products_page(request, count)
+    outputs = list(spider.parse_products_json(response))
+    spider.response_finished(response, outputs)
+    return [output for output in outputs if isinstance(output, Request)]
+
+
+def test_collection_is_done_only_after_every_page_up_to_the_last(tmp_path):
+    spider = make_spider(FarmexSpider, {'CHECKPOINT_DIR': str(tmp_path)})
+    spider.checkpoint = Checkpoint(spider)
+    spider.products_per_page = 2
+    window = list(spider.parse_category('medicamentos', 'https://farmex.cl/collections/medicamentos'))
+    assert [request.meta['page'] for request in window] == [1, 2, 3, 4]
+
+    # La página 2 es la última (incompleta) pero la 1 sigue en vuelo; la 3 y la 4 vuelven vacías
+    assert finish(spider, window[1], 1) == []
+    assert finish(spider, window[2], 0) == [] and finish(spider, window[3], 0) == []
+    assert not spider.checkpoint.is_done('medicamentos')
+    next_page, = finish(spider, window[0], 2)
+    assert next_page.meta['page'] == 5
+    assert spider.checkpoint.is_done('medicamentos')
+
+
+def test_collection_with_a_failed_page_is_not_done(tmp_path):
+    spider = make_spider(FarmexSpider, {'CHECKPOINT_DIR': str(tmp_path)})
+    spider.checkpoint = Checkpoint(spider)
+    window = list(spider.parse_category('medicamentos', 'https://farmex.cl/collections/medicamentos'))
+    failure = Failure(IOError('connection lost'))
+    failure.request = window[0]
+    spider.products_json_failed(failure)
+    for request in window[1:]:
+        finish(spider, request, 0)
+    assert not spider.checkpoint.is_done('medicamentos')
+    assert spider.checkpoint.failed
+
+
+def products_fixture(request):
+    # Respuesta grabada de <colección>/products.json; las páginas más allá del final vuelven vacías
+    try:
+        payload = load_fixture('farmex', f"products_{request.meta['category']}_{request.meta['page']}.json")
+    except FileNotFoundError:
+        payload = {'products': []}
+    return TextResponse(request.url, body=json.dumps(payload), encoding='utf-8', request=request)
+
+
+def test_product_json_record_mapping(tmp_path):
+    spider = make_spider(FarmexSpider, {'CHECKPOINT_DIR': str(tmp_path)})
+    request = spider.products_json_request('https://farmex.cl/collections/dermocosmetica', 'dermocosmetica', 1)
+    requests, items = requests_and_items(spider.parse_products_json(products_fixture(request)))
+    # 5 productos en una página de 250: es la última, no se pide otra
+    assert requests == []
+    on_sale, same_price, no_compare, second_variant, unavailable = items
+
+    assert on_sale['url'] == 'https://farmex.cl/collections/dermocosmetica/products/protector-solar-fps50'
+    assert on_sale['name'] == 'Protector Solar FPS50 50 ml'
+    assert on_sale['brand'] == 'La Roche-Posay'
+    assert on_sale['code'] == 'FX1001'
+    assert on_sale['category'] == 'dermocosmetica'
+    # Con oferta (compare_at_price > price), price es el precio tachado y price_sale el actual
+    assert (on_sale['price'], on_sale['price_sale']) == (15990, 12990)
+    # compare_at_price igual al precio, o ausente, no es oferta
+    assert (same_price['price'], same_price['price_sale']) == (8990, 0)
+    assert (no_compare['price'], no_compare['price_sale']) == (10490, 0)
+    # La primera variante no disponible se salta: precios y SKU son de la primera disponible
+    assert (second_variant['price'], second_variant['price_sale'], second_variant['code']) == (34990, 29990, 'FX1004-30')
+    # Sin variantes disponibles se usa la primera; compare_at_price menor al precio tampoco es oferta
+    assert (unavailable['price'], unavailable['price_sale']) == (6990, 0)
+    assert (unavailable['brand'], unavailable['code']) == ('No brand', 'No SKU')
+
+
+def test_page_window_stops_after_the_last_page(tmp_path):
+    spider = make_spider(FarmexSpider, {'CHECKPOINT_DIR': str(tmp_path)})
+    spider.checkpoint = Checkpoint(spider)
+    spider.products_per_page = 3
+    pending = list(spider.parse_category('medicamentos', 'https://farmex.cl/collections/medicamentos'))
+    requested, items = [], []
+    # Las respuestas llegan fuera de orden (la última request primero); la 6 es la última página (1 producto)
+    while pending:
+        request = pending.pop()
+        requested.append(request.meta['page'])
+        response = products_fixture(request)
+        outputs = list(spider.parse_products_json(response))
+        spider.response_finished(response, outputs)
+        more, page_items = requests_and_items(outputs)
+        pending.extend(more)
+        items.extend(page_items)
+        # Terminada recién cuando terminaron las páginas 1 a 6; la 5 es la última en hacerlo
+        assert spider.checkpoint.is_done('medicamentos') == (5 in requested)
+
+    # Cada página llena pide la que está page_window más adelante: 1-4 piden 5-8 y la 5 pide la 9
+    assert sorted(requested) == list(range(1, 10))
+    assert len(items) == 16 and len({item['url'] for item in items}) == 16
+    assert spider.collection_pages == {}
+
+
+def product_page(request, brand=None, price=None):
+    # Página de producto de farmex.cl: la marca en la disponibilidad y el precio del detalle
+    brand_html = f'<ul class="list-unstyled"><li><a href="/collections/vendors">{brand}</a></li></ul>' if brand else ''
+    price_html = f'<div class="detail-price">{price}</div>' if price else ''
+    body = (f'<html><body><div class="product-availability-wrapper">{brand_html}</div>'
+            f'<div class="product-price">{price_html}</div></body></html>')
+    return HtmlResponse(request.url, body=body, encoding='utf-8', request=request)
+
+
+def listing(url, price='$12.990', price_sale='$9.990'):
+    return {'brand': None, 'url': url, 'name': 'Producto', 'price': price, 'price_sale': price_sale,
+            'price_benef': '0', 'code': 'No SKU'}
+
+
+def brand_spider(tmp_path, cache):
+    path = tmp_path / 'farmex_brands.json'
+    path.write_text(json.dumps(cache), encoding='utf-8')
+    return make_spider(FarmexSpider, {'FARMEX_BRAND_CACHE_FILE': str(path), 'CHECKPOINT_DIR': str(tmp_path)})
+
+
+def test_cached_brand_skips_the_product_page(tmp_path):
+    url = 'https://farmex.cl/products/paracetamol'
+    spider = brand_spider(tmp_path, {url: 'Saval'})
+    item = spider.complete_details(listing(url), 'medicamentos')
+    assert not isinstance(item, Request)
+    assert (item['brand'], item['price'], item['price_sale']) == ('Saval', 12990, 9990)
+
+
+def test_brand_cache_miss_fetches_the_product_page(tmp_path):
+    url = 'https://farmex.cl/products/ibuprofeno'
+    spider = brand_spider(tmp_path, {})
+    request = spider.complete_details(listing(url), 'medicamentos')
+    assert isinstance(request, Request) and request.url == url
+    assert request.callback == spider.parse_product_page
+
+    item, = spider.parse_product_page(product_page(request, brand=' Recalcine '))
+    assert (item['brand'], item['price'], item['price_sale'], item['category']) == ('Recalcine', 12990, 9990, 'medicamentos')
+    assert spider.brand_cache[url] == 'Recalcine'
+    # La caché se guarda al cerrar: el próximo crawl ya no visita el producto
+    spider.closed('finished')
+    next_crawl = make_spider(FarmexSpider, {'FARMEX_BRAND_CACHE_FILE': str(tmp_path / 'farmex_brands.json')})
+    assert next_crawl.complete_details(listing(url), 'medicamentos')['brand'] == 'Recalcine'
+
+
+def test_stale_cached_brand_is_replaced_by_the_product_page(tmp_path):
+    url = 'https://farmex.cl/products/protector-solar'
+    spider = brand_spider(tmp_path, {url: 'Marca anterior'})
+    # Sin stock en el listado: el precio está solo en la página del producto, aunque la marca esté en caché
+    request = spider.complete_details(listing(url, price_sale='Sin Stock'), 'dermocosmetica')
+    assert isinstance(request, Request)
+
+    item, = spider.parse_product_page(product_page(request, brand='La Roche-Posay', price='$15.990'))
+    assert (item['brand'], item['price']) == ('La Roche-Posay', 15990)
+    assert spider.brand_cache[url] == 'La Roche-Posay'
+
+    # Si la página no trae marca se conserva la de la caché en vez de 'No brand'
+    request = spider.complete_details(listing(url, price_sale='No sale price'), 'dermocosmetica')
+    item, = spider.parse_product_page(product_page(request, price='$15.990'))
+    assert item['brand'] == 'La Roche-Posay'
+    assert spider.brand_cache[url] == 'La Roche-Posay'
@@ -0,0 +1,92 @@
+import sqlite3
+from datetime import datetime
+
+from scrapy import Spider
+from sqlalchemy import create_engine, inspect, text
+from scrapy.settings import Settings
+from twisted.internet import defer, reactor
+
+from scr_pharma.benchmarks.hotpaths_benchmark import SQLITE_SCHEMA
+from scr_pharma.items import build_items
+from scr_pharma.pipelines import ScrPharmaPipeline, migrate_table
+
+
+class InlineWriter:
+    # DatabaseWriter sin hilo: el lote se escribe al entrar a la cola
+    def __init__(self, write):
+        self.write = write
+
+    def submit(self, batch):
+        self.write(batch)
+        return defer.succeed(None)
+
+
+def product(url, price):
+    return {'brand': 'Marca', 'url': url, 'name': url, 'price': price, 'price_sale': '0', 'price_benef': '0',
+            'code': 'No SKU', 'category': 'medicamentos'}
+
+
+def crawl(path, records, timestamp, **settings):
+    # Un crawl del spider por el pipeline, con el índice de precios cargado como en open_spider
+    spider = Spider('ahumada')
+    pipeline = ScrPharmaPipeline(Settings({'DATABASE_URI': f'sqlite:///{path}', 'DB_FLUSH_INTERVAL': 0,
+                                           **settings}))
+    if pipeline.track_prices:
+        pipeline.load_price_index(spider)
+    pipeline.writer = InlineWriter(lambda batch: pipeline.write_batch(batch, spider))
+    for item in build_items(records, spider.name, timestamp):
+        pipeline.insert_into_database(item, spider)
+    pipeline.flush_database(spider)
+    return pipeline
+
+
+def history_rows(path):
+    connection = sqlite3.connect(path)
+    rows = connection.execute("SELECT url, day, price FROM scr_pharma_history_2026_10 ORDER BY day, url").fetchall()
+    connection.close()
+    return rows
+
+
+def test_history_records_only_price_changes_without_change_only_writes(tmp_path, monkeypatch):
+    # confirm_prices vuelve al reactor con callFromThread; acá el lote se escribe en el mismo hilo
+    monkeypatch.setattr(reactor, 'callFromThread', lambda function, *args: function(*args))
+    path = tmp_path / 'scr_pharma.sqlite'
+    connection = sqlite3.connect(path)
+    connection.execute(SQLITE_SCHEMA)
+    connection.close()
+
+    crawl(path, [product('a/1', '1990'), product('a/2', '2990')], datetime(2026, 10, 17, 10),
+          ENABLE_CHANGE_ONLY_WRITES=False)
+    pipeline = crawl(path, [product('a/1', '1990'), product('a/2', '3490'), product('a/3', '990'), product('a/3', '990')],
+                     datetime(2026, 10, 18, 10), ENABLE_CHANGE_ONLY_WRITES=False)
+
+    # Sin escritura solo de cambios todas las filas se escriben, pero el historial solo recibe las nuevas o distintas
+    assert history_rows(path) == [('a/1', '2026-10-17', 1990.0), ('a/2', '2026-10-17', 2990.0),
+                                  ('a/2', '2026-10-18', 3490.0), ('a/3', '2026-10-18', 990.0)]
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT timestamp FROM scr_pharma WHERE url = 'a/1'").fetchone()[0].startswith('2026-10-18')
+    connection.close()
+    assert pipeline.price_index['a/2'] == (3490.0, 0.0, 0.0)
+    assert pipeline.pending_prices == {}
+
+
+def test_old_table_gets_last_seen_and_spider_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(reactor, 'callFromThread', lambda function, *args: function(*args))
+    path = tmp_path / 'scr_pharma.sqlite'
+    # Esquema anterior a las escrituras solo de cambios: sin last_seen ni índice por spider
+    connection = sqlite3.connect(path)
+    connection.execute(SQLITE_SCHEMA.replace(', last_seen DATETIME', ''))
+    connection.execute("INSERT INTO scr_pharma (name, url, category, price, brand, timestamp, spider_name) "
+                       "VALUES ('a/1', 'a/1', 'medicamentos', 1990, 'Marca', '2026-10-17 10:00:00', 'ahumada')")
+    connection.close()
+
+    crawl(path, [product('a/1', '1990'), product('a/2', '2990')], datetime(2026, 10, 18, 10), PRICE_HISTORY_ENABLED=False)
+    engine = create_engine(f'sqlite:///{path}')
+    # Idempotente: una segunda pasada (otro proceso, otro deploy) no cambia nada
+    migrate_table(engine)
+    columns = [column['name'] for column in inspect(engine).get_columns('scr_pharma')]
+    assert columns.count('last_seen') == 1
+    assert [index['column_names'] for index in inspect(engine).get_indexes('scr_pharma')] == [['spider_name']]
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT url, last_seen FROM scr_pharma ORDER BY url")).fetchall()
+    assert [(url, last_seen is not None) for url, last_seen in rows] == [('a/1', True), ('a/2', True)]
@@ -0,0 +1,100 @@
+from urllib.parse import parse_qs, urlparse
+
+from scr_pharma.spiders.profar import ProfarSpider
+
+from conftest import load_fixture, make_spider, json_response, requests_and_items
+
+# Total de productos por categoría en las respuestas grabadas (header "resources" de VTEX)
+TOTALS = {'medicamentos': 120, 'dermocosmetica': 3}
+
+
+def search_fixture(category, offset):
+    try:
+        return load_fixture('profar', f'search_{category}_{offset}.json')
+    except FileNotFoundError:
+        return []
+
+
+def resources(category, offset):
+    products = search_fixture(category, offset)
+    return {'resources': f"{offset}-{offset + len(products) - 1}/{TOTALS[category]}"} if category in TOTALS else {}
+
+
+def search_route(method, path, query, body):
+    # Misma ruta que la API de catálogo de profar.cl; las categorías sin respuesta grabada no traen el header
+    prefix = '/api/catalog_system/pub/products/search/'
+    if path.startswith(prefix):
+        category, offset = path[len(prefix):], int(query['_from'][0])
+        return 200, search_fixture(category, offset), resources(category, offset)
+    return 404, {}
+
+
+def parse(spider, request):
+    category, offset = request.meta['category'], request.meta['offset']
+    response = json_response(request, search_fixture(category, offset), headers=resources(category, offset))
+    return requests_and_items(spider.parse_search(response))
+
+
+def offsets(requests):
+    return [(int(parse_qs(urlparse(r.url).query)['_from'][0]), int(parse_qs(urlparse(r.url).query)['_to'][0])) for r in requests]
+
+
+def test_first_page_requests_remaining_offsets_from_resources_header():
+    spider = make_spider(ProfarSpider)
+    requests, items = parse(spider, spider.search_request('medicamentos', 0))
+    assert offsets(requests) == [(50, 99), (100, 149)]
+    assert len(items) == 50
+
+    # Las páginas siguientes no vuelven a pedir offsets: la paginación termina en la última
+    for request in requests:
+        more, items = parse(spider, request)
+        assert more == [] and items
+
+
+def test_total_resources():
+    spider = make_spider(ProfarSpider)
+    request = spider.search_request('medicamentos', 0)
+    assert spider.total_resources(json_response(request, [], headers={'resources': '0-49/1234'})) == 1234
+    # Sin header, o con uno que no se entiende, solo se procesa la primera página
+    assert spider.total_resources(json_response(request, [])) == 0
+    assert spider.total_resources(json_response(request, [], headers={'resources': '0-49'})) == 0
+    requests, _ = requests_and_items(spider.parse_search(json_response(request, search_fixture('medicamentos', 0))))
+    assert requests == []
+
+
+def test_pagination_stops_at_max_offset(caplog):
+    spider = make_spider(ProfarSpider)
+    request = spider.search_request('medicamentos', 0)
+    requests, _ = requests_and_items(spider.parse_search(json_response(request, [], headers={'resources': '0-49/10000'})))
+    assert offsets(requests)[-1] == (spider.max_offset, spider.max_offset + spider.page_size - 1)
+    assert len(requests) == spider.max_offset // spider.page_size
+    assert 'only pages the first 2550 of 10000' in caplog.text
+
+
+def test_product_mapping():
+    spider = make_spider(ProfarSpider)
+    _, items = parse(spider, spider.search_request('dermocosmetica', 0))
+    on_sale, out_of_stock, regular = items
+
+    assert on_sale['url'] == 'https://www.profar.cl/producto-dermocosmetica-0-700000/p'
+    assert on_sale['name'] == 'Producto dermocosmetica 0'
+    assert on_sale['brand'] == 'Bayer'
+    assert on_sale['code'] == '700000'
+    assert on_sale['category'] == 'dermocosmetica'
+    # ListPrice > Price: price es el precio con descuento y price_sale el normal tachado, como en la UI
+    assert (on_sale['price'], on_sale['price_sale']) == (12990, 15990)
+    # Sin stock VTEX deja Price en 0: se usa PriceWithoutDiscount y no se informa el SKU
+    assert (out_of_stock['price'], out_of_stock['price_sale']) == (8990, 0)
+    assert out_of_stock['code'] == 'No SKU'
+    assert (regular['price'], regular['price_sale']) == (4990, 0)
+    assert regular['code'] == '700002'
+
+
+def test_crawl_against_stub_server(stub_server, crawl):
+    server = stub_server(search_route)
+    items = crawl('profar', f'PROFAR_API_URL={server.url}')
+    assert len(items) == 123
+    assert len({item['url'] for item in items}) == 123
+    searches = [path for method, path in server.requests if 'products/search' in path]
+    # 3 páginas de medicamentos, 1 de dermocosmética y 1 por cada categoría sin header
+    assert len(searches) == 7
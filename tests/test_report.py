@@ -0,0 +1,34 @@
+import csv
+from datetime import date
+
+from scr_pharma.report import COLUMNS, build_report, day_paths, load_csv_snapshot
+
+DAY = date(2026, 10, 18)
+
+
+def write_csv(path, rows, extra=()):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS + list(extra))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def product(url, price, spider='ahumada'):
+    return {'url': url, 'name': url, 'category': 'medicamentos', 'price': price, 'price_sale': 0,
+            'price_benef': 0, 'timestamp': '2026-10-18 10:00:00', 'spider_name': spider}
+
+
+def test_quarantine_files_are_not_read_as_spiders(tmp_path):
+    write_csv(tmp_path / 'ahumada_2026_10_18.csv', [product('a/1', 1990), product('a/2', 2990)])
+    # Misma carpeta que los CSV diarios (DB_QUARANTINE_DIR = CSV_OUTPUT_DIR = datafolder)
+    write_csv(tmp_path / 'ahumada_quarantine_2026_10_18.csv', [{**product('a/3', 3990), 'error': 'IntegrityError'}],
+              extra=['error'])
+    write_csv(tmp_path / 'cruzverde_2026_10_18.csv', [product('c/1', 1890, 'cruzverde')])
+
+    paths = day_paths(str(tmp_path), DAY)
+    assert [path.rsplit('/', 1)[1] for path in paths] == ['ahumada_2026_10_18.csv', 'cruzverde_2026_10_18.csv']
+
+    reports = build_report(load_csv_snapshot(paths + [str(tmp_path / 'ahumada_quarantine_2026_10_18.csv')]))
+    assert len(reports['products']) == 3
+    chains = reports['chains'].set_index('spider_name')['products']
+    assert chains.to_dict() == {'ahumada': 2, 'cruzverde': 1}
@@ -0,0 +1,134 @@
+import json
+from urllib.parse import parse_qs
+
+import pytest
+
+from scr_pharma.items import build_items, details_record
+from scr_pharma.spiders.salcobrand import SalcobrandSpider
+
+from conftest import load_fixture, make_spider, json_response, requests_and_items
+
+ALGOLIA = {
+    'SALCOBRAND_ALGOLIA_APP_ID': 'TESTAPP',
+    'SALCOBRAND_ALGOLIA_API_KEY': 'search-only-key',
+    'SALCOBRAND_ALGOLIA_INDEX': 'products',
+    # Con un límite chico las respuestas grabadas alcanzan para probar la partición por marca
+    'SALCOBRAND_ALGOLIA_PAGINATION_LIMIT': 4,
+}
+EMPTY = {'hits': [], 'nbHits': 0, 'page': 0, 'nbPages': 0, 'hitsPerPage': 1000}
+
+
+def query_params(body):
+    params = parse_qs(json.loads(body)['params'])
+    return {key: values[0] for key, values in params.items()}
+
+
+def query_fixture(params):
+    # fixtures/salcobrand/query_<categoría>[_<marca>].json según los facetFilters de la consulta
+    values = [group[0].split(':', 1)[1] for group in json.loads(params['facetFilters'])]
+    try:
+        return load_fixture('salcobrand', f"query_{'_'.join(values)}.json")
+    except FileNotFoundError:
+        return EMPTY
+
+
+def algolia_route(method, path, query, body):
+    if method == 'POST' and path == '/1/indexes/products/query':
+        return 200, query_fixture(query_params(body))
+    return 404, {}
+
+
+def parse(spider, request):
+    return requests_and_items(spider.parse_algolia(json_response(request, query_fixture(query_params(request.body)))))
+
+
+def test_hit_mapping():
+    spider = make_spider(SalcobrandSpider, ALGOLIA)
+    requests, items = parse(spider, spider.algolia_request('dermocoaching', 0))
+    assert requests == []
+    by_code = {item['code']: item for item in items}
+    assert set(by_code) == {'100001', '100002', '100003'}
+
+    on_sale = by_code['100001']
+    assert on_sale['url'] == 'https://salcobrand.cl/products/producto-1-dermocoaching'
+    assert on_sale['name'] == 'Producto 1 dermocoaching'
+    assert on_sale['brand'] == 'La Roche-Posay'
+    assert on_sale['category'] == 'dermocoaching'
+    assert (on_sale['price'], on_sale['price_sale'], on_sale['price_benef']) == (15990, 12990, 0)
+    # Los tres niveles de precio
+    internet = by_code['100002']
+    assert (internet['price'], internet['price_sale'], internet['price_benef']) == (21990, 18990, 17990)
+    regular = by_code['100003']
+    assert (regular['price'], regular['price_sale'], regular['price_benef']) == (9990, 0, 0)
+
+
+def test_field_names_can_be_overridden():
+    spider = make_spider(SalcobrandSpider, {**ALGOLIA, 'SALCOBRAND_ALGOLIA_FIELDS': {'code': 'objectID'}})
+    _, items = parse(spider, spider.algolia_request('dermocoaching', 0))
+    assert {item['code'] for item in items} == {'5001', '5002', '5003'}
+
+
+def test_missing_attributes_are_reported(caplog):
+    spider = make_spider(SalcobrandSpider, {**ALGOLIA, 'SALCOBRAND_ALGOLIA_FIELDS': {'price': 'list_price'}})
+    parse(spider, spider.algolia_request('dermocoaching', 0))
+    assert 'no list_price attribute' in caplog.text
+    assert spider.crawler.stats.get_value('algolia/unmapped_pages') == 1
+
+
+def test_category_over_pagination_limit_is_split_by_brand():
+    spider = make_spider(SalcobrandSpider, ALGOLIA)
+    request = spider.algolia_request('medicamentos', 0)
+    assert query_params(request.body)['facets'] == '["brand"]'
+    requests, items = parse(spider, request)
+    # Los hits de la consulta sin partir se descartan: vuelven en las consultas por marca
+    assert items == []
+    assert sorted(request.meta['split_value'] for request in requests) == ['Bayer', 'Mintlab']
+
+    split_items = []
+    for split in requests:
+        more, items = parse(spider, split)
+        assert more == []
+        split_items += items
+    assert len({item['url'] for item in split_items}) == 7
+
+
+def test_split_reports_hits_without_a_facet_value(caplog):
+    spider = make_spider(SalcobrandSpider, ALGOLIA)
+    request = spider.algolia_request('medicamentos', 0)
+    data = {**load_fixture('salcobrand', 'query_medicamentos.json'), 'nbHits': 9}
+    requests, _ = requests_and_items(spider.parse_algolia(json_response(request, data)))
+    assert len(requests) == 2
+    assert 'misses 2 of 9 hits' in caplog.text
+    assert spider.crawler.stats.get_value('algolia/truncated_hits') == 2
+
+
+def test_crawl_against_stub_server(stub_server, crawl):
+    server = stub_server(algolia_route)
+    items = crawl('salcobrand', *[f'{key}={value}' for key, value in ALGOLIA.items()],
+                  f'SALCOBRAND_ALGOLIA_URL={server.url}')
+    assert len(items) == 10
+    assert {item['category'] for item in items} == {'dermocoaching', 'medicamentos'}
+
+
+def card(**prices):
+    # Campos de una tarjeta del listado (product_fields) como los extrae el backend Selenium
+    fields = {'brand': 'Eucerin', 'url': 'https://salcobrand.cl/products/producto?default_sku=100003',
+              'name': 'Producto', 'internet_sale_price': '', 'secondary_sale_price': '', 'sale_price': '', 'original_price': ''}
+    return {**fields, **prices}
+
+
+@pytest.mark.parametrize('hit, details', [
+    # Sin oferta: la tarjeta muestra un solo precio, en sale-price
+    ({'normal_price': 9990.0}, card(sale_price='$9.990')),
+    ({'normal_price': 9990.0, 'sale_price': 9990.0}, card(sale_price='$9.990')),
+    ({'normal_price': 15990.0, 'sale_price': 12990.0}, card(original_price='$15.990', sale_price='$12.990')),
+    ({'normal_price': 21990.0, 'sale_price': 18990.0, 'internet_sale_price': 17990.0},
+     card(original_price='$21.990', secondary_sale_price='$18.990', internet_sale_price='$17.990')),
+])
+def test_both_backends_store_the_same_prices(hit, details):
+    spider = make_spider(SalcobrandSpider, ALGOLIA)
+    algolia, = build_items([spider.hit_record({'slug': 'producto', 'default_sku': '100003', **hit}, 'dermocoaching')], spider.name)
+    selenium, = build_items([details_record(spider.product_details(details), 'dermocoaching')], spider.name)
+    prices = lambda item: (item['price'], item['price_sale'], item['price_benef'])
+    assert prices(algolia) == prices(selenium)
+    assert algolia['price'] > 0
@@ -0,0 +1,80 @@
+import pytest
+from scrapy import Spider
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import Request
+
+from scr_pharma.checkpoints import Checkpoint
+from scr_pharma.workqueue import WorkQueue, claim_categories
+
+from conftest import make_spider
+
+CATEGORIES = ['a', 'b', 'c']
+
+
+class QueueSpider(Spider):
+    name = 'queue'
+    start_urls = ['https://example.com/']
+
+
+@pytest.fixture
+def spider(tmp_path):
+    spider = make_spider(QueueSpider, {'WORK_QUEUE_FILE': str(tmp_path / 'queue.sqlite'),
+                                       'CHECKPOINT_DIR': str(tmp_path)}, work_queue='run-1')
+    spider.checkpoint = Checkpoint(spider)
+    yield spider
+    spider.category_queue.close()
+
+
+def statuses(queue):
+    return dict(queue.connection.execute("SELECT key, status FROM work WHERE run = ?", (queue.run,)))
+
+
+def test_categories_complete_when_the_checkpoint_finishes_them(spider):
+    claimed = list(claim_categories(spider, CATEGORIES))
+    queue = spider.category_queue
+    # El loop ya pidió todas, pero ninguna terminó: siguen en lease
+    assert claimed == CATEGORIES
+    assert set(statuses(queue).values()) == {'leased'}
+
+    spider.checkpoint.category_done('a')
+    spider.checkpoint.mark_failed('b')
+    assert statuses(queue) == {'a': 'done', 'b': 'failed', 'c': 'leased'}
+
+    # Sin requests en vuelo, lo que sigue en lease de este worker ya no va a terminar
+    queue.spider_idle(spider)
+    assert statuses(queue)['c'] == 'failed'
+
+
+def test_idle_worker_waits_for_other_leases_without_blocking(spider, monkeypatch):
+    other = WorkQueue(spider.settings['WORK_QUEUE_FILE'], spider.name, 'run-1', worker_id='other', lease_seconds=600)
+    other.seed(CATEGORIES)
+    assert other.lease()[0] == 'a'
+
+    assert list(claim_categories(spider, CATEGORIES)) == ['b', 'c']
+    queue = spider.category_queue
+    spider.checkpoint.category_done('b')
+    spider.checkpoint.category_done('c')
+    crawled = []
+    monkeypatch.setattr(spider.crawler, 'engine', type('Engine', (), {'crawl': lambda self, request: crawled.append(request)})())
+
+    with pytest.raises(DontCloseSpider):
+        queue.spider_idle(spider)
+    assert crawled == []
+
+    # El otro worker murió: su lease vence y este vuelve a entrar al loop de categorías
+    other.connection.execute("UPDATE work SET lease_expires = 0 WHERE key = 'a'")
+    other.close()
+    with pytest.raises(DontCloseSpider):
+        queue.spider_idle(spider)
+    assert [request.url for request in crawled] == ['https://example.com/']
+    assert all(isinstance(request, Request) and request.dont_filter for request in crawled)
+    assert list(claim_categories(spider, CATEGORIES)) == ['a']
+    spider.checkpoint.category_done('a')
+    assert set(statuses(queue).values()) == {'done'}
+    queue.spider_idle(spider)
+
+
+def test_categories_already_done_in_the_checkpoint_are_not_handed_out(spider):
+    spider.checkpoint.category_done('a')
+    assert list(claim_categories(spider, CATEGORIES)) == ['b', 'c']
+    assert statuses(spider.category_queue)['a'] == 'done'